@@ -0,0 +1,50 @@
+from qversions._db import Base, DeviceModel, GateModel, QubitModel
+from sqlalchemy import create_engine
+import os
+import tempfile
+import timeit
+
+"""
+Helpers shared by the benchmark scripts.
+"""
+
+def make_engine():
+    """
+    Return an engine on a fresh sqlite file with the schema created.
+    """
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    engine = create_engine("sqlite:///" + path)
+    Base.metadata.create_all(engine)
+    return engine
+
+def populate(engine, device_id, qubits, gates_per_qubit, versions):
+    """
+    Write a device whose every qubit and gate has been saved `versions` times.
+    """
+    qubit_rows = []
+    gate_rows = []
+    for version in range(versions):
+        for qubit_id in range(qubits):
+            value = float(version)
+            qubit_rows.append(dict(device_id=device_id, qubit_id=qubit_id,
+                    timestamp=version * 10 + 1, resonance_frequency=value,
+                    t1=value, t2=value, archived=False))
+            for gate_number in range(gates_per_qubit):
+                gate_rows.append(dict(device_id=device_id, qubit_id=qubit_id,
+                        gate_id="G{}".format(gate_number),
+                        timestamp=version * 10 + 2, amplitude=value,
+                        width=value, phase=value, archived=False))
+
+    with engine.begin() as connection:
+        connection.execute(DeviceModel.__table__.insert(),
+                dict(device_id=device_id, description="benchmark", archived=False))
+        connection.execute(QubitModel.__table__.insert(), qubit_rows)
+        if gate_rows:
+            connection.execute(GateModel.__table__.insert(), gate_rows)
+
+def best_of(f, number, repeat=5):
+    """
+    Best wall clock time in milliseconds for a single call of f.
+    """
+    return min(timeit.repeat(f, number=number, repeat=repeat)) / number * 1000
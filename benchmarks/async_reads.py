@@ -0,0 +1,47 @@
+from ._history import make_engine, populate
+from concurrent.futures import ThreadPoolExecutor
+from qversions.async_device_summary import AsyncDeviceSummaries
+from qversions.device_summary import DeviceSummaries
+from sqlalchemy.ext.asyncio import create_async_engine
+import asyncio
+import time
+
+"""
+Many simultaneous get_device calls from an event loop: pushed into a thread
+pool around DeviceSummaries as before, against AsyncDeviceSummaries on
+aiosqlite. Prints the total wall clock time for each batch of reads.
+
+Run from the root dir with `python3 -m benchmarks.async_reads`
+"""
+
+async def threaded(q, reads, executor):
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*[loop.run_in_executor(executor, q.get_device, "bench")
+            for _ in range(reads)])
+
+async def native(async_q, reads):
+    await asyncio.gather(*[async_q.get_device("bench") for _ in range(reads)])
+
+async def main():
+    engine = make_engine()
+    populate(engine, "bench", 20, 5, 10)
+    q = DeviceSummaries(engine)
+    async_engine = create_async_engine(str(engine.url).replace("sqlite://",
+            "sqlite+aiosqlite://"))
+    async_q = AsyncDeviceSummaries(async_engine)
+    assert await async_q.get_device("bench") == q.get_device("bench")
+
+    print("{:>8} {:>14} {:>14}".format("reads", "threads ms", "asyncio ms"))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for reads in [1, 10, 100]:
+            start = time.perf_counter()
+            await threaded(q, reads, executor)
+            threads = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            await native(async_q, reads)
+            native_ms = (time.perf_counter() - start) * 1000
+            print("{:>8} {:>14.1f} {:>14.1f}".format(reads, threads, native_ms))
+    await async_engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
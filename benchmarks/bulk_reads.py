@@ -0,0 +1,57 @@
+from ._history import best_of, make_engine, populate
+from qversions._db import DeviceModel
+from qversions.device_summary import DeviceSummaries, _make_summary
+from qversions.device import _wrap as _wrap_device
+from qversions.gate import _wrap as _wrap_gate
+from qversions.qubit import _wrap as _wrap_qubit
+
+"""
+Compare the bulk reads, which select plain columns and build Qubits and Gates
+straight from the rows, against the previous path which loaded QubitModel and
+GateModel instances through the ORM and copied them, on a device with 1000
+qubits and 20 gates per qubit.
+
+Run from the root dir with `python3 -m benchmarks.bulk_reads`
+"""
+
+QUBITS = 1000
+GATES_PER_QUBIT = 20
+
+def by_device(query):
+    return query.filter_by(device_id="bench")
+
+def orm_qubits(q):
+    with q.sessions.read() as session:
+        return _wrap_qubit(q.qubits._query(session, by_device).all())
+
+def orm_gates(q):
+    with q.sessions.read() as session:
+        return _wrap_gate(q.gates._query(session, by_device).all())
+
+def orm_device(q):
+    with q.sessions.read() as session:
+        device = _wrap_device(by_device(session.query(DeviceModel)).one())
+        qubits = _wrap_qubit(q.qubits._query(session, by_device).all())
+        gates = _wrap_gate(q.gates._query(session, by_device).all())
+    return _make_summary(device, qubits, gates)
+
+def main():
+    engine = make_engine()
+    populate(engine, "bench", QUBITS, GATES_PER_QUBIT, 1)
+    q = DeviceSummaries(engine)
+    assert orm_qubits(q) == q.qubits.get_qubits_by_device("bench")
+    assert orm_gates(q) == q.gates.get_gates_by_device("bench")
+    assert orm_device(q) == q.get_device("bench")
+
+    print("{:>22} {:>10} {:>10}".format("read", "ORM ms", "Core ms"))
+    for name, old, new in [
+            ("get_qubits_by_device", orm_qubits,
+                lambda q: q.qubits.get_qubits_by_device("bench")),
+            ("get_gates_by_device", orm_gates,
+                lambda q: q.gates.get_gates_by_device("bench")),
+            ("get_device", orm_device, lambda q: q.get_device("bench"))]:
+        print("{:>22} {:>10.3f} {:>10.3f}".format(name,
+                best_of(lambda: old(q), number=5), best_of(lambda: new(q), number=5)))
+
+if __name__ == "__main__":
+    main()
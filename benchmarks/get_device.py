@@ -0,0 +1,40 @@
+from ._history import best_of, make_engine, populate
+from qversions.device_summary import DeviceSummaries, _make_summary
+
+"""
+Compare DeviceSummaries.get_device against the previous path which used three
+separate sessions and queries, as the history of the device grows. The last
+column reads through the optional head tables instead of grouping the history.
+
+Run from the root dir with `python3 -m benchmarks.get_device`
+"""
+
+QUBITS = 20
+GATES_PER_QUBIT = 5
+
+def three_queries(q, device_id):
+    device = q.devices.get_device(device_id)
+    qubits = q.qubits.get_qubits_by_device(device_id)
+    gates = q.gates.get_gates_by_device(device_id)
+    return _make_summary(device, qubits, gates)
+
+def main():
+    print("{:>10} {:>14} {:>14} {:>14}".format("versions", "3 queries ms",
+            "get_device ms", "head tables ms"))
+    for versions in [1, 10, 100, 1000]:
+        engine = make_engine()
+        populate(engine, "bench", QUBITS, GATES_PER_QUBIT, versions)
+        q = DeviceSummaries(engine)
+        head_q = DeviceSummaries(engine, head_tables=True)
+        head_q.qubits.rebuild_head_table()
+        head_q.gates.rebuild_head_table()
+        assert three_queries(q, "bench") == q.get_device("bench")
+        assert head_q.get_device("bench") == q.get_device("bench")
+
+        old = best_of(lambda: three_queries(q, "bench"), number=20)
+        new = best_of(lambda: q.get_device("bench"), number=20)
+        head = best_of(lambda: head_q.get_device("bench"), number=20)
+        print("{:>10} {:>14.3f} {:>14.3f} {:>14.3f}".format(versions, old, new, head))
+
+if __name__ == "__main__":
+    main()
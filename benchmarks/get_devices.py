@@ -0,0 +1,32 @@
+from ._history import best_of, make_engine, populate
+from qversions.device_summary import DeviceSummaries
+
+"""
+Compare loading 100 device summaries with one get_devices call against calling
+get_device for each device, as the history of the devices grows.
+
+Run from the root dir with `python3 -m benchmarks.get_devices`
+"""
+
+DEVICES = 100
+QUBITS = 10
+GATES_PER_QUBIT = 5
+
+def main():
+    print("{:>10} {:>16} {:>16}".format("versions", "get_device ms", "get_devices ms"))
+    for versions in [1, 10, 100]:
+        engine = make_engine()
+        device_ids = ["bench-{:03}".format(i) for i in range(DEVICES)]
+        for device_id in device_ids:
+            populate(engine, device_id, QUBITS, GATES_PER_QUBIT, versions)
+        q = DeviceSummaries(engine)
+        one_by_one = lambda: dict((device_id, q.get_device(device_id))
+                for device_id in device_ids)
+        assert q.get_devices(device_ids) == one_by_one()
+
+        old = best_of(one_by_one, number=1)
+        new = best_of(lambda: q.get_devices(device_ids), number=1)
+        print("{:>10} {:>16.3f} {:>16.3f}".format(versions, old, new))
+
+if __name__ == "__main__":
+    main()
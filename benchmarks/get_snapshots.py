@@ -0,0 +1,35 @@
+from ._history import best_of, make_engine, populate
+from qversions.device_summary import DeviceSummaries
+
+"""
+Compare one get_snapshots call for 200 points in time against calling
+get_snapshot for each of them, as the history of a device with 100 qubits and
+5 gates per qubit grows.
+
+Run from the root dir with `python3 -m benchmarks.get_snapshots`
+"""
+
+QUBITS = 100
+GATES_PER_QUBIT = 5
+SNAPSHOTS = 200
+
+def main():
+    print("{:>10} {:>18} {:>18}".format("versions", "get_snapshot ms", "get_snapshots ms"))
+    for versions in [10, 100, 500]:
+        engine = make_engine()
+        populate(engine, "bench", QUBITS, GATES_PER_QUBIT, versions)
+        q = DeviceSummaries(engine)
+        # Versions are saved every 10 microseconds from 1 on
+        step = max(1, versions * 10 // SNAPSHOTS)
+        timestamps = [1 + i * step for i in range(SNAPSHOTS)]
+        one_by_one = lambda: [(timestamp, q.get_snapshot("bench", timestamp))
+                for timestamp in timestamps]
+        assert list(q.get_snapshots("bench", timestamps)) == one_by_one()
+
+        old = best_of(one_by_one, number=1, repeat=3)
+        new = best_of(lambda: list(q.get_snapshots("bench", timestamps)), number=1,
+                repeat=3)
+        print("{:>10} {:>18.3f} {:>18.3f}".format(versions, old, new))
+
+if __name__ == "__main__":
+    main()
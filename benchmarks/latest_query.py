@@ -0,0 +1,47 @@
+from ._history import best_of, make_engine, populate
+from qversions._db import Base
+from qversions._latest import supported_strategies
+from qversions.device_summary import DeviceSummaries
+from sqlalchemy import create_engine
+import sys
+
+"""
+Compare the latest_query strategies for get_snapshot in the middle of a
+device's history, for a wide device with little history and a narrow one with
+a deep history. Runs on a sqlite file by default. Pass a database url to run
+on Postgres, pointing at a scratch database since the qversions tables there
+are dropped and recreated.
+
+Run from the root dir with `python3 -m benchmarks.latest_query [url]`
+"""
+
+SHAPES = [("wide", 1000, 10, 5), ("deep", 20, 5, 500)]
+"""Name, qubits, gates per qubit and versions of each device"""
+
+def main():
+    if len(sys.argv) > 1:
+        engine = create_engine(sys.argv[1])
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+    else:
+        engine = make_engine()
+    strategies = supported_strategies(engine.dialect)
+
+    print("{:>8} ".format("shape") + " ".join("{:>14}".format(strategy + " ms")
+            for strategy in strategies))
+    for name, qubits, gates_per_qubit, versions in SHAPES:
+        populate(engine, name, qubits, gates_per_qubit, versions)
+        # Versions are saved every 10 microseconds from 1 on
+        timestamp = versions * 5 + 1
+        expected = DeviceSummaries(engine, latest_query="group_by")\
+                .get_snapshot(name, timestamp)
+        timings = []
+        for strategy in strategies:
+            q = DeviceSummaries(engine, latest_query=strategy)
+            assert q.get_snapshot(name, timestamp) == expected
+            timings.append(best_of(lambda: q.get_snapshot(name, timestamp), number=3))
+        print("{:>8} ".format(name) + " ".join("{:>14.3f}".format(timing)
+                for timing in timings))
+
+if __name__ == "__main__":
+    main()
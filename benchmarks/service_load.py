@@ -0,0 +1,91 @@
+from ._history import make_engine, populate
+from qversions.device_summary import DeviceSummaries
+from qversions.service import Service
+from socketserver import ThreadingMixIn
+from threading import Thread
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+import sys
+import time
+import urllib.error
+import urllib.request
+
+"""
+Load test of the WSGI service against a local sqlite engine. Serves a device
+with 200 qubits and 10 gates per qubit over HTTP and measures requests per
+second and latency with concurrent clients, without the body cache, with it,
+with gzip, and for conditional requests answered with 304.
+
+Run from the root dir with `python3 -m benchmarks.service_load [clients] [requests]`
+"""
+
+QUBITS = 200
+GATES_PER_QUBIT = 10
+
+class ThreadingServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def fetch(url, headers):
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.read()
+    except urllib.error.HTTPError as e:
+        # 304 is raised as an error by urllib
+        if e.code != 304:
+            raise
+
+def run(url, headers, clients, requests):
+    """
+    Send requests from every client at once and return the requests per
+    second and the latencies in milliseconds.
+    """
+    latencies = []
+
+    def client():
+        for _ in range(requests):
+            start = time.perf_counter()
+            fetch(url, headers)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    threads = [Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return len(latencies) / elapsed, latencies
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    engine = make_engine()
+    populate(engine, "bench", QUBITS, GATES_PER_QUBIT, 1)
+    q = DeviceSummaries(engine)
+
+    print("{:>12} {:>10} {:>10} {:>10} {:>12}".format("scenario", "req/s", "p50 ms",
+            "p99 ms", "body bytes"))
+    for name, cache_size, headers in [
+            ("uncached", 0, {}),
+            ("cached", 256, {}),
+            ("gzip", 256, {"Accept-Encoding": "gzip"}),
+            ("304", 256, {"If-None-Match": '"{}"'.format(q.get_version("bench"))})]:
+        server = make_server("127.0.0.1", 0, Service(q, cache_size=cache_size),
+                server_class=ThreadingServer, handler_class=QuietHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}/devices/bench".format(server.server_port)
+        body = fetch(url, headers) or b""
+        rate, latencies = run(url, headers, clients, requests)
+        server.shutdown()
+        server.server_close()
+        print("{:>12} {:>10.0f} {:>10.3f} {:>10.3f} {:>12}".format(name, rate,
+                latencies[len(latencies) // 2], latencies[len(latencies) * 99 // 100],
+                len(body)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+from ._history import make_engine
+from qversions.device_summary import DeviceSummaries
+from qversions.engine import create_engine
+from qversions.gate import Gate
+from qversions.qubit import Qubit
+from sqlalchemy.pool import QueuePool
+import sys
+
+"""
+Soak test for session handling: makes a long run of mixed calls, including
+failing ones, and prints how many pooled connections are checked out along the
+way. The count should stay at zero between calls.
+
+Run from the root dir with `python3 -m benchmarks.soak_sessions [calls]`
+"""
+
+def main(calls):
+    url = make_engine().url
+    engine = create_engine(str(url), poolclass=QueuePool, pool_size=5,
+            max_overflow=0, pool_timeout=5)
+    q = DeviceSummaries(engine)
+    q.create_device("soak", "Soak test device")
+    q.save_qubit(Qubit("soak", 0, 1.0, 1.0, 1.0))
+
+    operations = [
+        lambda: q.get_device("soak"),
+        lambda: q.get_snapshot("soak", 1),
+        lambda: q.qubits.get_qubit("soak", 0),
+        lambda: q.gates.get_gates_by_device("soak"),
+        lambda: q.devices.get_all_devices(),
+        lambda: q.save_gate(Gate("soak", 0, "+X", 1.0, 1.0, 1.0)),
+    ]
+
+    def failing():
+        try:
+            q.get_device("missing")
+        except RuntimeError:
+            pass
+    operations.append(failing)
+
+    print("{:>10} {:>12} {:>12}".format("calls", "checked out", "pool size"))
+    for call in range(1, calls + 1):
+        operations[call % len(operations)]()
+        if call % max(1, calls // 10) == 0:
+            print("{:>10} {:>12} {:>12}".format(call, engine.pool.checkedout(),
+                    engine.pool.size()))
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,108 @@
+from ._history import best_of
+from qversions.device import Device
+from qversions.device_summary import _make_summary
+from qversions.gate import Gate
+from qversions.qubit import Qubit
+import sys
+import time
+import tracemalloc
+
+"""
+Compare the named tuple value objects against the previous classes which kept
+their fields in a __dict__ and hashed a frozenset of it on every call. For 1000
+qubits with 20 gates each, prints the size of a gate without its field values,
+the memory allocated per object including the values, the creation time, and
+the time for _make_summary, which puts every gate of a device in a set, for
+gates that were just created and for gates that were summarized before.
+
+Run from the root dir with `python3 -m benchmarks.value_objects`
+"""
+
+QUBITS = 1000
+GATES_PER_QUBIT = 20
+
+class DictQubit(object):
+    def __init__(self, device_id, qubit_id, resonance_frequency, t1, t2):
+        self.device_id = device_id
+        self.qubit_id = qubit_id
+        self.resonance_frequency = resonance_frequency
+        self.t1 = t1
+        self.t2 = t2
+
+    def __eq__(self, other):
+        return self.__dict__ == other.__dict__
+
+    def __hash__(self):
+        return hash(frozenset(self.__dict__.items()))
+
+class DictGate(object):
+    def __init__(self, device_id, qubit_id, gate_id, amplitude, width, phase):
+        self.device_id = device_id
+        self.qubit_id = qubit_id
+        self.gate_id = gate_id
+        self.amplitude = amplitude
+        self.width = width
+        self.phase = phase
+
+    def __eq__(self, other):
+        return self.__dict__ == other.__dict__
+
+    def __hash__(self):
+        return hash(frozenset(self.__dict__.items()))
+
+def make(qubit_class, gate_class):
+    qubits = [qubit_class("bench", i, float(i), float(i), float(i)) for i in range(QUBITS)]
+    gates = [gate_class("bench", i, "G{}".format(j), float(j), float(j), float(j))
+            for i in range(QUBITS) for j in range(GATES_PER_QUBIT)]
+    return qubits, gates
+
+def object_bytes(obj):
+    """
+    Size of the object and of its attribute dict if it has one, without the
+    field values which are the same either way.
+    """
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def bytes_per_object(qubit_class, gate_class):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    qubits, gates = make(qubit_class, gate_class)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    # Count what make() allocated, including the field values themselves
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return size / (len(qubits) + len(gates))
+
+def make_summary_ms(qubits, gates, fresh):
+    """
+    Best time of _make_summary, with gates that were never hashed before if
+    fresh.
+    """
+    best = None
+    for _ in range(5):
+        if fresh:
+            gates = [type(gate)(gate.device_id, gate.qubit_id, gate.gate_id,
+                    gate.amplitude, gate.width, gate.phase) for gate in gates]
+        start = time.perf_counter()
+        _make_summary(Device("bench", "Benchmark device"), qubits, gates)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    print("{:>8} {:>12} {:>14} {:>12} {:>18} {:>18}".format("objects", "gate bytes",
+            "total bytes", "create ms", "_make_summary ms", "repeat summary ms"))
+    for name, qubit_class, gate_class in [("dict", DictQubit, DictGate),
+            ("tuple", Qubit, Gate)]:
+        qubits, gates = make(qubit_class, gate_class)
+        print("{:>8} {:>12} {:>14.0f} {:>12.3f} {:>18.3f} {:>18.3f}".format(name,
+                object_bytes(gates[0]), bytes_per_object(qubit_class, gate_class),
+                best_of(lambda: make(qubit_class, gate_class), number=1),
+                make_summary_ms(qubits, gates, fresh=True),
+                make_summary_ms(qubits, gates, fresh=False)))
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,14 @@
-from qversions._db import Base
 from qversions.device_summary import DeviceSummaries
+from qversions.engine import create_engine
+from qversions.schema import create_tables
 from qversions.qubit import Qubit
 from qversions.gate import Gate
-from sqlalchemy import create_engine
 
 _engine = create_engine("sqlite:///:memory:")
-# _engine = create_engine("postgres://postgres@localhost:5432/qversions")
+# _engine = create_engine("postgresql://postgres@localhost:5432/qversions")
 # _engine = create_engine("mysql+mysqldb://root@localhost/qversions")
-Base.metadata.create_all(_engine)
+create_tables(_engine)
+# create_tables(_engine, partitions=16) to partition postgres tables by device
 
 q = DeviceSummaries(_engine)
 
@@ -0,0 +1,115 @@
+from ._db import HorizonModel
+from sqlalchemy import and_, bindparam, case, select, union_all
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import func
+
+"""
+Compaction of replaced versions into archive tables.
+"""
+
+def versions(session, model, archive_model, timestamp):
+    """
+    Return the entity to read versions of a table from, for reads of the state
+    before timestamp or of history from timestamp on. That is the table
+    itself, unless timestamp is before the table's horizon in which case the
+    archive is read as well.
+
+    :param Session session: Session to use
+    :param model: Model of the table
+    :param archive_model: Model of its archive table
+    :param long timestamp: Time of the read, or None for the latest state
+    :return: model or an alias of model over the table and its archive
+    """
+    if timestamp is None:
+        return model
+    horizon = get_horizon(session, model.__tablename__)
+    if horizon is None or timestamp >= horizon:
+        return model
+
+    table = model.__table__
+    archive = archive_model.__table__
+    both = union_all(select([table]),
+            select([archive.c[column.name] for column in table.columns]))
+    return aliased(model, both.subquery(model.__tablename__ + "_versions"))
+
+def get_horizon(session, table_name):
+    """
+    Return the horizon of a table, or None if it was never compacted.
+
+    :param Session session: Session to use
+    :param string table_name: Name of the table
+    :rtype: int
+    """
+    table = HorizonModel.__table__
+    return session.execute(select([table.c.horizon])\
+            .where(table.c.table_name == table_name)).scalar()
+
+def raise_horizon(session, table_name, horizon):
+    """
+    Move the horizon of a table forward to horizon within a write transaction.
+    Must be committed before any version is compacted, so that readers never
+    miss the archive. A horizon never moves back.
+
+    :param Session session: Session of the write transaction
+    :param string table_name: Name of the table
+    :param long horizon: New horizon
+    """
+    table = HorizonModel.__table__
+    result = session.execute(table.update()\
+            .where(table.c.table_name == table_name)\
+            .values(horizon=case([(table.c.horizon < horizon, horizon)],
+                    else_=table.c.horizon)))
+    if result.rowcount == 0:
+        # A concurrent compaction inserting the same row makes the commit fail
+        # and it is retried
+        session.execute(table.insert().values(table_name=table_name, horizon=horizon))
+
+def compacted_devices(session, model, horizon):
+    """
+    Return the ids of devices with versions saved before horizon.
+
+    :param Session session: Session to use
+    :param model: Model of the table
+    :param long horizon: Horizon of the compaction
+    :rtype: list
+    """
+    table = model.__table__
+    return [row[0] for row in session.execute(select([table.c.device_id])\
+            .where(table.c.timestamp < horizon).distinct())]
+
+def archive_versions(session, model, archive_model, keys, device_id, horizon, limit):
+    """
+    Move up to limit versions of a device that were replaced before horizon
+    into the archive within a write transaction. The latest version of each
+    entity from before horizon stays, since it is still current at horizon.
+
+    :param Session session: Session of the write transaction
+    :param model: Model of the table
+    :param archive_model: Model of its archive table
+    :param list keys: Names of the columns identifying an entity, without
+            timestamp
+    :param string device_id: Device id
+    :param long horizon: Horizon of the compaction
+    :param int limit: Maximum number of versions to move
+    :return: Number of versions moved
+    :rtype: int
+    """
+    table = model.__table__
+    newer = table.alias()
+    kept = select([func.max(newer.c.timestamp)])\
+            .where(and_(newer.c.timestamp < horizon,
+                    *[newer.c[key] == table.c[key] for key in keys]))\
+            .scalar_subquery()
+    rows = session.execute(select([table])\
+            .where(and_(table.c.device_id == device_id, table.c.timestamp < kept))\
+            .order_by(*[table.c[key] for key in keys + ["timestamp"]])\
+            .limit(limit)).fetchall()
+    if not rows:
+        return 0
+
+    session.execute(archive_model.__table__.insert(), [dict(row._mapping) for row in rows])
+    session.execute(table.delete().where(and_(*[table.c[key] == bindparam("key_" + key)
+            for key in keys + ["timestamp"]])),
+            [dict(("key_" + key, row._mapping[key]) for key in keys + ["timestamp"])
+            for row in rows])
+    return len(rows)
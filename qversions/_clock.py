@@ -0,0 +1,72 @@
+from ._db import DeviceVersionModel
+from sqlalchemy import case, select
+from sqlalchemy.exc import IntegrityError
+import time
+
+"""
+Allocation of version timestamps.
+"""
+
+ATTEMPTS = 5
+"""Number of times a write is attempted when it conflicts with another writer"""
+
+def current_timestamp():
+    """
+    Return microseconds since epoch.
+    """
+    return int(time.time() * 1000000)
+
+def next_timestamp(session, device_id):
+    """
+    Allocate the timestamp of a new version for a device within a write
+    transaction. It is the current time in microseconds unless the device
+    already has a version at or after that, in which case it is one more than
+    the last version. The device's row stays locked until the transaction ends,
+    so timestamps are strictly increasing per device across threads, processes
+    and clocks that jump backwards.
+
+    :param Session session: Session of the write transaction
+    :param string device_id: Device id
+    :return: Timestamp for the new version
+    :rtype: int
+    """
+    now = current_timestamp()
+    table = DeviceVersionModel.__table__
+    result = session.execute(table.update()\
+            .where(table.c.device_id == device_id)\
+            .values(version=case([(table.c.version >= now, table.c.version + 1)],
+                    else_=now)))
+    if result.rowcount == 0:
+        # First version of the device, a concurrent writer inserting the same
+        # row makes the commit fail and the write is retried
+        session.execute(table.insert().values(device_id=device_id, version=now))
+        return now
+    return last_timestamp(session, device_id)
+
+def last_timestamp(session, device_id):
+    """
+    Return the timestamp of the last version allocated for a device, or None if
+    it has none.
+
+    :param Session session: Session to use
+    :param string device_id: Device id
+    :rtype: int
+    """
+    table = DeviceVersionModel.__table__
+    return session.execute(select([table.c.version])\
+            .where(table.c.device_id == device_id)).scalar()
+
+def retry_conflicts(f):
+    """
+    Call f, calling it again if it fails because another writer got there
+    first.
+
+    :param function f: Function that runs a whole write transaction
+    :return: Result of f
+    """
+    for attempt in range(ATTEMPTS):
+        try:
+            return f()
+        except IntegrityError:
+            if attempt == ATTEMPTS - 1:
+                raise
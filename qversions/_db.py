@@ -1,6 +1,10 @@
+from contextlib import contextmanager
+from itertools import cycle
+from threading import Lock
 from sqlalchemy import BigInteger, Boolean, Column, Float, Integer, String
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+import time
 
 Base = declarative_base()
 
@@ -33,3 +37,193 @@ class GateModel(Base):
     width = Column(Float, nullable=False)
     phase = Column(Float, nullable=False)
     archived = Column(Boolean, default=False, index=True)
+
+class QubitArchiveModel(Base):
+    """
+    Versions of qubits compacted out of the qubits table, see Qubits.compact.
+    """
+    __tablename__ = 'qubit_archive'
+
+    device_id = Column(String(255), primary_key=True)
+    qubit_id = Column(Integer, primary_key=True)
+    timestamp = Column(BigInteger, primary_key=True)
+    resonance_frequency = Column(Float, nullable=False)
+    t1 = Column(Float, nullable=False)
+    t2 = Column(Float, nullable=False)
+    archived = Column(Boolean, default=False)
+
+class GateArchiveModel(Base):
+    """
+    Versions of gates compacted out of the gates table, see Gates.compact.
+    """
+    __tablename__ = 'gate_archive'
+
+    device_id = Column(String(255), primary_key=True)
+    qubit_id = Column(Integer, primary_key=True)
+    gate_id = Column(String(255), primary_key=True)
+    timestamp = Column(BigInteger, primary_key=True)
+    amplitude = Column(Float, nullable=False)
+    width = Column(Float, nullable=False)
+    phase = Column(Float, nullable=False)
+    archived = Column(Boolean, default=False)
+
+class QubitHeadModel(Base):
+    """
+    Optional pointer to the latest version of each qubit.
+    """
+    __tablename__ = 'qubit_heads'
+
+    device_id = Column(String(255), primary_key=True)
+    qubit_id = Column(Integer, primary_key=True)
+    timestamp = Column(BigInteger, nullable=False)
+
+class GateHeadModel(Base):
+    """
+    Optional pointer to the latest version of each gate.
+    """
+    __tablename__ = 'gate_heads'
+
+    device_id = Column(String(255), primary_key=True)
+    qubit_id = Column(Integer, primary_key=True)
+    gate_id = Column(String(255), primary_key=True)
+    timestamp = Column(BigInteger, nullable=False)
+
+class DeviceVersionModel(Base):
+    """
+    Last version timestamp allocated for each device.
+    """
+    __tablename__ = 'device_versions'
+
+    device_id = Column(String(255), primary_key=True)
+    version = Column(BigInteger, nullable=False)
+
+class HorizonModel(Base):
+    """
+    Time before which replaced versions may have been compacted out of a
+    table into its archive.
+    """
+    __tablename__ = 'history_horizons'
+
+    table_name = Column(String(255), primary_key=True)
+    horizon = Column(BigInteger, nullable=False)
+
+class Sessions(object):
+    """
+    Session factory shared by the objects working on one database. Sessions
+    are always closed at the end of their scope so that their connection is
+    returned to the pool.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        """Engine that sessions are bound to"""
+        # Objects are converted to the public API once loaded, keep their
+        # attributes readable after commit instead of reloading them
+        self.sessionmaker = sessionmaker(bind=engine, expire_on_commit=False)
+
+    @contextmanager
+    def read(self):
+        """
+        Scope of a session that only reads.
+        """
+        session = self.sessionmaker()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    @contextmanager
+    def write(self):
+        """
+        Scope of a session that is committed if no exception is raised and
+        rolled back otherwise.
+        """
+        session = self.sessionmaker()
+        try:
+            yield session
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+def sessions_for(engine):
+    """
+    Return Sessions for an engine, or the argument if it already is one.
+    """
+    if isinstance(engine, Sessions):
+        return engine
+    return Sessions(engine)
+
+class RoutedSessions(Sessions):
+    """
+    Sessions that write to a primary database and spread reads over replicas
+    of it in turn. Replicas lag behind the primary, so for a while after a
+    write made through this object reads go to the primary as well, letting
+    callers read their own writes.
+    """
+    def __init__(self, engine, read_engines, stickiness=1.0, timer=time.monotonic):
+        """
+        :param Engine engine: Primary database, used for writes
+        :param list read_engines: Replicas of the primary, used for reads
+        :param float stickiness: Seconds after a write during which reads still
+                go to the primary. Should cover the replication lag.
+        :param function timer: Clock used for the stickiness
+        """
+        super(RoutedSessions, self).__init__(engine)
+        if not read_engines:
+            raise ValueError("read_engines must not be empty")
+        self.read_engines = list(read_engines)
+        """Engines that reads are spread over"""
+        self.stickiness = stickiness
+        """Seconds after a write during which reads go to the primary"""
+        self._readers = cycle([sessionmaker(bind=read_engine, expire_on_commit=False)
+                for read_engine in self.read_engines])
+        self._timer = timer
+        self._last_write = None
+        self._lock = Lock()
+
+    @contextmanager
+    def read(self):
+        with self._lock:
+            if self._last_write is not None \
+                    and self._timer() - self._last_write < self.stickiness:
+                reader = self.sessionmaker
+            else:
+                reader = next(self._readers)
+        session = reader()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    @contextmanager
+    def write(self):
+        with super(RoutedSessions, self).write() as session:
+            yield session
+        with self._lock:
+            self._last_write = self._timer()
+
+class BoundSessions(Sessions):
+    """
+    Sessions that all reuse one session owned by the caller, who is responsible
+    for committing and closing it. Writes are flushed so that errors such as
+    integrity violations are raised inside the write scope.
+    """
+    def __init__(self, session):
+        self.engine = session.bind
+        self.session = session
+        """Session handed out to every scope"""
+
+    @contextmanager
+    def read(self):
+        yield self.session
+
+    @contextmanager
+    def write(self):
+        try:
+            yield self.session
+            self.session.flush()
+        except:
+            self.session.rollback()
+            raise
@@ -0,0 +1,122 @@
+from sqlalchemy import and_, inspect, select, true
+from sqlalchemy.sql import func
+
+"""
+Queries for the latest version of every qubit or gate as of a point in time.
+"""
+
+STRATEGIES = ["group_by", "window", "distinct_on", "lateral"]
+"""
+Ways to find the latest versions:
+
+- group_by: MAX(timestamp) grouped by entity, works everywhere
+- window: ROW_NUMBER() over the versions of each entity, needs window functions
+- distinct_on: DISTINCT ON the entity ordered by timestamp, Postgres only
+- lateral: LATERAL lookup of the newest version of each entity ordered by
+  timestamp with LIMIT 1, Postgres or MySQL
+"""
+
+_DIALECTS = dict(distinct_on=["postgresql"], lateral=["postgresql", "mysql"])
+
+def default_strategy(dialect):
+    """
+    Return the strategy used when none is chosen, for a database dialect.
+
+    :param Dialect dialect: Dialect of the database
+    :rtype: string
+    """
+    if dialect.name == "postgresql":
+        return "distinct_on"
+    # sqlite answers MAX per group straight from the primary key index, which
+    # beats its window functions, see benchmarks.latest_query
+    return "group_by"
+
+def supported_strategies(dialect):
+    """
+    Return the strategies a database dialect can run.
+
+    :param Dialect dialect: Dialect of the database
+    :rtype: list
+    """
+    return [strategy for strategy in STRATEGIES
+            if dialect.name in _DIALECTS.get(strategy, [dialect.name])]
+
+def check_strategy(strategy, dialect=None):
+    """
+    Raise an exception if strategy is not one of STRATEGIES or None, or if
+    dialect is given and cannot run it.
+
+    :param string strategy: Strategy to check
+    :param Dialect dialect: Dialect of the database, if known
+    """
+    if strategy is not None and strategy not in STRATEGIES:
+        raise ValueError("latest_query must be one of {}, got {}".format(
+                ", ".join(STRATEGIES), strategy))
+    if strategy is not None and dialect is not None \
+            and strategy not in supported_strategies(dialect):
+        raise ValueError("latest_query {} is not supported on {}".format(strategy,
+                dialect.name))
+
+def latest_versions(session, versions, keys, f, timestamp, strategy):
+    """
+    Subquery of the latest timestamp for each entity, exposed as the key
+    columns and latest_timestamp. If timestamp is given only versions from
+    before that time are considered.
+
+    :param Session session: Session to use
+    :param versions: Entity holding the versions, a model or an alias of one
+    :param list keys: Names of the columns identifying an entity, without
+            timestamp
+    :param function f: Adds filter operations to the query
+    :param long timestamp: Time of the read, or None for the latest state
+    :param string strategy: One of STRATEGIES, or None for default_strategy
+    :return: Subquery
+    """
+    dialect = session.get_bind().dialect
+    if strategy is None:
+        strategy = default_strategy(dialect)
+    check_strategy(strategy, dialect)
+    columns = [getattr(versions, key) for key in keys]
+
+    if strategy == "group_by":
+        query_builder = session.query(*columns,
+                func.max(versions.timestamp).label("latest_timestamp"))\
+                        .group_by(*columns)
+        if timestamp:
+            query_builder = query_builder.filter(versions.timestamp < timestamp)
+        return f(query_builder).subquery()
+
+    if strategy == "distinct_on":
+        query_builder = session.query(*columns,
+                versions.timestamp.label("latest_timestamp"))\
+                        .distinct(*columns)\
+                        .order_by(*columns + [versions.timestamp.desc()])
+        if timestamp:
+            query_builder = query_builder.filter(versions.timestamp < timestamp)
+        return f(query_builder).subquery()
+
+    if strategy == "window":
+        rank = func.row_number().over(partition_by=columns,
+                order_by=versions.timestamp.desc())
+        query_builder = session.query(*columns,
+                versions.timestamp.label("latest_timestamp"), rank.label("version_rank"))
+        if timestamp:
+            query_builder = query_builder.filter(versions.timestamp < timestamp)
+        ranked = f(query_builder).subquery()
+        return session.query(*[ranked.c[key] for key in keys] +
+                [ranked.c.latest_timestamp]).filter(ranked.c.version_rank == 1).subquery()
+
+    # lateral: every entity, then a lookup of its newest version by primary key.
+    # The filters of f may refer to versions, so the entities come from it too.
+    entities = f(session.query(*columns).distinct()).subquery()
+    table = inspect(versions).selectable.alias()
+    newest = select([table.c.timestamp])\
+            .where(and_(*[table.c[key] == entities.c[key] for key in keys]))\
+            .order_by(table.c.timestamp.desc())\
+            .limit(1)
+    if timestamp:
+        newest = newest.where(table.c.timestamp < timestamp)
+    newest = newest.lateral()
+    return session.query(*[entities.c[key] for key in keys] +
+            [newest.c.timestamp.label("latest_timestamp")])\
+                    .select_from(entities).join(newest, true()).subquery()
@@ -1,9 +1,43 @@
+from collections import namedtuple
+
+def value_type(name, fields):
+    """
+    Base class for an immutable value object with the given fields, built on a
+    named tuple so that objects are as small and as fast to create as a tuple.
+    Objects are equal when they are of the same class with equal fields.
+    Hashing is the tuple's own, done in C without building anything.
+
+    :param string name: Class name
+    :param list fields: Field names, in constructor order
+    """
+    base = namedtuple(name, fields)
+
+    class Value(base):
+        __slots__ = ()
+
+        def __eq__(self, other):
+            return type(other) is type(self) and tuple.__eq__(self, other)
+
+        def __ne__(self, other):
+            return not self == other
+
+        __hash__ = tuple.__hash__
+
+        def replace(self, **changes):
+            """
+            Return a copy with some fields changed.
+
+            :param changes: New value for each field to change
+            """
+            return self._replace(**changes)
+
+    return Value
 
 def validate_field(obj, name, typ):
     """
     Ensure an object field is the correct type and defined.
     """
-    value = obj.__dict__.get(name)
+    value = getattr(obj, name, None)
 
     validate_param(name, value, typ)
 
@@ -16,3 +50,34 @@ def validate_param(name, value, typ):
 
     if not isinstance(value, typ):
         raise TypeError("{} must be a {}".format(name, typ))
+
+def to_columns(rows, dtypes, structured=False):
+    """
+    Convert result rows into a map from column name to NumPy array, or into a
+    single NumPy structured array. String columns are sized to their longest
+    value. Requires numpy.
+
+    :param list rows: Tuples with one value per column
+    :param list dtypes: (name, dtype) for every column, in row order
+    :param bool structured: Return a structured array instead of a map
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("numpy is required to export columns")
+
+    values = list(zip(*rows)) if rows else [()] * len(dtypes)
+    columns = {}
+    fields = []
+    for (name, dtype), column in zip(dtypes, values):
+        if dtype is str:
+            dtype = "U{}".format(max([len(value) for value in column] + [1]))
+        columns[name] = numpy.array(column, dtype=dtype)
+        fields.append((name, dtype))
+
+    if not structured:
+        return columns
+    array = numpy.empty(len(rows), dtype=fields)
+    for name, _ in fields:
+        array[name] = columns[name]
+    return array
@@ -0,0 +1,104 @@
+from ._db import BoundSessions
+from ._latest import check_strategy
+from .device_summary import DeviceSummaries
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+"""
+Asyncio version of the high level module, for use with SQLAlchemy's async
+engines such as 'sqlite+aiosqlite://' or 'postgresql+asyncpg://'.
+"""
+
+class AsyncDeviceSummaries(object):
+    def __init__(self, engine, head_tables=False, latest_query=None):
+        """
+        :param AsyncEngine engine: Database to use, from
+                sqlalchemy.ext.asyncio.create_async_engine
+        :param bool head_tables: See DeviceSummaries
+        :param string latest_query: See DeviceSummaries
+        """
+        check_strategy(latest_query, engine.dialect)
+        self.head_tables = head_tables
+        self.latest_query = latest_query
+        self.sessionmaker = sessionmaker(bind=engine, class_=AsyncSession,
+                expire_on_commit=False)
+
+    async def create_device(self, device_id, description=None):
+        """
+        Create a new device. Device id must be unique even amongst devices that
+        were previously deleted.
+
+        :param string device_id: Unique device id such as '7-qubit-prototype'
+        :param string description: Optional short description of the device
+        """
+        return await self._run(lambda q: q.create_device(device_id, description),
+                write=True)
+
+    async def get_device(self, device_id):
+        """
+        Get device summary for this device_id or None if it doesn't exist.
+
+        :param string device_id: Device id
+        :return: Device summary if the device exists
+        :rtype: DeviceSummary
+        """
+        return await self._run(lambda q: q.get_device(device_id))
+
+    async def get_snapshot(self, device_id, timestamp):
+        """
+        Get the state of a device at a particular point in time.
+
+        :param string device_id: Device id
+        :param long timestamp: Point in time to retrieve
+        :return: Device summary if the device exists
+        :rtype: DeviceSummary
+        """
+        return await self._run(lambda q: q.get_snapshot(device_id, timestamp))
+
+    async def save_qubit(self, qubit):
+        """
+        Save new qubit measurements to the system.
+
+        :param Qubit qubit: Qubit to save
+        :return: timestamp of the system before saving qubit
+        :rtype: int
+        """
+        return await self._run(lambda q: q.save_qubit(qubit), write=True)
+
+    async def save_gate(self, gate):
+        """
+        Save new gate measurements to the system.
+
+        :param Gate gate: Gate to save
+        :return: timestamp of the system before saving gate
+        :rtype: int
+        """
+        return await self._run(lambda q: q.save_gate(gate), write=True)
+
+    async def save_calibration(self, device_id, qubits=(), gates=()):
+        """
+        Save new measurements for many qubits and gates of a device at once. See
+        DeviceSummaries.save_calibration.
+
+        :param string device_id: Device id
+        :param list qubits: Qubits to save
+        :param list gates: Gates to save
+        :return: timestamp of the system before saving the calibration
+        :rtype: int
+        """
+        return await self._run(lambda q: q.save_calibration(device_id, qubits, gates),
+                write=True)
+
+    async def _run(self, f, write=False):
+        """
+        Run f with a DeviceSummaries bound to a single async session. The
+        synchronous query code runs unchanged inside AsyncSession.run_sync,
+        which hands the database calls back to the event loop.
+        """
+        async with self.sessionmaker() as session:
+            result = await session.run_sync(lambda sync_session: f(DeviceSummaries(
+                    BoundSessions(sync_session), head_tables=self.head_tables,
+                    latest_query=self.latest_query)))
+            if write:
+                await session.commit()
+            return result
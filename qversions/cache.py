@@ -0,0 +1,291 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from threading import Lock
+import pickle
+import sqlite3
+import time
+
+"""
+Module for caching device summaries.
+"""
+
+class SummaryCache(object):
+    def __init__(self, maxsize=128, ttl=None, timer=time.monotonic):
+        """
+        :param int maxsize: Maximum number of summaries to keep, the least
+                recently used one is evicted first
+        :param float ttl: If specified, seconds after which a summary is
+                reloaded. Bounds how stale a summary can be when the database
+                is written by other processes.
+        :param function timer: Clock used for the ttl
+        """
+        self.maxsize = maxsize
+        """Maximum number of summaries to keep"""
+        self.ttl = ttl
+        """Seconds after which a summary expires, or None to never expire"""
+        self.hits = 0
+        """Number of lookups answered from the cache"""
+        self.misses = 0
+        """Number of lookups that had to load from the database"""
+        self.evictions = 0
+        """Number of summaries dropped to make room for new ones"""
+        self.expirations = 0
+        """Number of summaries dropped because they outlived the ttl"""
+        self._timer = timer
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._epoch = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        Return the cache counters, useful for sizing the cache.
+
+        :return: Map with hits, misses, evictions, expirations and size
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, expirations=self.expirations,
+                    size=len(self._entries))
+
+    def get_or_load(self, device_id, timestamp, load):
+        """
+        Return the cached summary for a device, loading and caching it on a
+        miss.
+
+        :param string device_id: Device id
+        :param long timestamp: Snapshot time or None for the latest summary
+        :param function load: Function returning the summary on a miss
+        :return: Device summary
+        :rtype: DeviceSummary
+        """
+        key = device_id if timestamp is None else (device_id, timestamp)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None \
+                    and self._timer() - entry[0] >= self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation(device_id)
+
+        summary = load()
+
+        with self._lock:
+            # Don't cache a summary that was loaded while a write to the same
+            # device was being committed
+            if self._generation(device_id) == generation:
+                self._entries[key] = (self._timer(), summary)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return summary
+
+    def invalidate(self, device_id, timestamp=None):
+        """
+        Drop summaries that a write to a device may have changed.
+
+        :param string device_id: Device id
+        :param long timestamp: Version that was written. Snapshots from before
+                it are kept since history never changes. If None, every summary
+                of the device is dropped.
+        """
+        with self._lock:
+            self._generations[device_id] = self._generations.get(device_id, 0) + 1
+            for key in list(self._entries):
+                if key == device_id:
+                    del self._entries[key]
+                elif isinstance(key, tuple) and key[0] == device_id \
+                        and (timestamp is None or key[1] > timestamp):
+                    del self._entries[key]
+
+    def clear(self):
+        """
+        Drop every cached summary. Counters are kept.
+        """
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+    def _generation(self, device_id):
+        """
+        Changes whenever summaries of this device are invalidated.
+        """
+        return (self._epoch, self._generations.get(device_id, 0))
+
+class SnapshotStore(ABC):
+    def __init__(self, settle=60.0):
+        """
+        Cache for snapshots of past points in time. History is append-only so
+        these never change and are never expired. Subclasses decide where
+        snapshots are kept by implementing _get, _put and _delete, which are
+        called with the lock held.
+
+        :param float settle: Only snapshots at least this many seconds in the
+                past are stored, leaving time for writes that were already in
+                flight to commit
+        """
+        self.settle = settle
+        """Seconds a timestamp must be in the past before it is stored"""
+        self.hits = 0
+        """Number of snapshots answered from the store"""
+        self.misses = 0
+        """Number of snapshots that had to load from the database"""
+        self._lock = Lock()
+
+    def stats(self):
+        """
+        Return the store counters.
+
+        :return: Map with hits and misses
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses)
+
+    def is_settled(self, timestamp, now):
+        """
+        Whether a snapshot at timestamp can no longer change.
+
+        :param long timestamp: Snapshot time in microseconds since epoch
+        :param long now: Current time in microseconds since epoch
+        :rtype: bool
+        """
+        return timestamp <= now - int(self.settle * 1000000)
+
+    def get_or_load(self, device_id, timestamp, load):
+        """
+        Return the stored snapshot, loading and storing it on a miss.
+
+        :param string device_id: Device id
+        :param long timestamp: Snapshot time
+        :param function load: Function returning the summary on a miss
+        :return: Device summary
+        :rtype: DeviceSummary
+        """
+        with self._lock:
+            summary = self._get(device_id, timestamp)
+            if summary is not None:
+                self.hits += 1
+                return summary
+            self.misses += 1
+
+        summary = load()
+
+        with self._lock:
+            self._put(device_id, timestamp, summary)
+        return summary
+
+    def invalidate(self, device_id, timestamp=None):
+        """
+        Drop snapshots that a write to a device may have changed. Writes always
+        happen after the stored snapshots so this only matters for changes to
+        the device itself, such as its description, which are not versioned.
+
+        :param string device_id: Device id
+        :param long timestamp: Version that was written, or None to drop every
+                snapshot of the device
+        """
+        with self._lock:
+            self._delete(device_id, timestamp)
+
+    @abstractmethod
+    def _get(self, device_id, timestamp):
+        """
+        Return the stored snapshot or None.
+        """
+
+    @abstractmethod
+    def _put(self, device_id, timestamp, summary):
+        """
+        Store a snapshot.
+        """
+
+    @abstractmethod
+    def _delete(self, device_id, timestamp):
+        """
+        Drop the snapshots of a device after timestamp, or all if it is None.
+        """
+
+class MemorySnapshotStore(SnapshotStore):
+    """
+    Snapshot store that keeps every snapshot in process memory.
+    """
+    def __init__(self, settle=60.0):
+        super(MemorySnapshotStore, self).__init__(settle)
+        self._snapshots = {}
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def _get(self, device_id, timestamp):
+        return self._snapshots.get((device_id, timestamp))
+
+    def _put(self, device_id, timestamp, summary):
+        self._snapshots[(device_id, timestamp)] = summary
+
+    def _delete(self, device_id, timestamp):
+        for key in list(self._snapshots):
+            if key[0] == device_id and (timestamp is None or key[1] > timestamp):
+                del self._snapshots[key]
+
+class SqliteSnapshotStore(SnapshotStore):
+    """
+    Snapshot store that pickles snapshots into a local sqlite file so they
+    survive restarts and can be shared by processes on the same machine. The
+    device description is stored with each snapshot, changes to it made by
+    other processes are not seen.
+    """
+    def __init__(self, path, settle=60.0):
+        """
+        :param string path: sqlite file to use, created if it doesn't exist
+        :param float settle: See SnapshotStore
+        """
+        super(SqliteSnapshotStore, self).__init__(settle)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS snapshots ("
+                    "device_id TEXT NOT NULL, timestamp INTEGER NOT NULL, "
+                    "summary BLOB NOT NULL, PRIMARY KEY (device_id, timestamp))")
+
+    def __len__(self):
+        # The connection is shared by every thread using the store
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM snapshots")\
+                    .fetchone()[0]
+
+    def close(self):
+        """
+        Close the underlying sqlite connection.
+        """
+        with self._lock:
+            self._connection.close()
+
+    def _get(self, device_id, timestamp):
+        row = self._connection.execute("SELECT summary FROM snapshots "
+                "WHERE device_id = ? AND timestamp = ?", (device_id, timestamp)).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def _put(self, device_id, timestamp, summary):
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)",
+                    (device_id, timestamp, pickle.dumps(summary, pickle.HIGHEST_PROTOCOL)))
+
+    def _delete(self, device_id, timestamp):
+        with self._connection:
+            if timestamp is None:
+                self._connection.execute("DELETE FROM snapshots WHERE device_id = ?",
+                        (device_id,))
+            else:
+                self._connection.execute("DELETE FROM snapshots "
+                        "WHERE device_id = ? AND timestamp > ?", (device_id, timestamp))
@@ -0,0 +1,280 @@
+from ._utils import value_type
+from abc import ABC, abstractmethod
+from queue import Queue, Empty
+from threading import Event, Lock, Thread
+import asyncio
+import json
+import select
+
+"""
+Module for notifying consumers of changes to devices, qubits and gates.
+"""
+
+class ChangeEvent(value_type("ChangeEvent", ["device_id", "kind", "timestamp"])):
+    """
+    Immutable notification of a change to a device, its qubits or its gates.
+
+    :ivar string device_id: Device that changed
+    :ivar string kind: What changed: 'device', 'qubit' or 'gate'
+    :ivar long timestamp: Timestamp of the version that was written, None for
+            changes to the device itself which are not versioned
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<ChangeEvent(device_id={}, kind={}, timestamp={})>"\
+                .format(self.device_id, self.kind, self.timestamp)
+
+class Subscription(object):
+    """
+    Stream of change events, from ChangeFeed.subscribe. Iterate over it, with
+    for or async for, to wait for the next event. Iteration ends once it is
+    closed. Events are queued until read. Async iteration waits on the event
+    loop without holding an executor thread.
+    """
+    def __init__(self, feed, device_id):
+        self.device_id = device_id
+        """Device whose events are received, or None for every device"""
+        self._feed = feed
+        self._queue = Queue()
+        self._closed = False
+        self._waiters = []
+        self._lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        event = self.get()
+        if event is None:
+            raise StopIteration()
+        return event
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            try:
+                event = self._queue.get_nowait()
+                break
+            except Empty:
+                pass
+            waiter = asyncio.get_running_loop().create_future()
+            with self._lock:
+                # An event queued after the check above wakes the waiter
+                if not self._queue.empty():
+                    continue
+                self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                with self._lock:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+        if event is None:
+            # Wake up the next reader as well
+            self._queue.put(None)
+            self._wake()
+            raise StopAsyncIteration()
+        return event
+
+    def get(self, timeout=None):
+        """
+        Wait for the next event.
+
+        :param float timeout: If specified, seconds to wait at most
+        :return: The event, or None if the subscription is closed or the
+                timeout expired
+        :rtype: ChangeEvent
+        """
+        if self._closed and self._queue.empty():
+            return None
+        try:
+            event = self._queue.get(timeout=timeout)
+        except Empty:
+            return None
+        if event is None:
+            # Wake up the next reader as well
+            self._queue.put(None)
+        return event
+
+    def close(self):
+        """
+        Stop receiving events and wake up any reader.
+        """
+        if not self._closed:
+            self._closed = True
+            self._feed._unsubscribe(self)
+            self._queue.put(None)
+            self._wake()
+
+    def _put(self, event):
+        if not self._closed:
+            self._queue.put(event)
+            self._wake()
+
+    def _wake(self):
+        """
+        Wake every async reader waiting for an event, from any thread.
+        """
+        with self._lock:
+            waiters = self._waiters
+            self._waiters = []
+        for waiter in waiters:
+            try:
+                waiter.get_loop().call_soon_threadsafe(_resolve, waiter)
+            except RuntimeError:
+                # The reader's event loop is closed
+                pass
+
+class ChangeFeed(ABC):
+    """
+    Transport of change events from writers to subscribers. Subclasses decide
+    how events travel by implementing publish, and hand the events they
+    receive to their subscribers with _deliver.
+    """
+    def __init__(self):
+        self._subscriptions = []
+        self._lock = Lock()
+
+    def subscribe(self, device_id=None):
+        """
+        Start receiving change events.
+
+        :param string device_id: If specified, only receive events of this device
+        :rtype: Subscription
+        """
+        subscription = Subscription(self, device_id)
+        with self._lock:
+            self._subscriptions.append(subscription)
+        return subscription
+
+    @abstractmethod
+    def publish(self, event):
+        """
+        Send an event to every subscriber. Called after the change committed,
+        DeviceSummaries logs exceptions raised here instead of failing the
+        write.
+
+        :param ChangeEvent event: Event to send
+        """
+
+    def close(self):
+        """
+        Close every subscription and release the transport.
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.close()
+
+    def _deliver(self, event):
+        with self._lock:
+            subscriptions = [subscription for subscription in self._subscriptions
+                    if subscription.device_id in (None, event.device_id)]
+        for subscription in subscriptions:
+            subscription._put(event)
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+class LocalChangeFeed(ChangeFeed):
+    """
+    Change feed within one process. Only changes made through the objects
+    publishing to it are seen.
+    """
+    def publish(self, event):
+        self._deliver(event)
+
+class PostgresChangeFeed(ChangeFeed):
+    """
+    Change feed over Postgres LISTEN/NOTIFY, which sees the changes published
+    by every process using the same database and channel. A background thread
+    holds one connection listening for events. Requires psycopg2.
+    """
+    def __init__(self, engine, channel="qversions_changes", poll_interval=1.0,
+            start_timeout=30.0):
+        """
+        :param Engine engine: Postgres database to use
+        :param string channel: Notification channel shared by all processes
+        :param float poll_interval: Seconds between checks for close()
+        :param float start_timeout: Seconds to wait for the listening
+                connection before failing
+        """
+        super(PostgresChangeFeed, self).__init__()
+        self.engine = engine
+        """Engine used to publish and listen"""
+        self.channel = channel
+        """Notification channel"""
+        self.poll_interval = poll_interval
+        """Seconds between checks for close()"""
+        self._stopped = Event()
+        self._listening = Event()
+        self._error = None
+        self._thread = Thread(target=self._listen, daemon=True)
+        self._thread.start()
+        if not self._listening.wait(start_timeout):
+            self._stopped.set()
+            raise RuntimeError("Timed out listening on channel {}".format(channel))
+        if self._error is not None:
+            # Connecting or LISTEN failed, the thread has ended
+            raise self._error
+
+    def publish(self, event):
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql("SELECT pg_notify(%(channel)s, %(payload)s)",
+                    dict(channel=self.channel, payload=_encode(event)))
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        super(PostgresChangeFeed, self).close()
+
+    def _listen(self):
+        try:
+            connection = self.engine.raw_connection()
+        except Exception as e:
+            self._error = e
+            self._listening.set()
+            return
+        try:
+            driver_connection = connection.connection
+            driver_connection.autocommit = True
+            cursor = driver_connection.cursor()
+            cursor.execute('LISTEN "{}"'.format(self.channel))
+            self._listening.set()
+            while not self._stopped.is_set():
+                if select.select([driver_connection], [], [], self.poll_interval)[0]:
+                    driver_connection.poll()
+                    while driver_connection.notifies:
+                        self._deliver(_decode(driver_connection.notifies.pop(0).payload))
+        except Exception as e:
+            self._error = e
+            if self._listening.is_set():
+                # Lost the connection after starting, end every subscription
+                # instead of leaving readers waiting forever
+                super(PostgresChangeFeed, self).close()
+        finally:
+            self._listening.set()
+            # Don't return a connection in autocommit mode to the pool
+            connection.invalidate()
+            connection.close()
+
+def _resolve(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+def _encode(event):
+    return json.dumps([event.device_id, event.kind, event.timestamp])
+
+def _decode(payload):
+    return ChangeEvent(*json.loads(payload))
@@ -1,33 +1,34 @@
-from ._db import DeviceModel
-from ._utils import validate_field, validate_param
-from contextlib import contextmanager
+from ._clock import next_timestamp, retry_conflicts
+from ._db import DeviceModel, sessions_for
+from ._utils import validate_field, validate_param, value_type
+from sqlalchemy import and_, exists
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import sessionmaker
 
 """
 Module for interacting with Quantum devices.
 """
 
-class Device(object):
-    def __init__(self, device_id, description):
-        self.device_id = device_id
-        """Unique device id such as '7-qubit-prototype'"""
-        self.description = description
-        """Short description of the device (optional)"""
+class Device(value_type("Device", ["device_id", "description"])):
+    """
+    Immutable device, use replace to get a copy with different values.
+
+    :ivar string device_id: Unique device id such as '7-qubit-prototype'
+    :ivar string description: Short description of the device (optional)
+    """
+    __slots__ = ()
 
     def __repr__(self):
         return "<Device(device_id={}, description={})>".format(self.device_id,
                 self.description)
 
-    def __eq__(self, other):
-        return self.__dict__ == other.__dict__
-
-    def __hash__(self):
-        return hash(frozenset(self.__dict__.items()))
-
 class Devices(object):
     def __init__(self, engine):
-        self.sessionmaker = sessionmaker(bind=engine)
+        """
+        :param Engine engine: Database to use, or Sessions shared with other
+                objects
+        """
+        self.sessions = sessions_for(engine)
+        self.listeners = []
 
     def create_device(self, device):
         """
@@ -38,10 +39,12 @@ class Devices(object):
         """
         validate_param("device", device, Device)
         try:
-            with self._session() as session:
+            with self.sessions.write() as session:
                 session.add(_validate(device))
+                next_timestamp(session, device.device_id)
         except IntegrityError:
             raise RuntimeError("Device already exists")
+        self._notify(device.device_id, None)
 
     def get_device(self, device_id):
         """
@@ -52,9 +55,10 @@ class Devices(object):
         :rtype: Device
         """
         validate_param("device_id", device_id, str)
-        result = self._query().filter_by(archived=False, device_id=device_id)\
-                .one_or_none()
-        return _wrap(result)
+        with self.sessions.read() as session:
+            result = session.query(DeviceModel)\
+                    .filter_by(archived=False, device_id=device_id).one_or_none()
+            return _wrap(result)
 
     def get_all_devices(self):
         """
@@ -63,8 +67,9 @@ class Devices(object):
         :return: List of devices
         :rtype: list
         """
-        result = self._query().filter_by(archived=False).all()
-        return _wrap(result)
+        with self.sessions.read() as session:
+            result = session.query(DeviceModel).filter_by(archived=False).all()
+            return _wrap(result)
 
     def update_device(self, device):
         """
@@ -75,11 +80,17 @@ class Devices(object):
         """
         validate_param("device", device, Device)
         _validate(device)
-        with self._session() as session:
-            old_device = session.query(DeviceModel).get(device.device_id)
-            if old_device is None:
-                raise RuntimeError("device_id {} does not exist".format(device.device_id))
-            old_device.description = device.description
+
+        def update():
+            with self.sessions.write() as session:
+                old_device = session.query(DeviceModel).get(device.device_id)
+                if old_device is None:
+                    raise RuntimeError("device_id {} does not exist".format(device.device_id))
+                old_device.description = device.description
+                next_timestamp(session, device.device_id)
+
+        retry_conflicts(update)
+        self._notify(device.device_id, None)
 
     def delete_device(self, device_id):
         """
@@ -88,11 +99,17 @@ class Devices(object):
         :param string device_id: Device id
         """
         validate_param("device_id", device_id, str)
-        with self._session() as session:
-            deleted_device = session.query(DeviceModel).get(device_id)
-            if deleted_device is None:
-                raise RuntimeError("device_id {} does not exist".format(device_id))
-            deleted_device.archived = True
+
+        def delete():
+            with self.sessions.write() as session:
+                deleted_device = session.query(DeviceModel).get(device_id)
+                if deleted_device is None:
+                    raise RuntimeError("device_id {} does not exist".format(device_id))
+                deleted_device.archived = True
+                next_timestamp(session, device_id)
+
+        retry_conflicts(delete)
+        self._notify(device_id, None)
 
     def get_archived_devices(self):
         """
@@ -101,8 +118,9 @@ class Devices(object):
         :return: List of deleted devices
         :rtype: list
         """
-        result = self._query().filter_by(archived=True).all()
-        return _wrap(result)
+        with self.sessions.read() as session:
+            result = session.query(DeviceModel).filter_by(archived=True).all()
+            return _wrap(result)
 
     def restore_device(self, device_id):
         """
@@ -113,19 +131,37 @@ class Devices(object):
         :rtype: Device
         """
         validate_param("device_id", device_id, str)
-        with self._session() as session:
-            deleted_device = session.query(DeviceModel).get(device_id)
-            deleted_device.archived = False
-
-    def _query(self):
-        session = self.sessionmaker()
-        return session.query(DeviceModel)
-
-    @contextmanager
-    def _session(self):
-        session = self.sessionmaker()
-        yield session
-        session.commit()
+
+        def restore():
+            with self.sessions.write() as session:
+                deleted_device = session.query(DeviceModel).get(device_id)
+                deleted_device.archived = False
+                next_timestamp(session, device_id)
+
+        retry_conflicts(restore)
+        self._notify(device_id, None)
+
+    def add_listener(self, listener):
+        """
+        Register a function to be called as listener(device_id, timestamp) after
+        every committed change to a device. Devices are not versioned so the
+        timestamp is always None, although every change moves the device's
+        version forward.
+
+        :param function listener: Function to call
+        """
+        self.listeners.append(listener)
+
+    def _exists(self, device_id):
+        """
+        SQL condition that holds if the device exists and wasn't deleted.
+        """
+        return exists().where(and_(DeviceModel.device_id == device_id,
+                DeviceModel.archived == False))
+
+    def _notify(self, device_id, timestamp):
+        for listener in self.listeners:
+            listener(device_id, timestamp)
 
 def _validate(device):
     """
@@ -1,36 +1,85 @@
+from ._clock import current_timestamp, last_timestamp, next_timestamp, retry_conflicts
+from ._db import DeviceModel, DeviceVersionModel, RoutedSessions, sessions_for
+from .changes import ChangeEvent, LocalChangeFeed
 from .device import Device, Devices
-from .gate import Gates
-from .qubit import Qubits
+from .gate import Gate, Gates, _validate as _validate_gate, _wrap as _wrap_gate
+from .qubit import Qubit, Qubits, _VALUE_COLUMNS as _QUBIT_COLUMNS, \
+        _validate as _validate_qubit, _wrap as _wrap_qubit
 from ._utils import validate_field, validate_param
 from collections import defaultdict
+from types import MappingProxyType
+from sqlalchemy import and_, inspect, select, union_all
+import logging
 
 """
 High level module for interacting with this versioning system.
 """
 
+_log = logging.getLogger(__name__)
+
 class DeviceSummary(object):
+    """
+    Immutable view of a device, its qubits and its gates at one point in time,
+    safe to share between threads. Qubits and gates are indexed by id when the
+    summary is created so that lookups don't scan.
+    """
+    __slots__ = ("device_id", "description", "qubits", "gates", "_qubits_by_id",
+            "_gates_by_id")
+
+    _set = object.__setattr__
+
     def __init__(self, device_id, description, qubits, gates):
-        self.device_id = device_id
+        self._set("device_id", device_id)
         """Unique device id such as '7-qubit-prototype'"""
-        self.description = description
+        self._set("description", description)
         """Optional short description of the device"""
-        self.qubits = qubits
-        """List of qubits sorted by qubit id"""
-        self.gates = gates
-        """Map from qubit id to a set of gates for that qubit"""
+        self._set("qubits", tuple(qubits))
+        """Tuple of qubits sorted by qubit id"""
+        self._set("gates", MappingProxyType(dict((qubit_id, frozenset(qubit_gates))
+                for qubit_id, qubit_gates in gates.items())))
+        """Read only map from qubit id to a frozenset of gates for that qubit"""
+        self._set("_qubits_by_id", dict((qubit.qubit_id, qubit) for qubit in self.qubits))
+        self._set("_gates_by_id", dict(((gate.qubit_id, gate.gate_id), gate)
+                for qubit_gates in self.gates.values() for gate in qubit_gates))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("DeviceSummary is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("DeviceSummary is immutable")
+
+    def __reduce__(self):
+        return (DeviceSummary, (self.device_id, self.description, self.qubits,
+                dict(self.gates)))
+
+    def __setstate__(self, state):
+        # Summaries pickled before they were immutable kept a __dict__
+        self.__init__(state["device_id"], state["description"], state["qubits"],
+                state["gates"])
 
     def __repr__(self):
         return ("Device id: {}\n"
                 "Description: {}\n"
                 "Qubits: {}\n"
                 "Gates: {}"
-                ).format(self.device_id, self.description, self.qubits, dict(self.gates))
+                ).format(self.device_id, self.description, list(self.qubits),
+                        dict((qubit_id, set(qubit_gates))
+                        for qubit_id, qubit_gates in self.gates.items()))
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        if not isinstance(other, DeviceSummary):
+            return NotImplemented
+        return (self.device_id, self.description, self.qubits, self.gates) == \
+                (other.device_id, other.description, other.qubits, other.gates)
+
+    def __ne__(self, other):
+        if not isinstance(other, DeviceSummary):
+            return NotImplemented
+        return not self == other
 
     def __hash__(self):
-        return hash(frozenset(self.__dict__.items()))
+        return hash((self.device_id, self.description, self.qubits,
+                frozenset(self.gates.items())))
 
     def get_qubit(self, qubit_id):
         """
@@ -42,10 +91,7 @@ class DeviceSummary(object):
         """
         validate_param("qubit_id", qubit_id, int)
 
-        for qubit in self.qubits:
-            if qubit.qubit_id == qubit_id:
-                return qubit
-        return None
+        return self._qubits_by_id.get(qubit_id)
 
     def get_gates_by_qubit(self, qubit_id):
         """
@@ -53,18 +99,152 @@ class DeviceSummary(object):
         doesn't exist.
 
         :param int qubit_id: Qubit id
-        :return: List of gates if the qubit exists
-        :rtype: list
+        :return: Set of gates if the qubit exists
+        :rtype: frozenset
         """
         validate_param("qubit_id", qubit_id, int)
 
         return self.gates.get(qubit_id)
 
+    def get_gate(self, qubit_id, gate_id):
+        """
+        Find a gate by its qubit id and gate id or None if it doesn't exist.
+
+        :param int qubit_id: Qubit id
+        :param string gate_id: Gate id such as '+X'
+        :return: Gate if it exists
+        :rtype: Gate
+        """
+        validate_param("qubit_id", qubit_id, int)
+        validate_param("gate_id", gate_id, str)
+
+        return self._gates_by_id.get((qubit_id, gate_id))
+
+class Change(object):
+    def __init__(self, old, new):
+        self.old = old
+        """Qubit or gate before the change"""
+        self.new = new
+        """Qubit or gate after the change"""
+        self.fields = dict((name, (getattr(old, name), getattr(new, name)))
+                for name in _FIELDS[type(old)]
+                if getattr(old, name) != getattr(new, name))
+        """Map from each changed field name to its (old, new) values"""
+
+    def __repr__(self):
+        return "<Change(old={}, new={})>".format(self.old, self.new)
+
+    def __eq__(self, other):
+        return self.__dict__ == other.__dict__
+
+class DeviceDiff(object):
+    def __init__(self, device_id, start, end, added_qubits, removed_qubits,
+            changed_qubits, added_gates, removed_gates, changed_gates):
+        self.device_id = device_id
+        """Unique device id such as '7-qubit-prototype'"""
+        self.start = start
+        """Timestamp of the snapshot compared from"""
+        self.end = end
+        """Timestamp of the snapshot compared to"""
+        self.added_qubits = added_qubits
+        """List of qubits that only exist at end, sorted by qubit id"""
+        self.removed_qubits = removed_qubits
+        """List of qubits that only exist at start, sorted by qubit id"""
+        self.changed_qubits = changed_qubits
+        """List of Changes to qubits that exist at both times"""
+        self.added_gates = added_gates
+        """List of gates that only exist at end, sorted by qubit and gate id"""
+        self.removed_gates = removed_gates
+        """List of gates that only exist at start, sorted by qubit and gate id"""
+        self.changed_gates = changed_gates
+        """List of Changes to gates that exist at both times"""
+
+    def __repr__(self):
+        return ("Device id: {}\n"
+                "Qubits added: {}\n"
+                "Qubits removed: {}\n"
+                "Qubits changed: {}\n"
+                "Gates added: {}\n"
+                "Gates removed: {}\n"
+                "Gates changed: {}"
+                ).format(self.device_id, self.added_qubits, self.removed_qubits,
+                        self.changed_qubits, self.added_gates, self.removed_gates,
+                        self.changed_gates)
+
+    def __eq__(self, other):
+        return self.__dict__ == other.__dict__
+
+    def is_empty(self):
+        """
+        Whether nothing changed between the two snapshots.
+
+        :rtype: bool
+        """
+        return not (self.added_qubits or self.removed_qubits or self.changed_qubits
+                or self.added_gates or self.removed_gates or self.changed_gates)
+
 class DeviceSummaries(object):
-    def __init__(self, engine):
-        self.devices = Devices(engine)
-        self.gates = Gates(engine)
-        self.qubits = Qubits(engine)
+    def __init__(self, engine, head_tables=False, cache=None, snapshot_store=None,
+            read_engines=None, change_feed=None, latest_query=None):
+        """
+        :param Engine engine: Database to use. Devices, qubits and gates share
+                its sessions, see qversions.engine.create_engine to configure
+                its connection pool.
+        :param bool head_tables: Keep a pointer to the latest version of every
+                qubit and gate so that latest reads do not depend on how much
+                history exists. See Qubits and Gates.
+        :param SummaryCache cache: If specified, summaries are cached in process
+                and invalidated by writes made through this object. Writes from
+                other processes are only picked up once the cache ttl expires.
+        :param SnapshotStore snapshot_store: If specified, snapshots of past
+                points in time are kept there forever since they never change.
+                With read_engines its settle time must exceed the replication
+                lag.
+        :param list read_engines: If specified, replicas of engine that reads
+                are spread over. Writes, and reads shortly after a write, go to
+                engine. See qversions._db.RoutedSessions.
+        :param ChangeFeed change_feed: Where changes made through this object
+                are published for subscribe, defaults to a LocalChangeFeed
+                that only reaches subscribers in this process
+        :param string latest_query: How snapshots find the latest version of
+                each qubit and gate, see Qubits
+        """
+        if read_engines:
+            self.sessions = RoutedSessions(engine, read_engines)
+        else:
+            self.sessions = sessions_for(engine)
+        self.devices = Devices(self.sessions)
+        self.gates = Gates(self.sessions, head_table=head_tables,
+                latest_query=latest_query)
+        self.qubits = Qubits(self.sessions, head_table=head_tables,
+                latest_query=latest_query)
+        self.cache = cache
+        if cache is not None:
+            self.devices.add_listener(cache.invalidate)
+            self.gates.add_listener(cache.invalidate)
+            self.qubits.add_listener(cache.invalidate)
+        self.snapshot_store = snapshot_store
+        if snapshot_store is not None:
+            self.devices.add_listener(snapshot_store.invalidate)
+            self.gates.add_listener(snapshot_store.invalidate)
+            self.qubits.add_listener(snapshot_store.invalidate)
+        self.change_feed = change_feed if change_feed is not None else LocalChangeFeed()
+        """Feed that changes are published to"""
+        for kind, publisher in [("device", self.devices), ("qubit", self.qubits),
+                ("gate", self.gates)]:
+            publisher.add_listener(_publisher(self.change_feed, kind))
+
+    def subscribe(self, device_id=None):
+        """
+        Receive an event after every change to a device, its qubits or its
+        gates, instead of polling get_device. Iterate over the subscription
+        with for or async for, and close it when done.
+
+        :param string device_id: If specified, only receive events of this device
+        :return: Iterator of ChangeEvent
+        :rtype: Subscription
+        """
+        return self.change_feed.subscribe(device_id)
 
     def create_device(self, device_id, description=None):
         """
@@ -76,39 +256,251 @@ class DeviceSummaries(object):
         """
         return self.devices.create_device(Device(device_id, description))
 
-    def get_device(self, device_id):
+    def get_device(self, device_id, if_changed_since=None):
         """
         Get device summary for this device_id or None if it doesn't exist.
 
         :param string device_id: Device id
+        :param long if_changed_since: If specified, a version from get_version.
+                Only the version is read and None is returned if the device
+                did not change since then.
         :return: Device summary if the device exists
         :rtype: DeviceSummary
         """
-        device = self.devices.get_device(device_id)
-        if device is None:
-            raise RuntimeError("device_id {} does not exist".format(device_id))
+        if if_changed_since is not None:
+            validate_param("if_changed_since", if_changed_since, int)
+            if self.get_version(device_id) <= if_changed_since:
+                return None
+        return self._get_summary(device_id, timestamp=None)
 
-        qubits = self.qubits.get_qubits_by_device(device_id)
-        gates = self.gates.get_gates_by_device(device_id)
+    def get_version(self, device_id):
+        """
+        Get the version of a device, which moves forward on every change to
+        the device, its qubits or its gates. Read it before get_device to
+        later ask whether the summary changed with if_changed_since.
 
-        return _make_summary(device, qubits, gates)
+        :param string device_id: Device id
+        :return: Timestamp of the last change, 0 for a device that was not
+                changed since versions were tracked
+        :rtype: int
+        """
+        validate_param("device_id", device_id, str)
+        devices = DeviceModel.__table__
+        versions = DeviceVersionModel.__table__
+        with self.sessions.read() as session:
+            row = session.execute(select([devices.c.device_id, versions.c.version])\
+                    .select_from(devices.outerjoin(versions,
+                            versions.c.device_id == devices.c.device_id))\
+                    .where(and_(devices.c.device_id == device_id,
+                            devices.c.archived == False))).first()
+        if row is None:
+            raise RuntimeError("device_id {} does not exist".format(device_id))
+        return row.version or 0
 
     def get_snapshot(self, device_id, timestamp):
         """
         Get the state of a device at a particular point in time.
 
         :param string device_id: Device id
+        :param long timestamp: Point in time to retrieve
         :return: Device summary if the device exists
         :rtype: DeviceSummary
         """
-        device = self.devices.get_device(device_id)
-        if device is None:
-            raise RuntimeError("device_id {} does not exist".format(device_id))
+        return self._get_summary(device_id, timestamp)
 
-        qubits = self.qubits.get_qubits_by_device(device_id, timestamp)
-        gates = self.gates.get_gates_by_device(device_id, timestamp)
+    def get_snapshots(self, device_id, timestamps):
+        """
+        Generator over the states of a device at many points in time, for
+        example to replay its calibration history. Instead of querying each
+        snapshot, the device's history is streamed once in timestamp order,
+        qubits and gates in a single result, and every snapshot is built as
+        the history is replayed. A read session stays open until the
+        generator is exhausted or closed.
 
-        return _make_summary(device, qubits, gates)
+        :param string device_id: Device id
+        :param list timestamps: Points in time to retrieve
+        :return: Generator of (timestamp, summary) pairs in timestamp order
+        :rtype: generator
+        """
+        validate_param("device_id", device_id, str)
+        timestamps = sorted(timestamps)
+        for timestamp in timestamps:
+            validate_param("timestamp", timestamp, int)
+            if timestamp <= 0:
+                raise ValueError("timestamp must be positive")
+        if not timestamps:
+            return
+
+        devices = DeviceModel.__table__
+        with self.sessions.read() as session:
+            row = session.execute(select([devices.c.device_id, devices.c.description])\
+                    .where(and_(devices.c.device_id == device_id,
+                            devices.c.archived == False))).first()
+            if row is None:
+                raise RuntimeError("device_id {} does not exist".format(device_id))
+            device = Device._make(row)
+
+            # A single streamed result, since some drivers such as MySQL's
+            # can't read two unbuffered results on one connection at once
+            versions = union_all(
+                    self.qubits._sweep(session, device_id, timestamps[0], timestamps[-1]),
+                    self.gates._sweep(session, device_id, timestamps[0], timestamps[-1]))\
+                            .subquery()
+            rows = iter(session.execute(select([versions])\
+                    .order_by(versions.c.timestamp)\
+                    .execution_options(stream_results=True)))
+            values = dict(qubit={}, gate={})
+            row = next(rows, None)
+            for timestamp in timestamps:
+                while row is not None and row[0] < timestamp:
+                    _replay(values[row[1]], row)
+                    row = next(rows, None)
+                yield timestamp, _make_summary(device, values["qubit"].values(),
+                        values["gate"].values())
+
+    def get_devices(self, device_ids=None, timestamp=None):
+        """
+        Get the summaries of many devices at once, for example every device
+        before routing jobs. Devices, qubits and gates are each loaded with a
+        single query for all the devices, instead of three per device. The
+        cache and snapshot store are not used.
+
+        :param list device_ids: Device ids, or None for every device
+        :param long timestamp: If specified, the state at that point in time.
+                Otherwise, the latest state.
+        :return: Map from device id to device summary, sorted by device id
+        :rtype: dict
+        """
+        if device_ids is not None:
+            device_ids = list(device_ids)
+            for device_id in device_ids:
+                validate_param("device_id", device_id, str)
+            if not device_ids:
+                return {}
+        if timestamp is not None:
+            validate_param("timestamp", timestamp, int)
+
+        def query(query_builder):
+            if device_ids is None:
+                return query_builder
+            entity = query_builder.column_descriptions[0]["entity"]
+            return query_builder.filter(entity.device_id.in_(device_ids))
+
+        table = DeviceModel.__table__
+        devices_query = select([table.c.device_id, table.c.description])\
+                .where(table.c.archived == False).order_by(table.c.device_id)
+        if device_ids is not None:
+            devices_query = devices_query.where(table.c.device_id.in_(device_ids))
+
+        with self.sessions.read() as session:
+            devices = [Device._make(row) for row in session.execute(devices_query)]
+            missing = set(device_ids or ()) - set(device.device_id for device in devices)
+            if missing:
+                raise RuntimeError("device_id {} does not exist".format(min(missing)))
+            qubits = self.qubits._values(session, query, timestamp)
+            gates = self.gates._values(session, query, timestamp)
+
+        # Split the rows by device in one pass
+        qubits_by_device = defaultdict(list)
+        for qubit in qubits:
+            qubits_by_device[qubit.device_id].append(qubit)
+        gates_by_device = defaultdict(list)
+        for gate in gates:
+            gates_by_device[gate.device_id].append(gate)
+
+        return dict((device.device_id, _make_summary(device,
+                qubits_by_device[device.device_id], gates_by_device[device.device_id]))
+                for device in devices)
+
+    def diff(self, device_id, start, end=None):
+        """
+        Find what changed on a device between two snapshots. Only the qubits
+        and gates that have versions saved between the two timestamps are
+        loaded, together with the gates of qubits that were added or removed.
+        Like in the snapshots, gates only count while their qubit exists, so
+        the gates of a removed qubit are reported as removed as well.
+
+        :param string device_id: Device id
+        :param long start: Timestamp of the snapshot to compare from
+        :param long end: Timestamp of the snapshot to compare to, defaults to
+                the latest state
+        :return: Added, removed and changed qubits and gates
+        :rtype: DeviceDiff
+        """
+        validate_param("device_id", device_id, str)
+        validate_param("start", start, int)
+        if end is not None:
+            validate_param("end", end, int)
+        if start <= 0 or (end is not None and end < start):
+            raise ValueError("start must be positive and not after end")
+
+        with self.sessions.read() as session:
+            self._check_device(session, device_id)
+            if end is None:
+                end = max(start, current_timestamp(),
+                        last_timestamp(session, device_id) or 0) + 1
+            qubits = self.qubits._changes(session, device_id, start, end)
+            added_qubits, removed_qubits, changed_qubits = _compare(
+                    *[dict(((model.qubit_id,), _wrap_qubit(model)) for model in models)
+                    for models in qubits])
+            qubit_versions = self.qubits._versions(session, start)
+            gates = self.gates._changes(session, device_id, start, end,
+                    lambda timestamp: self.qubits._existing(session, device_id,
+                            timestamp, qubit_versions),
+                    [qubit.qubit_id for qubit in added_qubits + removed_qubits])
+
+        added_gates, removed_gates, changed_gates = _compare(
+                *[dict(((model.qubit_id, model.gate_id), _wrap_gate(model))
+                for model in models) for models in gates])
+
+        return DeviceDiff(device_id, start, end, added_qubits, removed_qubits,
+                changed_qubits, added_gates, removed_gates, changed_gates)
+
+    def restore_snapshot(self, device_id, timestamp):
+        """
+        Bring a device back to the state it had at a point in time, for example
+        to roll back a bad calibration. Every qubit and gate that differs from
+        that snapshot gets a new version, including ones deleted or added since,
+        all written in a single transaction with one shared timestamp.
+
+        :param string device_id: Device id
+        :param long timestamp: Point in time to restore, such as the value
+                returned by save_calibration
+        :return: timestamp of the system before the restore
+        :rtype: int
+        """
+        validate_param("device_id", device_id, str)
+        validate_param("timestamp", timestamp, int)
+        if timestamp <= 0:
+            raise ValueError("timestamp must be positive")
+
+        def restore():
+            with self.sessions.write() as session:
+                self._check_device(session, device_id)
+
+                # Allocating first locks out other writers to the device while
+                # the differences are computed
+                now = next_timestamp(session, device_id)
+                qubits = _restoring_versions(_validate_qubit, *[
+                        dict(((model.qubit_id,), _wrap_qubit(model)) for model in models)
+                        for models in self.qubits._changes(session, device_id, timestamp, now)])
+                gates = _restoring_versions(_validate_gate, *[
+                        dict(((model.qubit_id, model.gate_id), _wrap_gate(model))
+                        for model in models)
+                        for models in self.gates._changes(session, device_id, timestamp, now)])
+
+                if qubits:
+                    self.qubits._insert(session, qubits, now)
+                if gates:
+                    self.gates._insert(session, gates, now)
+                return now, bool(qubits), bool(gates)
+
+        now, qubits_saved, gates_saved = retry_conflicts(restore)
+        if qubits_saved:
+            self.qubits._notify(device_id, now)
+        if gates_saved:
+            self.gates._notify(device_id, now)
+        return now
 
     def save_qubit(self, qubit):
         """
@@ -118,10 +510,22 @@ class DeviceSummaries(object):
         :return: timestamp of the system before saving qubit
         :rtype: int
         """
-        if self.devices.get_device(qubit.device_id) is None:
-            raise RuntimeError("device_id {} does not exist".format(qubit.device_id))
-
-        return self.qubits.save_qubit(qubit)
+        validate_param("qubit", qubit, Qubit)
+        device_id = qubit.device_id
+
+        def save():
+            with self.sessions.write() as session:
+                model = _validate_qubit(qubit)
+                model.timestamp = next_timestamp(session, device_id)
+                # The device is checked by the insert itself
+                if not self.qubits._insert_where(session, model,
+                        self.devices._exists(device_id)):
+                    raise RuntimeError("device_id {} does not exist".format(device_id))
+                return model.timestamp
+
+        timestamp = retry_conflicts(save)
+        self.qubits._notify(device_id, timestamp)
+        return timestamp
 
     def save_gate(self, gate):
         """
@@ -131,14 +535,243 @@ class DeviceSummaries(object):
         :return: timestamp of the system before saving gate
         :rtype: int
         """
-        if self.devices.get_device(gate.device_id) is None:
-            raise RuntimeError("device_id {} does not exist".format(gate.device_id))
+        validate_param("gate", gate, Gate)
+        device_id = gate.device_id
+
+        def save():
+            with self.sessions.write() as session:
+                model = _validate_gate(gate)
+                model.timestamp = next_timestamp(session, device_id)
+                # The device and qubit are checked by the insert itself
+                if not self.gates._insert_where(session, model, and_(
+                        self.devices._exists(device_id),
+                        self.qubits._exists(device_id, model.qubit_id))):
+                    self._check_device(session, device_id)
+                    raise RuntimeError("qubit with device_id {} and qubit_id {} does not exist"\
+                            .format(device_id, model.qubit_id))
+                return model.timestamp
+
+        timestamp = retry_conflicts(save)
+        self.gates._notify(device_id, timestamp)
+        return timestamp
+
+    def save_calibration(self, device_id, qubits=(), gates=()):
+        """
+        Save new measurements for many qubits and gates of a device at once, such
+        as the results of a calibration run. Everything is written in a single
+        transaction and shares one timestamp, so the whole run can be restored
+        with a single snapshot.
+
+        :param string device_id: Device id
+        :param list qubits: Qubits to save
+        :param list gates: Gates to save, their qubits must either already exist
+                or be part of qubits
+        :return: timestamp of the system before saving the calibration
+        :rtype: int
+        """
+        validate_param("device_id", device_id, str)
+        qubit_models = [_validate_qubit(_check_batch(device_id, "qubit", qubit, Qubit))
+                for qubit in qubits]
+        gate_models = [_validate_gate(_check_batch(device_id, "gate", gate, Gate))
+                for gate in gates]
+        _check_unique("qubit", [(qubit.qubit_id,) for qubit in qubit_models])
+        _check_unique("gate", [(gate.qubit_id, gate.gate_id) for gate in gate_models])
+
+        def query(query_builder):
+            return query_builder.filter_by(device_id=device_id)
+
+        def save():
+            with self.sessions.write() as session:
+                self._check_device(session, device_id)
+
+                qubit_ids = set(qubit.qubit_id for qubit in qubit_models)
+                if any(gate.qubit_id not in qubit_ids for gate in gate_models):
+                    qubit_ids.update(qubit.qubit_id for qubit in
+                            self.qubits._values(session, query))
+                for gate in gate_models:
+                    if gate.qubit_id not in qubit_ids:
+                        raise RuntimeError("qubit with device_id {} and qubit_id {} does not exist"\
+                                .format(device_id, gate.qubit_id))
+
+                timestamp = next_timestamp(session, device_id)
+                if qubit_models:
+                    self.qubits._insert(session, qubit_models, timestamp)
+                if gate_models:
+                    self.gates._insert(session, gate_models, timestamp)
+                return timestamp
+
+        timestamp = retry_conflicts(save)
+
+        if qubit_models:
+            self.qubits._notify(device_id, timestamp)
+        if gate_models:
+            self.gates._notify(device_id, timestamp)
+        return timestamp
+
+    def compact(self, horizon, batch_size=1000, grace=10.0):
+        """
+        Move qubit and gate versions that were replaced before horizon out of
+        the tables read for the latest state and into archive tables. Snapshots
+        and history from before horizon still include them. See Qubits.compact.
+
+        :param long horizon: Timestamp before which replaced versions are moved
+        :param int batch_size: Number of versions moved per transaction
+        :param float grace: Seconds to wait between raising the horizon of
+                each table and moving its versions
+        :return: Number of versions moved
+        :rtype: int
+        """
+        return self.qubits.compact(horizon, batch_size, grace) + \
+                self.gates.compact(horizon, batch_size, grace)
 
-        if self.qubits.get_qubit(gate.device_id, gate.qubit_id) is None:
-            raise RuntimeError("qubit with device_id {} and qubit_id {} does not exist"\
-                    .format(gate.device_id, gate.qubit_id))
+    def _check_device(self, session, device_id):
+        """
+        Raise an exception if the device doesn't exist or was deleted.
+        """
+        if not session.query(self.devices._exists(device_id)).scalar():
+            raise RuntimeError("device_id {} does not exist".format(device_id))
 
-        return self.gates.save_gate(gate)
+    def _get_summary(self, device_id, timestamp):
+        """
+        Return a summary from the snapshot store or the cache if there is one,
+        otherwise load it.
+        """
+        validate_param("device_id", device_id, str)
+
+        def load():
+            return self._load_summary(device_id, timestamp)
+
+        if timestamp and self.snapshot_store is not None and \
+                self.snapshot_store.is_settled(timestamp, current_timestamp()):
+            return self.snapshot_store.get_or_load(device_id, timestamp, load)
+        if self.cache is not None:
+            return self.cache.get_or_load(device_id, timestamp, load)
+        return load()
+
+    def _load_summary(self, device_id, timestamp):
+        """
+        Load the device, its qubits and its gates using a single session. The
+        device and its latest qubits are fetched in one statement by outer
+        joining the qubits onto the device row, the gates in a second one. Only
+        columns are selected, the public objects are built from the rows.
+        """
+        validate_param("device_id", device_id, str)
+
+        def query(query_builder):
+            return query_builder.filter_by(device_id=device_id)
+
+        with self.sessions.read() as session:
+            versions = self.qubits._versions(session, timestamp)
+            latest = self.qubits._latest(session, query, timestamp, versions)
+            devices = DeviceModel.__table__
+            table = inspect(versions).selectable
+            rows = session.execute(select([devices.c.device_id, devices.c.description] +
+                    [table.c[name] for name in _QUBIT_COLUMNS])\
+                    .select_from(devices\
+                            .outerjoin(latest, devices.c.device_id == latest.c.device_id)\
+                            .outerjoin(table, and_(
+                                    table.c.device_id == latest.c.device_id,
+                                    table.c.qubit_id == latest.c.qubit_id,
+                                    table.c.timestamp == latest.c.latest_timestamp)))\
+                    .where(and_(devices.c.device_id == device_id,
+                            devices.c.archived == False))).fetchall()
+            if not rows:
+                raise RuntimeError("device_id {} does not exist".format(device_id))
+
+            # Columns are the device's then the qubit's, ending with archived
+            device = Device._make(rows[0][:2])
+            qubits = [Qubit._make(row[2:-1]) for row in rows
+                    if row[3] is not None and not row[-1]]
+            gates = self.gates._values(session, query, timestamp)
+
+        return _make_summary(device, qubits, gates)
+
+def _publisher(feed, kind):
+    """
+    Listener publishing the changes of one kind to a change feed. The change
+    already committed, so a failure to publish is logged instead of raised.
+    """
+    def publish(device_id, timestamp):
+        try:
+            feed.publish(ChangeEvent(device_id, kind, timestamp))
+        except Exception:
+            _log.exception("Could not publish %s change of device %s", kind, device_id)
+    return publish
+
+def _replay(values, row):
+    """
+    Apply a version row from Qubits._sweep or Gates._sweep to a map of the
+    current qubits or gates. Rows are read by position, which is much faster
+    than by name.
+    """
+    # Columns are timestamp, kind, device_id, qubit_id, gate_id, the three
+    # values and archived
+    is_qubit = row[1] == "qubit"
+    key = row[3] if is_qubit else (row[3], row[4])
+    if row[-1]:
+        values.pop(key, None)
+    elif is_qubit:
+        values[key] = Qubit._make(row[2:4] + row[5:8])
+    else:
+        values[key] = Gate._make(row[2:8])
+
+def _check_batch(device_id, name, value, typ):
+    """
+    Ensure a member of a batch is the right type and belongs to the device.
+    """
+    validate_param(name, value, typ)
+    if value.device_id != device_id:
+        raise ValueError("{} device_id must be {}".format(name, device_id))
+    return value
+
+def _check_unique(name, keys):
+    """
+    Ensure a batch doesn't save the same entity twice.
+    """
+    if len(set(keys)) != len(keys):
+        raise ValueError("{} saved more than once in the same batch".format(name))
+
+_FIELDS = {
+    Qubit: ["resonance_frequency", "t1", "t2"],
+    Gate: ["amplitude", "width", "phase"],
+}
+"""Measured fields compared by Change"""
+
+def _compare(before, after):
+    """
+    Compare maps from key to qubit or gate, None meaning deleted, and return
+    lists of the added, removed and changed values sorted by key.
+    """
+    added = []
+    removed = []
+    changed = []
+    for key in sorted(set(before) | set(after)):
+        old = before.get(key)
+        new = after.get(key)
+        if old is None and new is not None:
+            added.append(new)
+        elif old is not None and new is None:
+            removed.append(old)
+        elif old != new:
+            changed.append(Change(old, new))
+    return added, removed, changed
+
+def _restoring_versions(validate, target, current):
+    """
+    Given maps from key to the qubit or gate in the snapshot being restored and
+    to the current one, None meaning deleted, return the models to save.
+    """
+    models = []
+    for key in sorted(set(target) | set(current)):
+        old = target.get(key)
+        new = current.get(key)
+        if old is not None and (new is None or old != new):
+            models.append(validate(old))
+        elif old is None and new is not None:
+            model = validate(new)
+            model.archived = True
+            models.append(model)
+    return models
 
 def _make_summary(device, qubits, gates):
     """
@@ -0,0 +1,41 @@
+from sqlalchemy import create_engine as _create_engine
+from sqlalchemy.engine.url import make_url
+
+"""
+Module for creating database engines with a configured connection pool.
+"""
+
+def create_engine(url, pool_size=5, max_overflow=10, pool_timeout=30,
+        pool_recycle=None, pool_pre_ping=None, **kwargs):
+    """
+    Create an engine whose connection pool is suited to a long running service.
+    sqlite uses its own pools which don't take a size, so pool_size,
+    max_overflow and pool_timeout only apply to it if a poolclass is passed.
+    sqlite has no server to drop connections either, and replacing the
+    connection of an in memory database loses the database, so connections
+    are only recycled and pinged for it if asked to.
+
+    :param string url: Database url such as 'postgresql://localhost/qversions'
+    :param int pool_size: Number of connections kept open
+    :param int max_overflow: Connections allowed on top of pool_size under load
+    :param float pool_timeout: Seconds to wait for a connection before failing
+    :param int pool_recycle: Seconds after which a connection is replaced, so
+            that connections closed by the server are never handed out.
+            Defaults to 1800, or to never for sqlite
+    :param bool pool_pre_ping: Test connections before handing them out.
+            Defaults to True, or to False for sqlite
+    :param kwargs: Any other sqlalchemy.create_engine argument
+    :return: Engine to pass to DeviceSummaries
+    :rtype: Engine
+    """
+    sqlite = make_url(url).get_backend_name() == "sqlite"
+    if pool_recycle is None:
+        pool_recycle = -1 if sqlite else 1800
+    if pool_pre_ping is None:
+        pool_pre_ping = not sqlite
+    options = dict(pool_recycle=pool_recycle, pool_pre_ping=pool_pre_ping)
+    if not sqlite or "poolclass" in kwargs:
+        options.update(pool_size=pool_size, max_overflow=max_overflow,
+                pool_timeout=pool_timeout)
+    options.update(kwargs)
+    return _create_engine(url, **options)
@@ -1,8 +1,9 @@
-from ._db import GateModel
-from ._utils import validate_field, validate_param
-from contextlib import contextmanager
-from sqlalchemy import and_
-from sqlalchemy.orm import sessionmaker
+from . import _archive
+from ._clock import next_timestamp, retry_conflicts
+from ._db import GateArchiveModel, GateHeadModel, GateModel, sessions_for
+from ._latest import check_strategy, latest_versions
+from ._utils import to_columns, validate_field, validate_param, value_type
+from sqlalchemy import and_, bindparam, inspect, literal, or_, select, tuple_
 from sqlalchemy.orm.session import make_transient
 from sqlalchemy.sql import func
 import time
@@ -11,35 +12,46 @@ import time
 Module for interacting with Quantum Gates.
 """
 
-class Gate(object):
-    def __init__(self, device_id, qubit_id, gate_id, amplitude, width, phase):
-        self.device_id = device_id
-        """Device that this gate is associated with"""
-        self.qubit_id = qubit_id
-        """Qubit that this gate is associated with"""
-        self.gate_id = gate_id
-        """Short name string like '+X' to uniquely identify the gate"""
-        self.amplitude = amplitude
-        """Amplitude of control pulse in mV (optional)"""
-        self.width = width
-        """Width of control pulse in ns (optional)"""
-        self.phase = phase
-        """Phase of control pulse (optional)"""
+class Gate(value_type("Gate", ["device_id", "qubit_id", "gate_id", "amplitude", "width",
+        "phase"])):
+    """
+    Immutable gate measurements, use replace to get a copy with different values.
+
+    :ivar string device_id: Device that this gate is associated with
+    :ivar int qubit_id: Qubit that this gate is associated with
+    :ivar string gate_id: Short name string like '+X' to uniquely identify the
+            gate
+    :ivar float amplitude: Amplitude of control pulse in mV (optional)
+    :ivar float width: Width of control pulse in ns (optional)
+    :ivar float phase: Phase of control pulse (optional)
+    """
+    __slots__ = ()
 
     def __repr__(self):
         return "<Gate(device_id={}, qubit_id={}, gate_id={}, amplitude={}, width={}, phase={})>"\
                 .format(self.device_id, self.qubit_id, self.gate_id,
                          self.amplitude, self.width, self.phase)
 
-    def __eq__(self, other):
-        return self.__dict__ == other.__dict__
-
-    def __hash__(self):
-        return hash(frozenset(self.__dict__.items()))
-
 class Gates(object):
-    def __init__(self, engine):
-        self.sessionmaker = sessionmaker(bind=engine)
+    def __init__(self, engine, head_table=False, latest_query=None):
+        """
+        :param Engine engine: Database to use, or Sessions shared with other
+                objects
+        :param bool head_table: If true, every write also updates a table
+                pointing to the latest version of each gate so that latest
+                reads are primary key lookups instead of a group by over the
+                whole history. All writers to a database must agree on this,
+                use rebuild_head_table() when turning it on for existing data.
+        :param string latest_query: How reads of the state at a point in time
+                find the latest version of each gate, one of
+                qversions._latest.STRATEGIES that the database supports.
+                Defaults to the best one for the database.
+        """
+        self.sessions = sessions_for(engine)
+        self.head_table = head_table
+        check_strategy(latest_query, getattr(self.sessions.engine, "dialect", None))
+        self.latest_query = latest_query
+        self.listeners = []
 
     def save_gate(self, gate):
         """
@@ -51,11 +63,18 @@ class Gates(object):
         :rtype: int
         """
         validate_param("gate", gate, Gate)
-        gate = _validate(gate)
-        with self._session() as session:
-            timestamp = _current_timestamp()
-            gate.timestamp = timestamp
-            session.add(gate)
+        device_id = gate.device_id
+
+        def save():
+            with self.sessions.write() as session:
+                model = _validate(gate)
+                model.timestamp = next_timestamp(session, device_id)
+                session.add(model)
+                self._move_heads(session, [model])
+                return model.timestamp
+
+        timestamp = retry_conflicts(save)
+        self._notify(device_id, timestamp)
         return timestamp
 
     def get_gate(self, device_id, qubit_id, gate_id, timestamp=None):
@@ -74,8 +93,8 @@ class Gates(object):
         validate_param("qubit_id", qubit_id, int)
         validate_param("gate_id", gate_id, str)
 
-        session = self.sessionmaker()
-        return _wrap(self._get_gate(session, device_id, qubit_id, gate_id, timestamp))
+        with self.sessions.read() as session:
+            return _wrap(self._get_gate(session, device_id, qubit_id, gate_id, timestamp))
 
     def get_gates_by_qubit(self, device_id, qubit_id, timestamp=None):
         """
@@ -90,13 +109,10 @@ class Gates(object):
         validate_param("qubit_id", qubit_id, int)
 
         def query(query_builder):
-            query = query_builder.filter_by(device_id=device_id, qubit_id=qubit_id)
-            if timestamp:
-                return query.filter(GateModel.timestamp < timestamp)
-            return query
+            return query_builder.filter_by(device_id=device_id, qubit_id=qubit_id)
 
-        session = self.sessionmaker()
-        return _wrap(self._query(session, query).all())
+        with self.sessions.read() as session:
+            return self._values(session, query, timestamp)
 
     def get_gates_by_device(self, device_id, timestamp=None):
         """
@@ -111,13 +127,97 @@ class Gates(object):
         validate_param("device_id", device_id, str)
 
         def query(query_builder):
-            query = query_builder.filter_by(device_id=device_id)
-            if timestamp:
-                return query.filter(GateModel.timestamp < timestamp)
-            return query
+            return query_builder.filter_by(device_id=device_id)
+
+        with self.sessions.read() as session:
+            return self._values(session, query, timestamp)
+
+    def get_history(self, device_id, qubit_id, gate_id, start=None, end=None, limit=None):
+        """
+        Get every version saved for a gate in timestamp order.
 
-        session = self.sessionmaker()
-        return _wrap(self._query(session, query).all())
+        :param string device_id: Device id
+        :param int qubit_id: Qubit id
+        :param string gate_id: Gate id
+        :param long start: If specified, only versions saved at or after this time
+        :param long end: If specified, only versions saved before this time
+        :param int limit: If specified, return at most this many versions
+        :return: List of (timestamp, gate) pairs, gate is None for the versions
+                where it was deleted
+        :rtype: list
+        """
+        validate_param("device_id", device_id, str)
+        validate_param("qubit_id", qubit_id, int)
+        validate_param("gate_id", gate_id, str)
+        if limit is not None:
+            validate_param("limit", limit, int)
+            if limit < 0:
+                raise ValueError("limit must not be negative")
+
+        with self.sessions.read() as session:
+            return self._history_page(session, device_id, qubit_id, gate_id,
+                    start, end, limit)
+
+    def iter_history(self, device_id, qubit_id, gate_id, start=None, end=None,
+            batch_size=1000):
+        """
+        Generator over every version saved for a gate in timestamp order, like
+        get_history. Versions are fetched in batches using the timestamp of the
+        last version seen, so a long history is never loaded at once.
+
+        :param string device_id: Device id
+        :param int qubit_id: Qubit id
+        :param string gate_id: Gate id
+        :param long start: If specified, only versions saved at or after this time
+        :param long end: If specified, only versions saved before this time
+        :param int batch_size: Number of versions fetched per query
+        :return: Generator of (timestamp, gate) pairs
+        :rtype: generator
+        """
+        validate_param("device_id", device_id, str)
+        validate_param("qubit_id", qubit_id, int)
+        validate_param("gate_id", gate_id, str)
+        validate_param("batch_size", batch_size, int)
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive")
+
+        while True:
+            with self.sessions.read() as session:
+                page = self._history_page(session, device_id, qubit_id, gate_id,
+                        start, end, batch_size)
+            for version in page:
+                yield version
+            if len(page) < batch_size:
+                return
+            start = page[-1][0] + 1
+
+    def export_history(self, device_id, start=None, end=None, structured=False):
+        """
+        Export every version of every gate on a device as NumPy columns, sorted
+        by qubit id, gate id and then timestamp. Rows are read straight from the
+        table without building any objects. Requires numpy.
+
+        :param string device_id: Device id
+        :param long start: If specified, only versions saved at or after this time
+        :param long end: If specified, only versions saved before this time
+        :param bool structured: Return a NumPy structured array instead
+        :return: Map from qubit_id, gate_id, timestamp, amplitude, width, phase
+                and archived to arrays
+        :rtype: dict
+        """
+        validate_param("device_id", device_id, str)
+
+        with self.sessions.read() as session:
+            table = inspect(self._versions(session, start or 0)).selectable
+            query = select([table.c[name] for name, _ in _COLUMNS])\
+                    .where(table.c.device_id == device_id)
+            if start is not None:
+                query = query.where(table.c.timestamp >= start)
+            if end is not None:
+                query = query.where(table.c.timestamp < end)
+            query = query.order_by(table.c.qubit_id, table.c.gate_id, table.c.timestamp)
+            rows = session.execute(query).fetchall()
+        return to_columns(rows, _COLUMNS, structured)
 
     def delete_gate(self, device_id, qubit_id, gate_id):
         """
@@ -133,65 +233,323 @@ class Gates(object):
         validate_param("qubit_id", qubit_id, int)
         validate_param("gate_id", gate_id, str)
 
-        with self._session() as session:
-            gate = self._get_gate(session, device_id, qubit_id, gate_id, timestamp=None)
-            if gate is None:
-                raise RuntimeError("gate with device_id {} and qubit_id {} and gate_id {} does not exist"\
-                        .format(device_id, qubit_id, gate_id))
-            # Don't track any more modifications to gate
-            session.expunge(gate)
-            make_transient(gate)
-            # Create a new entry with a new timestamp that is archived
-            timestamp = _current_timestamp()
-            gate.timestamp = timestamp
-            gate.archived = True
-            session.add(gate)
-            return timestamp
+        def delete():
+            with self.sessions.write() as session:
+                gate = self._get_gate(session, device_id, qubit_id, gate_id, timestamp=None)
+                if gate is None:
+                    raise RuntimeError("gate with device_id {} and qubit_id {} and gate_id {} does not exist"\
+                            .format(device_id, qubit_id, gate_id))
+                # Don't track any more modifications to gate
+                session.expunge(gate)
+                make_transient(gate)
+                # Create a new entry with a new timestamp that is archived
+                gate.timestamp = next_timestamp(session, device_id)
+                gate.archived = True
+                session.add(gate)
+                self._move_heads(session, [gate])
+                return gate.timestamp
+
+        timestamp = retry_conflicts(delete)
+        self._notify(device_id, timestamp)
+        return timestamp
+
+    def rebuild_head_table(self):
+        """
+        Point the head table at the latest version of every gate. Needed when
+        turning on head_table for a database that already has history.
+        """
+        table = GateHeadModel.__table__
+        latest = select([GateModel.device_id, GateModel.qubit_id, GateModel.gate_id,
+                func.max(GateModel.timestamp)])\
+                        .group_by(GateModel.device_id, GateModel.qubit_id, GateModel.gate_id)
+        with self.sessions.write() as session:
+            session.execute(table.delete())
+            session.execute(table.insert().from_select(
+                    ["device_id", "qubit_id", "gate_id", "timestamp"], latest))
+
+    def compact(self, horizon, batch_size=1000, grace=10.0):
+        """
+        Move the versions of gates that were replaced before horizon into the
+        gate_archive table, so that reads of the latest state only go through
+        recent history. The version that was current at horizon stays. Reads
+        from before horizon, including history, keep returning the same
+        results by also reading the archive. Versions are moved in transactions
+        of batch_size, starting grace seconds after the horizon was raised.
+        Reads check the horizon in a statement of their own just before reading
+        the versions, so it can run while the system is in use as long as no
+        read takes longer than grace between the two.
+
+        :param long horizon: Timestamp before which replaced versions are moved
+        :param int batch_size: Number of versions moved per transaction
+        :param float grace: Seconds to wait between raising the horizon and
+                moving versions
+        :return: Number of versions moved
+        :rtype: int
+        """
+        validate_param("horizon", horizon, int)
+        validate_param("batch_size", batch_size, int)
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive")
+        validate_param("grace", grace, (int, float))
+
+        def move_horizon():
+            with self.sessions.write() as session:
+                _archive.raise_horizon(session, GateModel.__tablename__, horizon)
+
+        retry_conflicts(move_horizon)
+        # Reads that saw the old horizon may not have read the table yet
+        time.sleep(grace)
+        with self.sessions.read() as session:
+            device_ids = _archive.compacted_devices(session, GateModel, horizon)
+
+        moved = 0
+        for device_id in device_ids:
+            def move():
+                with self.sessions.write() as session:
+                    return _archive.archive_versions(session, GateModel,
+                            GateArchiveModel, ["device_id", "qubit_id", "gate_id"],
+                            device_id, horizon, batch_size)
+
+            while True:
+                count = retry_conflicts(move)
+                moved += count
+                if count < batch_size:
+                    break
+        return moved
+
+    def add_listener(self, listener):
+        """
+        Register a function to be called as listener(device_id, timestamp) after
+        every committed change to a gate, with the timestamp of the version
+        that was written.
+
+        :param function listener: Function to call
+        """
+        self.listeners.append(listener)
 
     def _get_gate(self, session, device_id, qubit_id, gate_id, timestamp):
         """
         Return a GateModel for this point in time.
         """
         def query(query_builder):
-            query_builder = query_builder\
+            return query_builder\
                 .filter_by(device_id=device_id, qubit_id=qubit_id, gate_id=gate_id)
 
-            if timestamp:
-                return query_builder.filter(GateModel.timestamp < timestamp)
-            return query_builder
+        return self._query(session, query, timestamp).one_or_none()
+
+    def _changes(self, session, device_id, start, end, existing=None, qubit_ids=()):
+        """
+        Return lists of the latest GateModels from before start and from before
+        end, only for the gates that have versions in [start, end) or belong
+        to one of qubit_ids. If specified, existing is a method returning a
+        subquery of the device_id and qubit_id of the qubits that exist before
+        a timestamp, and only the gates of those qubits are returned.
+        """
+        versions = self._versions(session, start)
+        in_window = and_(versions.timestamp >= start, versions.timestamp < end)
+        if qubit_ids:
+            in_window = or_(in_window, versions.qubit_id.in_(qubit_ids))
+        window = session.query(versions.device_id, versions.qubit_id, versions.gate_id)\
+                .filter(versions.device_id == device_id, in_window)\
+                .distinct().subquery()
+
+        def changes(timestamp):
+            def query(query_builder):
+                query_builder = query_builder.filter_by(device_id=device_id)\
+                        .join(window, and_(
+                                versions.device_id == window.c.device_id,
+                                versions.qubit_id == window.c.qubit_id,
+                                versions.gate_id == window.c.gate_id))
+                if existing is None:
+                    return query_builder
+                qubits = existing(timestamp)
+                return query_builder.join(qubits, and_(
+                        versions.device_id == qubits.c.device_id,
+                        versions.qubit_id == qubits.c.qubit_id))
 
-        return self._query(session, query).one_or_none()
+            return self._query(session, query, timestamp, versions).all()
 
-    def _query(self, session, f):
+        return changes(start), changes(end)
+
+    def _history_page(self, session, device_id, qubit_id, gate_id, start, end, limit):
+        """
+        Return (timestamp, gate) pairs for versions in [start, end), walking the
+        primary key in timestamp order.
+        """
+        versions = self._versions(session, start or 0)
+        query = session.query(versions)\
+                .filter_by(device_id=device_id, qubit_id=qubit_id, gate_id=gate_id)
+        if start is not None:
+            query = query.filter(versions.timestamp >= start)
+        if end is not None:
+            query = query.filter(versions.timestamp < end)
+        query = query.order_by(versions.timestamp)
+        if limit is not None:
+            query = query.limit(limit)
+        return [(model.timestamp, _wrap(model)) for model in query]
+
+    def _sweep(self, session, device_id, start, end):
+        """
+        Select of every version of the device's gates from before end, as rows
+        of timestamp, kind 'gate', device_id, qubit_id, gate_id, amplitude,
+        width and phase as value1 to value3, and archived. See Qubits._sweep.
+        """
+        table = inspect(self._versions(session, start)).selectable
+        return select([table.c.timestamp, literal("gate").label("kind"),
+                table.c.device_id, table.c.qubit_id, table.c.gate_id,
+                table.c.amplitude.label("value1"), table.c.width.label("value2"),
+                table.c.phase.label("value3"), table.c.archived])\
+                .where(and_(table.c.device_id == device_id, table.c.timestamp < end))
+
+    def _query(self, session, f, timestamp=None, versions=None):
         """
         Perform a query on only the latest version of the gates.
         Takes a method f which adds filter operations to the query.
         """
-        # Find the max for each gate
-        query_builder = session.query(GateModel.device_id, GateModel.qubit_id, GateModel.gate_id,
-                func.max(GateModel.timestamp).label("latest_timestamp"))\
-                        .group_by(GateModel.device_id, GateModel.qubit_id, GateModel.gate_id)
-        # Add custom filters
-        latest = f(query_builder).subquery()
-        # Join with whole table to get original information
-        query = session.query(GateModel).join((latest, and_(
-                GateModel.device_id == latest.c.device_id,
-                GateModel.qubit_id == latest.c.qubit_id,
-                GateModel.gate_id == latest.c.gate_id,
-                GateModel.timestamp == latest.c.latest_timestamp)))
+        if versions is None:
+            versions = self._versions(session, timestamp or None)
+        latest = self._latest(session, f, timestamp, versions)
+        # Join with whole table to get original information. Every latest
+        # timestamp has a matching row, the outer join only pins the join order
+        # so that the database looks up versions by primary key instead of
+        # scanning the device's history.
+        query = session.query(versions).select_from(latest).outerjoin(versions, and_(
+                versions.device_id == latest.c.device_id,
+                versions.qubit_id == latest.c.qubit_id,
+                versions.gate_id == latest.c.gate_id,
+                versions.timestamp == latest.c.latest_timestamp))
         return query
 
-    @contextmanager
-    def _session(self):
-        session = self.sessionmaker()
-        yield session
-        session.commit()
+    def _values(self, session, f, timestamp=None):
+        """
+        Latest versions of the gates as public Gates, skipping deleted ones.
+        Only the columns are selected and Gates are built straight from the
+        rows, without loading GateModels.
+        Takes a method f which adds filter operations to the query.
+        """
+        versions = self._versions(session, timestamp or None)
+        latest = self._latest(session, f, timestamp, versions)
+        table = inspect(versions).selectable
+        query = select([table.c[name] for name in _VALUE_COLUMNS])\
+                .select_from(latest.outerjoin(table, and_(
+                        table.c.device_id == latest.c.device_id,
+                        table.c.qubit_id == latest.c.qubit_id,
+                        table.c.gate_id == latest.c.gate_id,
+                        table.c.timestamp == latest.c.latest_timestamp)))
+        # Filtered here, a condition on the joined table would let the
+        # database change the join order
+        return [Gate._make(row[:-1]) for row in session.execute(query) if not row[-1]]
+
+    def _versions(self, session, timestamp):
+        """
+        Entity holding the versions needed to read the state before timestamp,
+        or history from timestamp on: the gates table, together with the
+        archive if timestamp is before the horizon. None means the latest state.
+        """
+        return _archive.versions(session, GateModel, GateArchiveModel, timestamp)
 
-def _current_timestamp():
-    """
-    Return microseconds since epoch.
-    """
-    return int(time.time() * 1000000)
+    def _latest(self, session, f, timestamp=None, versions=None):
+        """
+        Subquery of the latest timestamp for each gate, exposed as the
+        columns device_id, qubit_id, gate_id and latest_timestamp. If timestamp
+        is given only versions from before that time are considered.
+        Takes a method f which adds filter operations to the query.
+        """
+        if self.head_table and not timestamp:
+            query_builder = session.query(GateHeadModel.device_id,
+                    GateHeadModel.qubit_id, GateHeadModel.gate_id,
+                    GateHeadModel.timestamp.label("latest_timestamp"))
+            return f(query_builder).subquery()
+
+        if versions is None:
+            versions = self._versions(session, timestamp or None)
+        return latest_versions(session, versions, ["device_id", "qubit_id", "gate_id"], f,
+                timestamp, self.latest_query)
+
+    def _insert_where(self, session, gate, condition):
+        """
+        Insert a GateModel only if a SQL condition holds, checked by the
+        database in the same INSERT ... SELECT statement. Returns whether the
+        gate was inserted.
+        """
+        if gate.archived is None:
+            gate.archived = False
+        table = GateModel.__table__
+        values = select([literal(getattr(gate, column.name), column.type)
+                for column in table.columns]).where(condition)
+        result = session.execute(table.insert().from_select(
+                [column.name for column in table.columns], values))
+        if result.rowcount != 1:
+            return False
+        self._move_heads(session, [gate])
+        return True
+
+    def _insert(self, session, gates, timestamp):
+        """
+        Insert GateModels as new versions sharing one timestamp, using a single
+        executemany statement.
+        """
+        for gate in gates:
+            gate.timestamp = timestamp
+            if gate.archived is None:
+                gate.archived = False
+        session.execute(GateModel.__table__.insert(), [dict(
+                device_id=gate.device_id, qubit_id=gate.qubit_id,
+                gate_id=gate.gate_id, timestamp=gate.timestamp,
+                amplitude=gate.amplitude, width=gate.width, phase=gate.phase,
+                archived=gate.archived)
+                for gate in gates])
+        self._move_heads(session, gates)
+
+    def _move_heads(self, session, gates):
+        """
+        Point the head table at these gate versions unless newer ones have
+        already been saved.
+        """
+        if not self.head_table or not gates:
+            return
+        table = GateHeadModel.__table__
+        key_columns = [table.c.device_id, table.c.qubit_id, table.c.gate_id]
+        keys = list(set((gate.device_id, gate.qubit_id, gate.gate_id) for gate in gates))
+        # Only the head rows of the written gates are read, in chunks to stay
+        # below the bound parameter limit of the database
+        existing = set()
+        for start in range(0, len(keys), _HEAD_CHUNK):
+            existing.update(session.execute(select(key_columns)\
+                    .where(tuple_(*key_columns).in_(keys[start:start + _HEAD_CHUNK]))))
+
+        moved = [dict(key_device_id=gate.device_id, key_qubit_id=gate.qubit_id,
+                key_gate_id=gate.gate_id, key_timestamp=gate.timestamp)
+                for gate in gates
+                if (gate.device_id, gate.qubit_id, gate.gate_id) in existing]
+        if moved:
+            session.execute(table.update()\
+                    .where(and_(table.c.device_id == bindparam("key_device_id"),
+                            table.c.qubit_id == bindparam("key_qubit_id"),
+                            table.c.gate_id == bindparam("key_gate_id"),
+                            table.c.timestamp < bindparam("key_timestamp")))\
+                    .values(timestamp=bindparam("key_timestamp")), moved)
+
+        added = [dict(device_id=gate.device_id, qubit_id=gate.qubit_id,
+                gate_id=gate.gate_id, timestamp=gate.timestamp) for gate in gates
+                if (gate.device_id, gate.qubit_id, gate.gate_id) not in existing]
+        if added:
+            session.execute(table.insert(), added)
+
+    def _notify(self, device_id, timestamp):
+        for listener in self.listeners:
+            listener(device_id, timestamp)
+
+_HEAD_CHUNK = 500
+"""Number of gates whose head rows are looked up per statement"""
+
+_COLUMNS = [("qubit_id", "i8"), ("gate_id", str), ("timestamp", "i8"),
+        ("amplitude", "f8"), ("width", "f8"), ("phase", "f8"), ("archived", "?")]
+"""Columns and NumPy types of exported gate history"""
+
+_VALUE_COLUMNS = ["device_id", "qubit_id", "gate_id", "amplitude", "width", "phase",
+        "archived"]
+"""Columns selected to build a Gate, followed by archived"""
 
 def _validate(gate):
     """
@@ -1,8 +1,10 @@
-from ._db import QubitModel
-from ._utils import validate_field, validate_param
-from contextlib import contextmanager
-from sqlalchemy import and_
-from sqlalchemy.orm import sessionmaker
+from . import _archive
+from ._clock import next_timestamp, retry_conflicts
+from ._db import QubitArchiveModel, QubitHeadModel, QubitModel, sessions_for
+from ._latest import check_strategy, latest_versions
+from ._utils import to_columns, validate_field, validate_param, value_type
+from sqlalchemy import String, and_, bindparam, cast, exists, inspect, literal, null, \
+        select, tuple_
 from sqlalchemy.orm.session import make_transient
 from sqlalchemy.sql import func
 import time
@@ -11,33 +13,43 @@ import time
 Module for interacting with Quantum Bits (Qubits).
 """
 
-class Qubit(object):
-    def __init__(self, device_id, qubit_id, resonance_frequency, t1, t2):
-        self.device_id = device_id
-        """Device that this qubit is associated with"""
-        self.qubit_id = qubit_id
-        """Positive integer uniquely identifying this qubit"""
-        self.resonance_frequency = resonance_frequency
-        """Resonance frequency in GHz (optional)"""
-        self.t1 = t1
-        """Coherence time constant 1 in microseconds (optional)"""
-        self.t2 = t2
-        """Coherence time constant 2 in microseconds (optional)"""
+class Qubit(value_type("Qubit", ["device_id", "qubit_id", "resonance_frequency", "t1", "t2"])):
+    """
+    Immutable qubit measurements, use replace to get a copy with different values.
+
+    :ivar string device_id: Device that this qubit is associated with
+    :ivar int qubit_id: Positive integer uniquely identifying this qubit
+    :ivar float resonance_frequency: Resonance frequency in GHz (optional)
+    :ivar float t1: Coherence time constant 1 in microseconds (optional)
+    :ivar float t2: Coherence time constant 2 in microseconds (optional)
+    """
+    __slots__ = ()
 
     def __repr__(self):
         return "<Qubit(device_id={}, qubit_id={}, resonance_frequency={}, t1={}, t2={})>"\
                 .format(self.device_id, self.qubit_id, self.resonance_frequency,
                         self.t1, self.t2)
 
-    def __eq__(self, other):
-        return self.__dict__ == other.__dict__
-
-    def __hash__(self):
-        return hash(frozenset(self.__dict__.items()))
-
 class Qubits(object):
-    def __init__(self, engine):
-        self.sessionmaker = sessionmaker(bind=engine)
+    def __init__(self, engine, head_table=False, latest_query=None):
+        """
+        :param Engine engine: Database to use, or Sessions shared with other
+                objects
+        :param bool head_table: If true, every write also updates a table
+                pointing to the latest version of each qubit so that latest
+                reads are primary key lookups instead of a group by over the
+                whole history. All writers to a database must agree on this,
+                use rebuild_head_table() when turning it on for existing data.
+        :param string latest_query: How reads of the state at a point in time
+                find the latest version of each qubit, one of
+                qversions._latest.STRATEGIES that the database supports.
+                Defaults to the best one for the database.
+        """
+        self.sessions = sessions_for(engine)
+        self.head_table = head_table
+        check_strategy(latest_query, getattr(self.sessions.engine, "dialect", None))
+        self.latest_query = latest_query
+        self.listeners = []
 
     def save_qubit(self, qubit):
         """
@@ -49,11 +61,18 @@ class Qubits(object):
         :rtype: int
         """
         validate_param("qubit", qubit, Qubit)
-        qubit = _validate(qubit)
-        with self._session() as session:
-            timestamp = _current_timestamp()
-            qubit.timestamp = timestamp
-            session.add(qubit)
+        device_id = qubit.device_id
+
+        def save():
+            with self.sessions.write() as session:
+                model = _validate(qubit)
+                model.timestamp = next_timestamp(session, device_id)
+                session.add(model)
+                self._move_heads(session, [model])
+                return model.timestamp
+
+        timestamp = retry_conflicts(save)
+        self._notify(device_id, timestamp)
         return timestamp
 
     def get_qubit(self, device_id, qubit_id, timestamp=None):
@@ -70,8 +89,8 @@ class Qubits(object):
         validate_param("device_id", device_id, str)
         validate_param("qubit_id", qubit_id, int)
 
-        session = self.sessionmaker()
-        return _wrap(self._get_qubit(session, device_id, qubit_id, timestamp))
+        with self.sessions.read() as session:
+            return _wrap(self._get_qubit(session, device_id, qubit_id, timestamp))
 
     def get_qubits_by_device(self, device_id, timestamp=None):
         """
@@ -86,13 +105,91 @@ class Qubits(object):
         validate_param("device_id", device_id, str)
 
         def query(query_builder):
-            query = query_builder.filter_by(device_id=device_id)
-            if timestamp:
-                return query.filter(QubitModel.timestamp < timestamp)
-            return query
+            return query_builder.filter_by(device_id=device_id)
 
-        session = self.sessionmaker()
-        return _wrap(self._query(session, query).all())
+        with self.sessions.read() as session:
+            return self._values(session, query, timestamp)
+
+    def get_history(self, device_id, qubit_id, start=None, end=None, limit=None):
+        """
+        Get every version saved for a qubit in timestamp order.
+
+        :param string device_id: Device id
+        :param int qubit_id: Qubit id
+        :param long start: If specified, only versions saved at or after this time
+        :param long end: If specified, only versions saved before this time
+        :param int limit: If specified, return at most this many versions
+        :return: List of (timestamp, qubit) pairs, qubit is None for the versions
+                where it was deleted
+        :rtype: list
+        """
+        validate_param("device_id", device_id, str)
+        validate_param("qubit_id", qubit_id, int)
+        if limit is not None:
+            validate_param("limit", limit, int)
+            if limit < 0:
+                raise ValueError("limit must not be negative")
+
+        with self.sessions.read() as session:
+            return self._history_page(session, device_id, qubit_id, start, end, limit)
+
+    def iter_history(self, device_id, qubit_id, start=None, end=None, batch_size=1000):
+        """
+        Generator over every version saved for a qubit in timestamp order, like
+        get_history. Versions are fetched in batches using the timestamp of the
+        last version seen, so a long history is never loaded at once.
+
+        :param string device_id: Device id
+        :param int qubit_id: Qubit id
+        :param long start: If specified, only versions saved at or after this time
+        :param long end: If specified, only versions saved before this time
+        :param int batch_size: Number of versions fetched per query
+        :return: Generator of (timestamp, qubit) pairs
+        :rtype: generator
+        """
+        validate_param("device_id", device_id, str)
+        validate_param("qubit_id", qubit_id, int)
+        validate_param("batch_size", batch_size, int)
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive")
+
+        while True:
+            with self.sessions.read() as session:
+                page = self._history_page(session, device_id, qubit_id, start, end,
+                        batch_size)
+            for version in page:
+                yield version
+            if len(page) < batch_size:
+                return
+            start = page[-1][0] + 1
+
+    def export_history(self, device_id, start=None, end=None, structured=False):
+        """
+        Export every version of every qubit on a device as NumPy columns, sorted
+        by qubit id and then timestamp. Rows are read straight from the table
+        without building any objects. Requires numpy.
+
+        :param string device_id: Device id
+        :param long start: If specified, only versions saved at or after this time
+        :param long end: If specified, only versions saved before this time
+        :param bool structured: Return a NumPy structured array instead
+        :return: Map from qubit_id, timestamp, resonance_frequency, t1, t2 and
+                archived to arrays
+        :rtype: dict
+        """
+        validate_param("device_id", device_id, str)
+
+        with self.sessions.read() as session:
+            table = inspect(self._versions(session, start or 0)).selectable
+            query = select([table.c[name] for name, _ in _COLUMNS])\
+                    .where(table.c.device_id == device_id)
+            if start is not None:
+                query = query.where(table.c.timestamp >= start)
+            if end is not None:
+                query = query.where(table.c.timestamp < end)
+            query = query.order_by(table.c.qubit_id, table.c.timestamp)
+            rows = session.execute(query).fetchall()
+        return to_columns(rows, _COLUMNS, structured)
 
     def delete_qubit(self, device_id, qubit_id):
         """
@@ -106,64 +203,343 @@ class Qubits(object):
         validate_param("device_id", device_id, str)
         validate_param("qubit_id", qubit_id, int)
 
-        with self._session() as session:
-            qubit = self._get_qubit(session, device_id, qubit_id, timestamp=None)
-            if qubit is None:
-                raise RuntimeError("qubit with device_id {} and qubit_id {} does not exist"\
-                        .format(device_id, qubit_id))
-            # Don't track any more modifications to qubit
-            session.expunge(qubit)
-            make_transient(qubit)
-            # Create a new entry with a new timestamp that is archived
-            timestamp = _current_timestamp()
-            qubit.timestamp = timestamp
-            qubit.archived = True
-            session.add(qubit)
-            return timestamp
+        def delete():
+            with self.sessions.write() as session:
+                qubit = self._get_qubit(session, device_id, qubit_id, timestamp=None)
+                if qubit is None:
+                    raise RuntimeError("qubit with device_id {} and qubit_id {} does not exist"\
+                            .format(device_id, qubit_id))
+                # Don't track any more modifications to qubit
+                session.expunge(qubit)
+                make_transient(qubit)
+                # Create a new entry with a new timestamp that is archived
+                qubit.timestamp = next_timestamp(session, device_id)
+                qubit.archived = True
+                session.add(qubit)
+                self._move_heads(session, [qubit])
+                return qubit.timestamp
+
+        timestamp = retry_conflicts(delete)
+        self._notify(device_id, timestamp)
+        return timestamp
+
+    def rebuild_head_table(self):
+        """
+        Point the head table at the latest version of every qubit. Needed when
+        turning on head_table for a database that already has history.
+        """
+        table = QubitHeadModel.__table__
+        latest = select([QubitModel.device_id, QubitModel.qubit_id,
+                func.max(QubitModel.timestamp)])\
+                        .group_by(QubitModel.device_id, QubitModel.qubit_id)
+        with self.sessions.write() as session:
+            session.execute(table.delete())
+            session.execute(table.insert().from_select(
+                    ["device_id", "qubit_id", "timestamp"], latest))
+
+    def compact(self, horizon, batch_size=1000, grace=10.0):
+        """
+        Move the versions of qubits that were replaced before horizon into the
+        qubit_archive table, so that reads of the latest state only go through
+        recent history. The version that was current at horizon stays. Reads
+        from before horizon, including history, keep returning the same
+        results by also reading the archive. Versions are moved in transactions
+        of batch_size, starting grace seconds after the horizon was raised.
+        Reads check the horizon in a statement of their own just before reading
+        the versions, so it can run while the system is in use as long as no
+        read takes longer than grace between the two.
+
+        :param long horizon: Timestamp before which replaced versions are moved
+        :param int batch_size: Number of versions moved per transaction
+        :param float grace: Seconds to wait between raising the horizon and
+                moving versions
+        :return: Number of versions moved
+        :rtype: int
+        """
+        validate_param("horizon", horizon, int)
+        validate_param("batch_size", batch_size, int)
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive")
+        validate_param("grace", grace, (int, float))
+
+        def move_horizon():
+            with self.sessions.write() as session:
+                _archive.raise_horizon(session, QubitModel.__tablename__, horizon)
+
+        retry_conflicts(move_horizon)
+        # Reads that saw the old horizon may not have read the table yet
+        time.sleep(grace)
+        with self.sessions.read() as session:
+            device_ids = _archive.compacted_devices(session, QubitModel, horizon)
+
+        moved = 0
+        for device_id in device_ids:
+            def move():
+                with self.sessions.write() as session:
+                    return _archive.archive_versions(session, QubitModel,
+                            QubitArchiveModel, ["device_id", "qubit_id"], device_id,
+                            horizon, batch_size)
+
+            while True:
+                count = retry_conflicts(move)
+                moved += count
+                if count < batch_size:
+                    break
+        return moved
+
+    def add_listener(self, listener):
+        """
+        Register a function to be called as listener(device_id, timestamp) after
+        every committed change to a qubit, with the timestamp of the version
+        that was written.
+
+        :param function listener: Function to call
+        """
+        self.listeners.append(listener)
 
     def _get_qubit(self, session, device_id, qubit_id, timestamp):
         """
         Return a QubitModel for this point in time
         """
         def query(query_builder):
-            query_builder = query_builder\
-                    .filter_by(device_id=device_id, qubit_id=qubit_id)
+            return query_builder.filter_by(device_id=device_id, qubit_id=qubit_id)
+
+        return self._query(session, query, timestamp).one_or_none()
+
+    def _changes(self, session, device_id, start, end):
+        """
+        Return lists of the latest QubitModels from before start and from before
+        end, only for the qubits that have versions in [start, end).
+        """
+        versions = self._versions(session, start)
+        window = session.query(versions.device_id, versions.qubit_id)\
+                .filter(versions.device_id == device_id,
+                        versions.timestamp >= start, versions.timestamp < end)\
+                .distinct().subquery()
+
+        def query(query_builder):
+            return query_builder.filter_by(device_id=device_id).join(window, and_(
+                    versions.device_id == window.c.device_id,
+                    versions.qubit_id == window.c.qubit_id))
+
+        return (self._query(session, query, start, versions).all(),
+                self._query(session, query, end, versions).all())
+
+    def _existing(self, session, device_id, timestamp, versions=None):
+        """
+        Subquery of the device_id and qubit_id of the device's qubits that
+        exist, meaning not deleted, before timestamp.
+        """
+        if versions is None:
+            versions = self._versions(session, timestamp)
+
+        def query(query_builder):
+            return query_builder.filter_by(device_id=device_id)
 
-            if timestamp:
-                return query_builder.filter(QubitModel.timestamp < timestamp)
-            return query_builder
+        latest = self._latest(session, query, timestamp, versions)
+        table = inspect(versions).selectable
+        return select([table.c.device_id, table.c.qubit_id])\
+                .select_from(latest.join(table, and_(
+                        table.c.device_id == latest.c.device_id,
+                        table.c.qubit_id == latest.c.qubit_id,
+                        table.c.timestamp == latest.c.latest_timestamp)))\
+                .where(table.c.archived == False).subquery()
 
-        return self._query(session, query).one_or_none()
+    def _history_page(self, session, device_id, qubit_id, start, end, limit):
+        """
+        Return (timestamp, qubit) pairs for versions in [start, end), walking the
+        primary key in timestamp order.
+        """
+        versions = self._versions(session, start or 0)
+        query = session.query(versions)\
+                .filter_by(device_id=device_id, qubit_id=qubit_id)
+        if start is not None:
+            query = query.filter(versions.timestamp >= start)
+        if end is not None:
+            query = query.filter(versions.timestamp < end)
+        query = query.order_by(versions.timestamp)
+        if limit is not None:
+            query = query.limit(limit)
+        return [(model.timestamp, _wrap(model)) for model in query]
+
+    def _sweep(self, session, device_id, start, end):
+        """
+        Select of every version of the device's qubits from before end, as
+        rows of timestamp, kind 'qubit', device_id, qubit_id, a NULL gate_id,
+        resonance_frequency, t1 and t2 as value1 to value3, and archived.
+        Gates._sweep has the same columns so the two can be streamed as one
+        UNION ALL. The archive is read as well if start, the earliest state
+        the versions are replayed to, is before the horizon.
+        """
+        table = inspect(self._versions(session, start)).selectable
+        return select([table.c.timestamp, literal("qubit").label("kind"),
+                table.c.device_id, table.c.qubit_id,
+                cast(null(), String).label("gate_id"),
+                table.c.resonance_frequency.label("value1"),
+                table.c.t1.label("value2"), table.c.t2.label("value3"),
+                table.c.archived])\
+                .where(and_(table.c.device_id == device_id, table.c.timestamp < end))
 
-    def _query(self, session, f):
+    def _query(self, session, f, timestamp=None, versions=None):
         """
         Perform a query on only the latest version of the qubits.
         Takes a method f which adds filter operations to the query.
         """
-        # Find the max for each qubit
-        query_builder = session.query(QubitModel.device_id, QubitModel.qubit_id,
-                func.max(QubitModel.timestamp).label("latest_timestamp"))\
-                        .group_by(QubitModel.device_id, QubitModel.qubit_id)
-        # Add custom filters
-        latest = f(query_builder).subquery()
-        # Join with whole table to get original information
-        query = session.query(QubitModel).join((latest, and_(
-                QubitModel.device_id == latest.c.device_id,
-                QubitModel.qubit_id == latest.c.qubit_id,
-                QubitModel.timestamp == latest.c.latest_timestamp)))
+        if versions is None:
+            versions = self._versions(session, timestamp or None)
+        latest = self._latest(session, f, timestamp, versions)
+        # Join with whole table to get original information. Every latest
+        # timestamp has a matching row, the outer join only pins the join order
+        # so that the database looks up versions by primary key instead of
+        # scanning the device's history.
+        query = session.query(versions).select_from(latest).outerjoin(versions, and_(
+                versions.device_id == latest.c.device_id,
+                versions.qubit_id == latest.c.qubit_id,
+                versions.timestamp == latest.c.latest_timestamp))
         return query
 
-    @contextmanager
-    def _session(self):
-        session = self.sessionmaker()
-        yield session
-        session.commit()
+    def _values(self, session, f, timestamp=None):
+        """
+        Latest versions of the qubits as public Qubits, skipping deleted ones.
+        Only the columns are selected and Qubits are built straight from the
+        rows, without loading QubitModels.
+        Takes a method f which adds filter operations to the query.
+        """
+        versions = self._versions(session, timestamp or None)
+        latest = self._latest(session, f, timestamp, versions)
+        table = inspect(versions).selectable
+        query = select([table.c[name] for name in _VALUE_COLUMNS])\
+                .select_from(latest.outerjoin(table, and_(
+                        table.c.device_id == latest.c.device_id,
+                        table.c.qubit_id == latest.c.qubit_id,
+                        table.c.timestamp == latest.c.latest_timestamp)))
+        # Filtered here, a condition on the joined table would let the
+        # database change the join order
+        return [Qubit._make(row[:-1]) for row in session.execute(query) if not row[-1]]
 
-def _current_timestamp():
-    """
-    Return microseconds since epoch.
-    """
-    return int(time.time() * 1000000)
+    def _versions(self, session, timestamp):
+        """
+        Entity holding the versions needed to read the state before timestamp,
+        or history from timestamp on: the qubits table, together with the
+        archive if timestamp is before the horizon. None means the latest state.
+        """
+        return _archive.versions(session, QubitModel, QubitArchiveModel, timestamp)
+
+    def _latest(self, session, f, timestamp=None, versions=None):
+        """
+        Subquery of the latest timestamp for each qubit, exposed as the
+        columns device_id, qubit_id and latest_timestamp. If timestamp is given
+        only versions from before that time are considered.
+        Takes a method f which adds filter operations to the query.
+        """
+        if self.head_table and not timestamp:
+            query_builder = session.query(QubitHeadModel.device_id,
+                    QubitHeadModel.qubit_id,
+                    QubitHeadModel.timestamp.label("latest_timestamp"))
+            return f(query_builder).subquery()
+
+        if versions is None:
+            versions = self._versions(session, timestamp or None)
+        return latest_versions(session, versions, ["device_id", "qubit_id"], f, timestamp,
+                self.latest_query)
+
+    def _insert_where(self, session, qubit, condition):
+        """
+        Insert a QubitModel only if a SQL condition holds, checked by the
+        database in the same INSERT ... SELECT statement. Returns whether the
+        qubit was inserted.
+        """
+        if qubit.archived is None:
+            qubit.archived = False
+        table = QubitModel.__table__
+        values = select([literal(getattr(qubit, column.name), column.type)
+                for column in table.columns]).where(condition)
+        result = session.execute(table.insert().from_select(
+                [column.name for column in table.columns], values))
+        if result.rowcount != 1:
+            return False
+        self._move_heads(session, [qubit])
+        return True
+
+    def _exists(self, device_id, qubit_id):
+        """
+        SQL condition that holds if the latest version of the qubit exists and
+        isn't archived. The latest timestamp is a max over the primary key,
+        which databases answer with a single index lookup.
+        """
+        versions = QubitModel.__table__.alias()
+        latest = select([func.max(versions.c.timestamp)])\
+                .where(and_(versions.c.device_id == device_id,
+                        versions.c.qubit_id == qubit_id))\
+                .scalar_subquery()
+        return exists().where(and_(QubitModel.device_id == device_id,
+                QubitModel.qubit_id == qubit_id,
+                QubitModel.timestamp == latest,
+                QubitModel.archived == False))
+
+    def _insert(self, session, qubits, timestamp):
+        """
+        Insert QubitModels as new versions sharing one timestamp, using a single
+        executemany statement.
+        """
+        for qubit in qubits:
+            qubit.timestamp = timestamp
+            if qubit.archived is None:
+                qubit.archived = False
+        session.execute(QubitModel.__table__.insert(), [dict(
+                device_id=qubit.device_id, qubit_id=qubit.qubit_id,
+                timestamp=qubit.timestamp,
+                resonance_frequency=qubit.resonance_frequency,
+                t1=qubit.t1, t2=qubit.t2, archived=qubit.archived)
+                for qubit in qubits])
+        self._move_heads(session, qubits)
+
+    def _move_heads(self, session, qubits):
+        """
+        Point the head table at these qubit versions unless newer ones have
+        already been saved.
+        """
+        if not self.head_table or not qubits:
+            return
+        table = QubitHeadModel.__table__
+        key_columns = [table.c.device_id, table.c.qubit_id]
+        keys = list(set((qubit.device_id, qubit.qubit_id) for qubit in qubits))
+        # Only the head rows of the written qubits are read, in chunks to stay
+        # below the bound parameter limit of the database
+        existing = set()
+        for start in range(0, len(keys), _HEAD_CHUNK):
+            existing.update(session.execute(select(key_columns)\
+                    .where(tuple_(*key_columns).in_(keys[start:start + _HEAD_CHUNK]))))
+
+        moved = [dict(key_device_id=qubit.device_id, key_qubit_id=qubit.qubit_id,
+                key_timestamp=qubit.timestamp) for qubit in qubits
+                if (qubit.device_id, qubit.qubit_id) in existing]
+        if moved:
+            session.execute(table.update()\
+                    .where(and_(table.c.device_id == bindparam("key_device_id"),
+                            table.c.qubit_id == bindparam("key_qubit_id"),
+                            table.c.timestamp < bindparam("key_timestamp")))\
+                    .values(timestamp=bindparam("key_timestamp")), moved)
+
+        added = [dict(device_id=qubit.device_id, qubit_id=qubit.qubit_id,
+                timestamp=qubit.timestamp) for qubit in qubits
+                if (qubit.device_id, qubit.qubit_id) not in existing]
+        if added:
+            session.execute(table.insert(), added)
+
+    def _notify(self, device_id, timestamp):
+        for listener in self.listeners:
+            listener(device_id, timestamp)
+
+_HEAD_CHUNK = 500
+"""Number of qubits whose head rows are looked up per statement"""
+
+_COLUMNS = [("qubit_id", "i8"), ("timestamp", "i8"), ("resonance_frequency", "f8"),
+        ("t1", "f8"), ("t2", "f8"), ("archived", "?")]
+"""Columns and NumPy types of exported qubit history"""
+
+_VALUE_COLUMNS = ["device_id", "qubit_id", "resonance_frequency", "t1", "t2", "archived"]
+"""Columns selected to build a Qubit, followed by archived"""
 
 def _validate(qubit):
     """
@@ -0,0 +1,56 @@
+from ._db import Base
+from sqlalchemy import DDL, MetaData, event
+
+"""
+Module for creating the database tables.
+"""
+
+PARTITIONED_TABLES = ['qubits', 'gates', 'qubit_heads', 'gate_heads',
+        'qubit_archive', 'gate_archive']
+"""Tables that can be partitioned by device_id, all have it in their primary key"""
+
+def create_tables(engine, partitions=None):
+    """
+    Create every table that doesn't exist yet.
+
+    With partitions, the qubit and gate history, head and archive tables are
+    created with native Postgres hash partitioning on device_id (requires
+    PostgreSQL 11). Every query filters on device_id, so a single device query
+    only touches its own partition: Postgres prunes the others when planning,
+    or while executing for the lookups joined back to the history. The table
+    names don't change, so Devices, Qubits, Gates and DeviceSummaries need no
+    other setting. The number of partitions can't be changed once created.
+
+    :param Engine engine: Database to create the tables in
+    :param int partitions: Number of hash partitions, or None to not partition
+    """
+    if partitions is None:
+        Base.metadata.create_all(engine)
+        return
+
+    if not isinstance(partitions, int) or isinstance(partitions, bool) or partitions < 1:
+        raise ValueError("partitions must be a positive int")
+    if engine.dialect.name != "postgresql":
+        raise ValueError("partitioning requires postgresql, not {}".format(engine.dialect.name))
+
+    partitioned_metadata(partitions).create_all(engine)
+
+def partitioned_metadata(partitions):
+    """
+    Copy of the table definitions with the partitioned tables declared as
+    partitioned, each creating its partitions after itself.
+
+    :param int partitions: Number of hash partitions
+    :rtype: MetaData
+    """
+    metadata = MetaData()
+    for table in Base.metadata.sorted_tables:
+        copy = table.to_metadata(metadata)
+        if table.name in PARTITIONED_TABLES:
+            copy.dialect_options["postgresql"]["partition_by"] = "HASH (device_id)"
+            for remainder in range(partitions):
+                event.listen(copy, "after_create", DDL(
+                        "CREATE TABLE IF NOT EXISTS {0}_p{2} PARTITION OF {0} "
+                        "FOR VALUES WITH (MODULUS {1}, REMAINDER {2})"
+                        .format(table.name, partitions, remainder)))
+    return metadata
@@ -0,0 +1,254 @@
+from ._db import BoundSessions
+from ._utils import validate_param
+from .device_summary import DeviceSummaries
+from collections import OrderedDict
+from threading import Lock
+from urllib.parse import parse_qsl, quote, unquote, urlsplit
+import gzip
+import json
+
+"""
+WSGI service exposing devices, snapshots and history over HTTP.
+"""
+
+class Service(object):
+    """
+    WSGI application on top of DeviceSummaries, serve it with any WSGI server.
+    Responses are JSON:
+
+    - GET /devices/<device_id>: latest summary of a device
+    - GET /devices/<device_id>/snapshots/<timestamp>: summary at a point in time
+    - GET /devices/<device_id>/qubits/<qubit_id>/history: versions of a qubit
+    - GET /devices/<device_id>/qubits/<qubit_id>/gates/<gate_id>/history:
+      versions of a gate, or /devices/<device_id>/qubits/<qubit_id>/gates/history
+      with a gate_id query parameter
+
+    Ids are percent encoded. Servers decode %2F in PATH_INFO, so ids
+    containing '/' are only found in the path if the server passes the raw
+    URI as RAW_URI or REQUEST_URI, otherwise use the gate_id parameter.
+    History takes optional start, end and limit query parameters. The ETag of
+    every response is the version of the device, so a request whose
+    If-None-Match still matches is answered with 304 after reading only the
+    version. Response bodies are cached per device version, and compressed
+    once if they are large and the client accepts gzip.
+    """
+    def __init__(self, summaries, cache_size=256, gzip_min_size=1024):
+        """
+        :param DeviceSummaries summaries: Devices to serve
+        :param int cache_size: Maximum number of response bodies to keep, 0 to
+                serialize every response
+        :param int gzip_min_size: Bodies of at least this many bytes are sent
+                compressed to clients accepting gzip
+        """
+        validate_param("cache_size", cache_size, int)
+        validate_param("gzip_min_size", gzip_min_size, int)
+        self.summaries = summaries
+        """DeviceSummaries the responses are read from"""
+        self.cache_size = cache_size
+        """Maximum number of response bodies to keep"""
+        self.gzip_min_size = gzip_min_size
+        """Size from which bodies are compressed"""
+        self.hits = 0
+        """Number of responses whose body came from the cache"""
+        self.misses = 0
+        """Number of responses whose body had to be serialized"""
+        self.not_modified = 0
+        """Number of 304 responses"""
+        self._bodies = OrderedDict()
+        self._lock = Lock()
+
+    def __call__(self, environ, start_response):
+        method = environ["REQUEST_METHOD"]
+        if method not in ("GET", "HEAD"):
+            return _respond(start_response, "405 Method Not Allowed",
+                    _error("Method {} not allowed".format(method)),
+                    [("Allow", "GET, HEAD")], method)
+
+        parts = _path_parts(environ)
+        try:
+            read = self._route(parts, dict(parse_qsl(environ.get("QUERY_STRING", ""))))
+        except (TypeError, ValueError) as e:
+            return _respond(start_response, "400 Bad Request", _error(str(e)), [],
+                    method)
+        if read is None:
+            return _respond(start_response, "404 Not Found", _error("Not found"), [],
+                    method)
+
+        # The version and then the body are read in one session, so both come
+        # from the same database, even with read replicas, and a body is never
+        # older than its ETag
+        with self.summaries.sessions.read() as session:
+            summaries = self._bind(session)
+            try:
+                version = summaries.get_version(parts[1])
+            except RuntimeError as e:
+                return _respond(start_response, "404 Not Found", _error(str(e)), [],
+                        method)
+
+            # Each encoding is a different representation with its own ETag
+            etag = '"{}"'.format(version)
+            gzip_etag = '"{}-gzip"'.format(version)
+            headers = [("Cache-Control", "no-cache"), ("Vary", "Accept-Encoding")]
+            matches = _etags(environ.get("HTTP_IF_NONE_MATCH", ""))
+            if etag in matches or gzip_etag in matches:
+                with self._lock:
+                    self.not_modified += 1
+                return _respond(start_response, "304 Not Modified", b"",
+                        headers + [("ETag", gzip_etag if gzip_etag in matches else etag)],
+                        method)
+
+            try:
+                body, compressed = self._get_body(
+                        (tuple(parts), environ.get("QUERY_STRING"), version),
+                        lambda: read(summaries))
+            except RuntimeError as e:
+                return _respond(start_response, "404 Not Found", _error(str(e)), [],
+                        method)
+        if compressed is not None and _accepts_gzip(environ.get("HTTP_ACCEPT_ENCODING", "")):
+            return _respond(start_response, "200 OK", compressed,
+                    headers + [("ETag", gzip_etag),
+                    ("Content-Encoding", "gzip")], method)
+        return _respond(start_response, "200 OK", body, headers + [("ETag", etag)], method)
+
+    def stats(self):
+        """
+        Return the response counters, useful for sizing the cache.
+
+        :return: Map with hits, misses, not_modified and size
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                    not_modified=self.not_modified, size=len(self._bodies))
+
+    def _bind(self, session):
+        """
+        Return DeviceSummaries configured like summaries that read through a
+        single session. The cache is left out since its summaries may be
+        older than the version read in the session.
+        """
+        return DeviceSummaries(BoundSessions(session),
+                head_tables=self.summaries.qubits.head_table,
+                snapshot_store=self.summaries.snapshot_store,
+                latest_query=self.summaries.qubits.latest_query)
+
+    def _route(self, parts, params):
+        """
+        Return a function reading the data of a path from DeviceSummaries, or
+        None if there is no such path. Raises TypeError or ValueError for
+        invalid parameters.
+        """
+        if len(parts) < 2 or parts[0] != "devices" or not parts[1]:
+            return None
+        device_id = parts[1]
+
+        if len(parts) == 2:
+            return lambda summaries: _summary_dict(summaries.get_device(device_id))
+        if len(parts) == 4 and parts[2] == "snapshots":
+            timestamp = _int("timestamp", parts[3], minimum=1)
+            return lambda summaries: _summary_dict(summaries.get_snapshot(device_id,
+                    timestamp))
+        if len(parts) < 5 or parts[2] != "qubits" or parts[-1] != "history":
+            return None
+
+        qubit_id = _int("qubit_id", parts[3])
+        start, end, limit = [_int(name, params[name], minimum) if name in params else None
+                for name, minimum in [("start", 0), ("end", 0), ("limit", 0)]]
+        if len(parts) == 5:
+            return lambda summaries: [_version_dict(timestamp, qubit)
+                    for timestamp, qubit in summaries.qubits.get_history(device_id,
+                            qubit_id, start, end, limit)]
+        if len(parts) in (6, 7) and parts[4] == "gates":
+            if len(parts) == 7:
+                gate_id = parts[5]
+            elif "gate_id" in params:
+                gate_id = params["gate_id"]
+            else:
+                raise ValueError("gate_id is required")
+            return lambda summaries: [_version_dict(timestamp, gate)
+                    for timestamp, gate in summaries.gates.get_history(device_id,
+                            qubit_id, gate_id, start, end, limit)]
+        return None
+
+    def _get_body(self, key, read):
+        """
+        Return the serialized body cached for key, and its compressed form if
+        it is large enough, serializing what read returns on a miss.
+        """
+        with self._lock:
+            entry = self._bodies.get(key)
+            if entry is not None:
+                self._bodies.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        body = json.dumps(read()).encode("utf-8")
+        compressed = None
+        if len(body) >= self.gzip_min_size:
+            compressed = gzip.compress(body, compresslevel=6, mtime=0)
+        entry = (body, compressed)
+
+        if self.cache_size > 0:
+            with self._lock:
+                # The version is part of the key so entries never go stale
+                self._bodies[key] = entry
+                self._bodies.move_to_end(key)
+                while len(self._bodies) > self.cache_size:
+                    self._bodies.popitem(last=False)
+        return entry
+
+def _respond(start_response, status, body, headers, method):
+    headers = [("Content-Type", "application/json")] + headers
+    if not status.startswith("304"):
+        headers.append(("Content-Length", str(len(body))))
+    start_response(status, headers)
+    return [b""] if method == "HEAD" or status.startswith("304") else [body]
+
+def _error(message):
+    return json.dumps(dict(error=message)).encode("utf-8")
+
+def _path_parts(environ):
+    """
+    Decoded segments of the request path, split before decoding when the
+    server passes the raw URI.
+    """
+    raw = environ.get("RAW_URI") or environ.get("REQUEST_URI")
+    if raw is None:
+        return environ.get("PATH_INFO", "").strip("/").split("/")
+    path = raw.partition("?")[0]
+    if "://" in path:
+        path = urlsplit(path).path
+    script_name = quote(environ.get("SCRIPT_NAME", ""))
+    if script_name and path.startswith(script_name):
+        path = path[len(script_name):]
+    return [unquote(part) for part in path.strip("/").split("/")]
+
+def _int(name, value, minimum=None):
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError("{} must be an integer, got {}".format(name, value))
+    if minimum is not None and number < minimum:
+        raise ValueError("{} must be at least {}, got {}".format(name, minimum, value))
+    return number
+
+def _etags(header):
+    return [etag.strip() for etag in header.split(",")]
+
+def _accepts_gzip(header):
+    for coding in header.split(","):
+        name, _, params = coding.partition(";")
+        if name.strip() == "gzip":
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+def _summary_dict(summary):
+    return dict(device_id=summary.device_id, description=summary.description,
+            qubits=[dict(qubit._asdict(), gates=[gate._asdict() for gate in
+                    sorted(summary.gates.get(qubit.qubit_id, ()),
+                            key=lambda gate: gate.gate_id)])
+                    for qubit in summary.qubits])
+
+def _version_dict(timestamp, value):
+    return dict(timestamp=timestamp, value=None if value is None else value._asdict())
@@ -1,5 +1,6 @@
 import pytest
-from qversions._db import Base, DeviceModel, GateModel, QubitModel
+from qversions._db import Base, DeviceModel, DeviceVersionModel, GateArchiveModel, \
+        GateHeadModel, GateModel, HorizonModel, QubitArchiveModel, QubitHeadModel, QubitModel
 from qversions.device import Device
 from qversions.qubit import Qubit
 from qversions.gate import Gate
@@ -7,7 +8,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 engine = create_engine("sqlite:///:memory:")
-# engine = create_engine("postgres://postgres@localhost:5432/qversions")
+# engine = create_engine("postgresql://postgres@localhost:5432/qversions")
 # engine = create_engine("mysql+mysqldb://root@localhost/qversions")
 
 Base.metadata.drop_all(engine)
@@ -19,6 +20,12 @@ def setup():
     session.query(DeviceModel).delete()
     session.query(GateModel).delete()
     session.query(QubitModel).delete()
+    session.query(GateHeadModel).delete()
+    session.query(QubitHeadModel).delete()
+    session.query(DeviceVersionModel).delete()
+    session.query(GateArchiveModel).delete()
+    session.query(QubitArchiveModel).delete()
+    session.query(HorizonModel).delete()
     session.commit()
     yield
 
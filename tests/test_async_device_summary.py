@@ -0,0 +1,59 @@
+from base_test import *
+import asyncio
+import pytest
+from qversions.device_summary import DeviceSummary
+
+aiosqlite = pytest.importorskip("aiosqlite")
+
+from qversions.async_device_summary import AsyncDeviceSummaries
+from sqlalchemy.ext.asyncio import create_async_engine
+
+def run(tmpdir, test):
+    async def main():
+        async_engine = create_async_engine("sqlite+aiosqlite:///" + str(tmpdir.join("async.db")))
+        async with async_engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        try:
+            await test(AsyncDeviceSummaries(async_engine))
+        finally:
+            await async_engine.dispose()
+    asyncio.run(main())
+
+def test_save_and_get(tmpdir):
+    async def test(q):
+        await q.create_device(name1, desc)
+        await q.save_qubit(qubit0)
+        await q.save_qubit(qubit1)
+        timestamp = await q.save_gate(gate1X)
+        await q.save_gate(gate1Y)
+        assert await q.get_device(name1) == DeviceSummary(name1, desc, [qubit0, qubit1],
+                {1: set([gate1X, gate1Y])})
+        assert await q.get_snapshot(name1, timestamp) == DeviceSummary(name1, desc,
+                [qubit0, qubit1], dict())
+    run(tmpdir, test)
+
+def test_errors(tmpdir):
+    async def test(q):
+        await q.create_device(name1, desc)
+        with pytest.raises(RuntimeError):
+            await q.create_device(name1, desc)
+        with pytest.raises(RuntimeError):
+            await q.get_device(name2)
+        with pytest.raises(RuntimeError):
+            await q.save_gate(gate0X)
+        assert await q.get_device(name1) == DeviceSummary(name1, desc, list(), dict())
+    run(tmpdir, test)
+
+def test_concurrent_reads(tmpdir):
+    async def test(q):
+        await q.create_device(name1, desc)
+        await q.save_calibration(name1, [qubit0, qubit1], [gate0X])
+        summaries = await asyncio.gather(*[q.get_device(name1) for _ in range(50)])
+        assert all(summary == summaries[0] for summary in summaries)
+    run(tmpdir, test)
+
+def test_latest_query_invalid():
+    async_engine = create_async_engine("sqlite+aiosqlite://")
+    with pytest.raises(ValueError):
+        AsyncDeviceSummaries(async_engine, latest_query="distinct_on")
+    assert AsyncDeviceSummaries(async_engine, latest_query="window").latest_query == "window"
@@ -0,0 +1,100 @@
+from base_test import *
+import pytest
+from qversions.cache import MemorySnapshotStore, SnapshotStore, SqliteSnapshotStore, \
+        SummaryCache
+from qversions.device_summary import DeviceSummary
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_hit_and_miss():
+    cache = SummaryCache()
+    assert cache.get_or_load(name1, None, lambda: "latest") == "latest"
+    assert cache.get_or_load(name1, None, lambda: "reloaded") == "latest"
+    assert cache.get_or_load(name1, 5, lambda: "snapshot") == "snapshot"
+    assert cache.stats() == dict(hits=1, misses=2, evictions=0, expirations=0, size=2)
+
+def test_lru_eviction():
+    cache = SummaryCache(maxsize=2)
+    cache.get_or_load(name1, None, lambda: 1)
+    cache.get_or_load(name2, None, lambda: 2)
+    cache.get_or_load(name1, None, lambda: None)
+    cache.get_or_load(name3, None, lambda: 3)
+    assert cache.get_or_load(name1, None, lambda: None) == 1
+    assert cache.get_or_load(name2, None, lambda: "reloaded") == "reloaded"
+    assert cache.evictions == 2
+
+def test_ttl():
+    timer = FakeTimer()
+    cache = SummaryCache(ttl=10, timer=timer)
+    cache.get_or_load(name1, None, lambda: "old")
+    timer.now = 9.0
+    assert cache.get_or_load(name1, None, lambda: "new") == "old"
+    timer.now = 10.0
+    assert cache.get_or_load(name1, None, lambda: "new") == "new"
+    assert cache.expirations == 1
+
+def test_invalidate():
+    cache = SummaryCache()
+    cache.get_or_load(name1, None, lambda: "latest")
+    cache.get_or_load(name1, 10, lambda: "before write")
+    cache.get_or_load(name1, 30, lambda: "after write")
+    cache.get_or_load(name2, None, lambda: "other device")
+    cache.invalidate(name1, 20)
+    assert cache.get_or_load(name1, None, lambda: "reloaded") == "reloaded"
+    assert cache.get_or_load(name1, 10, lambda: "reloaded") == "before write"
+    assert cache.get_or_load(name1, 30, lambda: "reloaded") == "reloaded"
+    assert cache.get_or_load(name2, None, lambda: "reloaded") == "other device"
+    cache.invalidate(name1)
+    assert cache.get_or_load(name1, 10, lambda: "reloaded") == "reloaded"
+
+def test_write_during_load():
+    cache = SummaryCache()
+    def load():
+        cache.invalidate(name1, 1)
+        return "stale"
+    assert cache.get_or_load(name1, None, load) == "stale"
+    assert cache.get_or_load(name1, None, lambda: "fresh") == "fresh"
+
+def test_snapshot_store_settle():
+    store = MemorySnapshotStore(settle=1.0)
+    assert store.is_settled(1000000, 2000000)
+    assert not store.is_settled(1000001, 2000000)
+
+def test_snapshot_store_abstract():
+    class IncompleteStore(SnapshotStore):
+        def _get(self, device_id, timestamp):
+            return None
+
+    with pytest.raises(TypeError):
+        SnapshotStore()
+    with pytest.raises(TypeError):
+        IncompleteStore()
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmpdir):
+    if request.param == "memory":
+        return MemorySnapshotStore()
+    return SqliteSnapshotStore(str(tmpdir.join("snapshots.db")))
+
+def test_snapshot_store(store):
+    assert store.get_or_load(name1, 10, lambda: "snapshot") == "snapshot"
+    assert store.get_or_load(name1, 10, lambda: "reloaded") == "snapshot"
+    assert store.get_or_load(name1, 30, lambda: "later") == "later"
+    assert store.stats() == dict(hits=1, misses=2)
+    store.invalidate(name1, 20)
+    assert store.get_or_load(name1, 10, lambda: "reloaded") == "snapshot"
+    assert store.get_or_load(name1, 30, lambda: "reloaded") == "reloaded"
+    store.invalidate(name1)
+    assert len(store) == 0
+
+def test_sqlite_snapshot_store_persists(tmpdir):
+    path = str(tmpdir.join("snapshots.db"))
+    SqliteSnapshotStore(path).get_or_load(name1, 10, lambda: DeviceSummary(name1,
+            desc, [qubit0], {0: set([gate0X])}))
+    assert SqliteSnapshotStore(path).get_or_load(name1, 10, lambda: None) == \
+            DeviceSummary(name1, desc, [qubit0], {0: set([gate0X])})
@@ -0,0 +1,146 @@
+from base_test import *
+import asyncio
+from qversions.changes import ChangeEvent, ChangeFeed, LocalChangeFeed, \
+        PostgresChangeFeed, _decode, _encode
+from qversions.device_summary import DeviceSummaries
+from sqlalchemy import create_engine
+from threading import Thread
+
+def test_subscribe():
+    q = DeviceSummaries(engine)
+    everything = q.subscribe()
+    device1 = q.subscribe(name1)
+    q.create_device(name1, desc)
+    q.create_device(name2, desc)
+    qubit_timestamp = q.save_qubit(qubit0)
+    gate_timestamp = q.save_gate(gate0X)
+    calibration_timestamp = q.save_calibration(name1, [qubit1], [gate1X])
+    q.devices.delete_device(name2)
+
+    assert [device1.get(timeout=1) for _ in range(5)] == [
+            ChangeEvent(name1, "device", None),
+            ChangeEvent(name1, "qubit", qubit_timestamp),
+            ChangeEvent(name1, "gate", gate_timestamp),
+            ChangeEvent(name1, "qubit", calibration_timestamp),
+            ChangeEvent(name1, "gate", calibration_timestamp)]
+    assert device1.get(timeout=0.01) is None
+    events = [everything.get(timeout=1) for _ in range(7)]
+    assert events.count(ChangeEvent(name2, "device", None)) == 2
+
+    device1.close()
+    q.save_qubit(qubit0)
+    assert device1.get() is None
+    assert list(device1) == []
+    everything.close()
+
+def test_iterate():
+    feed = LocalChangeFeed()
+    q = DeviceSummaries(engine, change_feed=feed)
+    subscription = q.subscribe(name1)
+    received = []
+
+    def consume():
+        for event in subscription:
+            received.append(event)
+
+    consumer = Thread(target=consume)
+    consumer.start()
+    q.create_device(name1, desc)
+    q.save_qubit(qubit0)
+    feed.close()
+    consumer.join(timeout=1)
+    assert not consumer.is_alive()
+    assert [event.kind for event in received] == ["device", "qubit"]
+
+def test_async_iterate():
+    q = DeviceSummaries(engine)
+
+    async def main():
+        with q.subscribe(name1) as subscription:
+            q.create_device(name1, desc)
+            timestamp = q.save_qubit(qubit0)
+            received = []
+            async for event in subscription:
+                received.append(event)
+                if len(received) == 2:
+                    break
+            return timestamp, received
+
+    timestamp, received = asyncio.run(main())
+    assert received == [ChangeEvent(name1, "device", None),
+            ChangeEvent(name1, "qubit", timestamp)]
+
+def test_async_idle_subscriptions():
+    feed = LocalChangeFeed()
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        subscriptions = [feed.subscribe(name1) for _ in range(50)]
+
+        async def first(subscription):
+            async for event in subscription:
+                return event
+
+        readers = [asyncio.ensure_future(first(subscription))
+                for subscription in subscriptions]
+        await asyncio.sleep(0.01)
+        # Waiting readers don't hold executor threads
+        assert await asyncio.wait_for(loop.run_in_executor(None, lambda: 1), 1) == 1
+
+        readers[0].cancel()
+        await asyncio.sleep(0.01)
+        assert subscriptions[0]._waiters == []
+        await loop.run_in_executor(None, feed.publish, ChangeEvent(name1, "qubit", 1))
+        events = await asyncio.wait_for(asyncio.gather(*readers[1:]), 1)
+        assert events == [ChangeEvent(name1, "qubit", 1)] * 49
+
+        feed.close()
+        assert [event async for event in subscriptions[1]] == []
+
+    asyncio.run(main())
+
+class BrokenFeed(LocalChangeFeed):
+    def publish(self, event):
+        raise ConnectionError("feed is down")
+
+def test_publish_fails(caplog):
+    q = DeviceSummaries(engine, change_feed=BrokenFeed())
+    q.create_device(name1, desc)
+    # The change is saved even though it could not be published
+    timestamp = q.save_qubit(qubit0)
+    assert q.qubits.get_history(name1, 0) == [(timestamp, qubit0)]
+    assert "Could not publish qubit change of device {}".format(name1) in caplog.text
+
+def test_change_feed_abstract():
+    class IncompleteFeed(ChangeFeed):
+        pass
+
+    with pytest.raises(TypeError):
+        IncompleteFeed()
+
+class ConnectError(Exception):
+    pass
+
+def test_postgres_feed_fails_to_start():
+    def creator():
+        raise ConnectError()
+
+    with pytest.raises(ConnectError):
+        PostgresChangeFeed(create_engine("sqlite://", creator=creator))
+    # sqlite has no LISTEN, the feed fails instead of coming up dead
+    with pytest.raises(Exception):
+        PostgresChangeFeed(create_engine("sqlite://"))
+
+def test_encode():
+    event = ChangeEvent(name1, "gate", 1234567890123456)
+    assert _decode(_encode(event)) == event
+
+def test_event_immutable():
+    event = ChangeEvent(name1, "qubit", 1)
+    with pytest.raises(AttributeError):
+        event.timestamp = 2
+    assert not hasattr(event, "__dict__")
+    assert event == ChangeEvent(name1, "qubit", 1) and \
+            hash(event) == hash(ChangeEvent(name1, "qubit", 1))
+    assert event != (name1, "qubit", 1) and event != None
+    assert event.replace(kind="gate") == ChangeEvent(name1, "gate", 1)
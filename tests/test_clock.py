@@ -0,0 +1,58 @@
+from base_test import *
+import multiprocessing
+import pytest
+import qversions._clock
+from qversions.engine import create_engine
+from qversions.qubit import Qubits
+
+qubits = Qubits(engine)
+
+def test_clock_going_backwards(monkeypatch):
+    monkeypatch.setattr(qversions._clock.time, "time", lambda: 2000.0)
+    first = qubits.save_qubit(qubit0)
+    second = qubits.save_qubit(qubit0)
+    monkeypatch.setattr(qversions._clock.time, "time", lambda: 1000.0)
+    third = qubits.delete_qubit(name1, 0)
+    assert first == 2000000000
+    assert first < second < third
+    assert [timestamp for timestamp, _ in qubits.get_history(name1, 0)] == \
+            [first, second, third]
+
+def test_devices_have_separate_clocks(monkeypatch):
+    monkeypatch.setattr(qversions._clock.time, "time", lambda: 2000.0)
+    qubits.save_qubit(qubit0)
+    qubits.save_qubit(qubit0)
+    assert qubits.save_qubit(Qubit(name2, 0, 0.0, 0.0, 0.0)) == 2000000000
+
+WRITERS = 4
+WRITES = 25
+
+def write(url, writer):
+    # Same wall clock everywhere, the worst case for collisions
+    qversions._clock.current_timestamp = lambda: 1000000000
+    writer_qubits = Qubits(create_engine(url, connect_args={"timeout": 60}))
+    for write in range(WRITES):
+        writer_qubits.save_qubit(Qubit(name1, 0, 0.0, float(writer), float(write)))
+
+def test_concurrent_writers(tmpdir):
+    # Every process writes to the same qubit as fast as it can
+    url = "sqlite:///" + str(tmpdir.join("clock.db"))
+    Base.metadata.create_all(create_engine(url))
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=write, args=(url, writer))
+            for writer in range(WRITERS)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    history = Qubits(create_engine(url)).get_history(name1, 0)
+    assert len(history) == WRITERS * WRITES
+    assert set((qubit.t1, qubit.t2) for _, qubit in history) == \
+            set((float(writer), float(write)) for writer in range(WRITERS)
+                    for write in range(WRITES))
+    for writer in range(WRITERS):
+        # Each writer's versions were saved in order
+        writes = [qubit.t2 for _, qubit in history if qubit.t1 == float(writer)]
+        assert writes == sorted(writes)
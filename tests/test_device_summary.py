@@ -1,8 +1,21 @@
 from base_test import *
+import pickle
 import pytest
-from qversions.device_summary import DeviceSummary, DeviceSummaries
+import random
+from qversions.cache import MemorySnapshotStore, SummaryCache
+from qversions.device import Device
+from qversions.device_summary import Change, DeviceDiff, DeviceSummary, DeviceSummaries
+from qversions._clock import current_timestamp
+from qversions._db import RoutedSessions
 from qversions.qubit import Qubit
 from qversions.gate import Gate
+import qversions.gate
+import qversions.qubit
+from qversions import _archive
+from sqlalchemy import create_engine
+import sqlite3
+from threading import Thread
+import time
 
 q = DeviceSummaries(engine)
 
@@ -40,3 +53,538 @@ def test_save_gate():
     assert q.get_device(name1).get_gates_by_qubit(0) == None
     with pytest.raises(RuntimeError):
         q.save_gate(gate0X)
+
+def test_summary_lookups():
+    summary = DeviceSummary(name1, desc, [qubit0, qubit1], {
+            0: set([gate0X]),
+            1: set([gate1X, gate1Y])
+        })
+    assert summary.get_qubit(1) == qubit1
+    assert summary.get_qubit(2) == None
+    assert summary.get_gate(1, "-Y/2") == gate1Y
+    assert summary.get_gate(0, "-Y/2") == None
+    assert summary.get_gate(2, "+X") == None
+    assert summary.get_gates_by_qubit(1) == set([gate1X, gate1Y])
+
+def test_summary_immutable():
+    summary = DeviceSummary(name1, desc, [qubit0], {0: set([gate0X])})
+    with pytest.raises(AttributeError):
+        summary.description = "new"
+    with pytest.raises(TypeError):
+        summary.gates[1] = set([gate1X])
+    with pytest.raises(AttributeError):
+        summary.gates[0].add(gate1X)
+    assert hash(summary) == hash(DeviceSummary(name1, desc, [qubit0], {0: set([gate0X])}))
+    assert pickle.loads(pickle.dumps(summary)) == summary
+
+    # Summaries pickled by older versions kept their fields in a __dict__
+    old = DeviceSummary.__new__(DeviceSummary)
+    old.__setstate__(dict(device_id=name1, description=desc, qubits=[qubit0],
+            gates={0: set([gate0X])}))
+    assert old == summary
+
+def test_save_nonexistent():
+    with pytest.raises(RuntimeError):
+        q.save_qubit(qubit0)
+    with pytest.raises(RuntimeError):
+        q.save_gate(gate0X)
+    q.create_device(name1, desc)
+    with pytest.raises(RuntimeError):
+        q.save_gate(gate0X)
+    q.save_qubit(qubit0)
+    q.devices.delete_device(name1)
+    with pytest.raises(RuntimeError):
+        q.save_qubit(qubit1)
+    with pytest.raises(RuntimeError):
+        q.save_gate(gate0X)
+    assert q.qubits.get_history(name1, 1) == []
+    assert q.gates.get_history(name1, 0, "X") == []
+
+def test_save_gate_head_tables():
+    head_q = DeviceSummaries(engine, head_tables=True)
+    head_q.create_device(name1, desc)
+    head_q.save_qubit(qubit0)
+    head_q.save_gate(gate0X)
+    assert head_q.get_device(name1).get_gates_by_qubit(0) == set([gate0X])
+    head_q.qubits.delete_qubit(name1, 0)
+    with pytest.raises(RuntimeError):
+        head_q.save_gate(gate0X)
+
+def test_get_nonexistent():
+    with pytest.raises(RuntimeError):
+        q.get_device(name1)
+    q.create_device(name1, desc)
+    q.devices.delete_device(name1)
+    with pytest.raises(RuntimeError):
+        q.get_device(name1)
+
+def test_get_snapshot():
+    q.create_device(name1, desc)
+    q.save_qubit(qubit0)
+    q.save_gate(gate0X)
+    before_qubit1 = q.save_qubit(qubit1)
+    before_delete = q.qubits.delete_qubit(name1, 0)
+    assert q.get_device(name1) == DeviceSummary(name1, desc, [qubit1], dict())
+    assert q.get_snapshot(name1, before_delete) == DeviceSummary(name1, desc,
+            [qubit0, qubit1], {0: set([gate0X])})
+    assert q.get_snapshot(name1, before_qubit1) == DeviceSummary(name1, desc,
+            [qubit0], {0: set([gate0X])})
+
+def test_head_tables():
+    head_q = DeviceSummaries(engine, head_tables=True)
+    head_q.create_device(name1, desc)
+    head_q.save_qubit(qubit0)
+    head_q.save_qubit(qubit1)
+    head_q.save_gate(gate1X)
+    before_delete = head_q.qubits.delete_qubit(name1, 1)
+    assert head_q.get_device(name1) == DeviceSummary(name1, desc, [qubit0], dict())
+    assert head_q.get_snapshot(name1, before_delete) == DeviceSummary(name1, desc,
+            [qubit0, qubit1], {1: set([gate1X])})
+
+def test_cache():
+    cache = SummaryCache()
+    cached_q = DeviceSummaries(engine, cache=cache)
+    cached_q.create_device(name1, desc)
+    cached_q.save_qubit(qubit0)
+    assert cached_q.get_device(name1) == DeviceSummary(name1, desc, [qubit0], dict())
+    assert cached_q.get_device(name1) == DeviceSummary(name1, desc, [qubit0], dict())
+    assert cache.hits == 1
+
+    cached_q.save_gate(gate0X)
+    assert cached_q.get_device(name1).get_gates_by_qubit(0) == set([gate0X])
+    cached_q.gates.delete_gate(name1, 0, "+X")
+    assert cached_q.get_device(name1).get_gates_by_qubit(0) == None
+    cached_q.devices.update_device(Device(name1, "new"))
+    assert cached_q.get_device(name1).description == "new"
+    cached_q.devices.delete_device(name1)
+    with pytest.raises(RuntimeError):
+        cached_q.get_device(name1)
+
+def test_snapshot_store():
+    store = MemorySnapshotStore(settle=0.0)
+    stored_q = DeviceSummaries(engine, snapshot_store=store)
+    stored_q.create_device(name1, desc)
+    stored_q.save_qubit(qubit0)
+    timestamp = stored_q.save_qubit(qubit1)
+    expected = DeviceSummary(name1, desc, [qubit0], dict())
+    assert stored_q.get_snapshot(name1, timestamp) == expected
+    stored_q.qubits.delete_qubit(name1, 0)
+    assert stored_q.get_snapshot(name1, timestamp) == expected
+    assert store.stats() == dict(hits=1, misses=1)
+    assert stored_q.get_snapshot(name1, current_timestamp() + 1000000) == \
+            DeviceSummary(name1, desc, [qubit1], dict())
+    assert len(store) == 1
+
+def test_save_calibration():
+    q.create_device(name1, desc)
+    q.save_qubit(qubit0)
+    timestamp = q.save_calibration(name1, [qubit1], [gate1X, gate1Y, gate0X])
+    expected = DeviceSummary(name1, desc, [qubit0, qubit1], {
+            0: set([gate0X]),
+            1: set([gate1X, gate1Y])
+        })
+    assert q.get_device(name1) == expected
+    assert q.get_snapshot(name1, timestamp) == DeviceSummary(name1, desc, [qubit0], dict())
+    assert q.get_snapshot(name1, timestamp + 1) == expected
+
+def test_save_calibration_head_tables():
+    head_q = DeviceSummaries(engine, head_tables=True)
+    head_q.create_device(name1, desc)
+    head_q.save_calibration(name1, [qubit0, qubit1], [gate0X])
+    new_qubit0 = Qubit(name1, 0, 2.0, 2.0, 2.0)
+    head_q.save_calibration(name1, [new_qubit0], [gate1X])
+    assert head_q.get_device(name1) == DeviceSummary(name1, desc, [new_qubit0, qubit1], {
+            0: set([gate0X]),
+            1: set([gate1X])
+        })
+
+def test_save_calibration_head_chunks(monkeypatch):
+    monkeypatch.setattr(qversions.qubit, "_HEAD_CHUNK", 2)
+    monkeypatch.setattr(qversions.gate, "_HEAD_CHUNK", 2)
+    head_q = DeviceSummaries(engine, head_tables=True)
+    head_q.create_device(name1, desc)
+    new_qubits = [Qubit(name1, i, 0.0, 0.0, 0.0) for i in range(5)]
+    new_gates = [Gate(name1, i, "+X", 0.0, 0.0, 0.0) for i in range(5)]
+    head_q.save_calibration(name1, new_qubits[:3], new_gates[:3])
+    new_qubits = [qubit.replace(t1=1.0) for qubit in new_qubits]
+    new_gates = [gate.replace(phase=1.0) for gate in new_gates]
+    head_q.save_calibration(name1, new_qubits, new_gates)
+    assert head_q.get_device(name1) == DeviceSummary(name1, desc, new_qubits,
+            dict((gate.qubit_id, set([gate])) for gate in new_gates))
+
+def test_save_calibration_invalid():
+    with pytest.raises(RuntimeError):
+        q.save_calibration(name1, [qubit0])
+    q.create_device(name1, desc)
+    with pytest.raises(RuntimeError):
+        q.save_calibration(name1, [qubit0], [gate1X])
+    with pytest.raises(ValueError):
+        q.save_calibration(name1, [qubit0, qubit0])
+    with pytest.raises(ValueError):
+        q.save_calibration(name2, [qubit0])
+    assert q.get_device(name1) == DeviceSummary(name1, desc, list(), dict())
+
+def test_diff():
+    q.create_device(name1, desc)
+    start = q.save_calibration(name1, [Qubit(name1, 0, 0.0, 0.0, 0.0), qubit1],
+            [Gate(name1, 1, "+X", 1.0, 1.0, 1.0), gate1Y])
+    middle = q.save_qubit(Qubit(name1, 0, 0.0, 5.0, 0.0))
+    q.save_qubit(Qubit(name1, 2, 2.0, 2.0, 2.0))
+    q.save_gate(Gate(name1, 1, "+X", 2.0, 1.0, 1.0))
+    q.save_gate(gate0X)
+    q.gates.delete_gate(name1, 1, "-Y/2")
+    q.save_qubit(qubit1)
+
+    diff = q.diff(name1, start + 1)
+    assert diff.added_qubits == [Qubit(name1, 2, 2.0, 2.0, 2.0)]
+    assert diff.removed_qubits == []
+    assert diff.changed_qubits == [Change(Qubit(name1, 0, 0.0, 0.0, 0.0),
+            Qubit(name1, 0, 0.0, 5.0, 0.0))]
+    assert diff.changed_qubits[0].fields == {"t1": (0.0, 5.0)}
+    assert diff.added_gates == [gate0X]
+    assert diff.removed_gates == [gate1Y]
+    assert diff.changed_gates[0].fields == {"amplitude": (1.0, 2.0)}
+
+    diff = q.diff(name1, start + 1, middle + 1)
+    assert diff.added_qubits == [] and diff.added_gates == [] and diff.changed_gates == []
+    assert [change.new.qubit_id for change in diff.changed_qubits] == [0]
+    assert q.diff(name1, middle + 1, middle + 1).is_empty()
+
+    with pytest.raises(ValueError):
+        q.diff(name1, middle, start)
+    with pytest.raises(RuntimeError):
+        q.diff(name2, start)
+
+def _snapshot_diff(device_id, start, end):
+    """
+    DeviceDiff computed by comparing the two whole snapshots.
+    """
+    before, after = q.get_snapshot(device_id, start), q.get_snapshot(device_id, end)
+    values = [(dict(((qubit.qubit_id,), qubit) for qubit in summary.qubits),
+            dict(((gate.qubit_id, gate.gate_id), gate)
+            for gates in summary.gates.values() for gate in gates))
+            for summary in (before, after)]
+    results = []
+    for old_values, new_values in zip(*values):
+        keys = sorted(set(old_values) | set(new_values))
+        results += [[new_values[key] for key in keys if key not in old_values],
+                [old_values[key] for key in keys if key not in new_values],
+                [Change(old_values[key], new_values[key]) for key in keys
+                        if key in old_values and key in new_values
+                        and old_values[key] != new_values[key]]]
+    return DeviceDiff(device_id, start, end, *results)
+
+@pytest.mark.parametrize("seed", range(10))
+def test_diff_matches_snapshots(seed):
+    rng = random.Random(seed)
+    q.create_device(name1, desc)
+    timestamps = []
+    for _ in range(30):
+        qubit_id = rng.randrange(3)
+        gate_id = rng.choice(["+X", "-Y/2"])
+        value = float(rng.randrange(3))
+        action = rng.randrange(4)
+        try:
+            if action == 0:
+                timestamps.append(q.qubits.save_qubit(Qubit(name1, qubit_id, value,
+                        1.0, 1.0)))
+            elif action == 1:
+                # Gates saved straight through Gates may belong to deleted qubits
+                timestamps.append(q.gates.save_gate(Gate(name1, qubit_id, gate_id,
+                        value, 1.0, 1.0)))
+            elif action == 2:
+                timestamps.append(q.qubits.delete_qubit(name1, qubit_id))
+            else:
+                timestamps.append(q.gates.delete_gate(name1, qubit_id, gate_id))
+        except RuntimeError:
+            pass
+
+    for _ in range(20):
+        start, end = sorted(rng.sample(timestamps, 2))
+        assert q.diff(name1, start + 1, end + 1) == _snapshot_diff(name1, start + 1,
+                end + 1)
+
+def test_diff_qubit_removed_and_restored():
+    q.create_device(name1, desc)
+    q.save_calibration(name1, [qubit1], [gate1X])
+    start = q.qubits.delete_qubit(name1, 1) + 1
+    q.gates.save_gate(gate1X.replace(amplitude=2.0))
+    q.gates.save_gate(gate1X)
+    assert q.diff(name1, start, q.get_version(name1) + 1).is_empty()
+
+    end = q.save_qubit(qubit1) + 1
+    diff = q.diff(name1, start, end)
+    assert diff.added_qubits == [qubit1]
+    assert diff.added_gates == [gate1X]
+    diff = q.diff(name1, start - 1, end)
+    assert diff.added_qubits == [] and diff.removed_gates == [] and diff.added_gates == []
+
+def test_restore_snapshot():
+    q.create_device(name1, desc)
+    calibration = [Qubit(name1, 0, 0.0, 0.0, 0.0), qubit1]
+    gates = [Gate(name1, 1, "+X", 1.0, 1.0, 1.0), gate1Y]
+    q.save_calibration(name1, calibration, gates)
+    good = q.get_device(name1)
+    good_timestamp = q.save_qubit(Qubit(name1, 0, 9.0, 9.0, 9.0))
+    q.save_qubit(Qubit(name1, 2, 2.0, 2.0, 2.0))
+    q.save_gate(Gate(name1, 2, "+X", 2.0, 2.0, 2.0))
+    q.qubits.delete_qubit(name1, 1)
+    q.gates.delete_gate(name1, 1, "-Y/2")
+
+    before_restore = q.restore_snapshot(name1, good_timestamp)
+    assert q.get_device(name1) == good
+    assert q.get_snapshot(name1, before_restore) != good
+    assert q.diff(name1, before_restore, before_restore + 1).added_qubits == [qubit1]
+
+    # Every restored version shares one timestamp
+    assert q.qubits.get_history(name1, 2)[-1] == (before_restore, None)
+    assert q.gates.get_history(name1, 1, "-Y/2")[-1] == (before_restore, gate1Y)
+
+    # Restoring a state that is already current writes nothing
+    q.restore_snapshot(name1, before_restore + 1)
+    assert q.qubits.get_history(name1, 0)[-1][0] == before_restore
+    assert q.get_device(name1) == good
+
+def test_restore_snapshot_nonexistent():
+    with pytest.raises(RuntimeError):
+        q.restore_snapshot(name1, 1)
+
+def test_read_replicas(tmpdir):
+    paths = [str(tmpdir.join(name)) for name in ["primary.db", "replica1.db", "replica2.db"]]
+    primary, replica1, replica2 = [create_engine("sqlite:///" + path) for path in paths]
+    for e in [primary, replica1, replica2]:
+        Base.metadata.create_all(e)
+
+    def replicate(path):
+        source = sqlite3.connect(paths[0])
+        target = sqlite3.connect(path)
+        source.backup(target)
+        source.close()
+        target.close()
+
+    now = [0.0]
+    sessions = RoutedSessions(primary, [replica1, replica2], stickiness=1.0,
+            timer=lambda: now[0])
+    routed = DeviceSummaries(sessions)
+    routed.create_device(name1, desc)
+    routed.save_qubit(qubit0)
+
+    # Reads right after a write see it on the primary
+    assert routed.get_device(name1).qubits == (qubit0,)
+
+    # Then they alternate between replicas that haven't caught up
+    now[0] = 2.0
+    replicate(paths[1])
+    routed.save_qubit(qubit1)
+    now[0] = 4.0
+    assert routed.get_device(name1).qubits == (qubit0,)
+    with pytest.raises(RuntimeError):
+        routed.get_device(name1)
+    assert routed.qubits.get_history(name1, 1) == []
+    assert routed.devices.get_all_devices() == []
+
+    replicate(paths[2])
+    assert routed.get_device(name1).qubits == (qubit0,)
+    assert routed.get_device(name1).qubits == (qubit0, qubit1)
+
+def test_read_engines_invalid():
+    with pytest.raises(ValueError):
+        RoutedSessions(engine, [])
+    assert DeviceSummaries(engine, read_engines=[engine]).sessions.read_engines == [engine]
+
+def test_compact():
+    q.create_device(name1, desc)
+    q.create_device(name2, desc)
+    timestamps = []
+    for i in range(5):
+        timestamps.append(q.save_calibration(name1,
+                [Qubit(name1, 0, float(i), 0.0, 0.0), Qubit(name1, 1, float(i), 1.0, 1.0)],
+                [Gate(name1, 0, "+X", float(i), 0.0, 0.0)]))
+    q.save_qubit(Qubit(name2, 0, 0.0, 0.0, 0.0))
+    q.save_qubit(Qubit(name2, 0, 1.0, 0.0, 0.0))
+    timestamps.append(q.qubits.delete_qubit(name1, 1))
+    horizon = q.save_qubit(Qubit(name1, 0, 9.0, 9.0, 9.0))
+    timestamps.append(horizon)
+    timestamps.append(q.save_gate(Gate(name1, 0, "+X", 9.0, 9.0, 9.0)) + 1)
+
+    def everything():
+        return ([q.get_snapshot(name1, t) for t in timestamps],
+                q.get_device(name1), q.get_device(name2),
+                q.qubits.get_history(name1, 0), q.qubits.get_history(name1, 1),
+                q.gates.get_history(name1, 0, "+X"),
+                list(q.gates.iter_history(name1, 0, "+X", batch_size=2)),
+                q.qubits.get_history(name2, 0, start=timestamps[2]),
+                q.diff(name1, timestamps[1], timestamps[4]),
+                q.diff(name1, timestamps[1], timestamps[-1]))
+
+    before = everything()
+    assert q.compact(horizon, batch_size=2, grace=0) == 4 + 5 + 4 + 1
+    assert everything() == before
+    assert q.qubits.export_history(name1)["timestamp"].tolist() == \
+            [t for t, _ in before[3]] + [t for t, _ in before[4]]
+
+    # Only the versions current at the horizon and after it are left in the
+    # tables read for the latest state
+    session = sessionmaker(bind=engine)()
+    assert session.query(QubitModel).filter_by(device_id=name1).count() == 3
+    assert session.query(GateModel).count() == 2
+    assert session.query(QubitArchiveModel).count() == 10
+    session.close()
+
+    # A horizon never moves back and compacting again moves nothing
+    assert q.compact(timestamps[0], grace=0) == 0
+    assert q.compact(horizon, grace=0) == 0
+    assert everything() == before
+
+    q.restore_snapshot(name1, timestamps[1])
+    assert q.get_device(name1) == before[0][1]
+    with pytest.raises(ValueError):
+        q.compact(horizon, batch_size=0, grace=0)
+
+def test_compact_during_read(monkeypatch, tmp_path):
+    # Threads need a database they share, a file instead of memory
+    file_engine = create_engine("sqlite:///" + str(tmp_path / "compact.db"))
+    Base.metadata.create_all(file_engine)
+    file_q = DeviceSummaries(file_engine)
+    file_q.create_device(name1, desc)
+    file_q.save_qubit(qubit0)
+    replaced = file_q.save_qubit(qubit0.replace(t1=5.0))
+    horizon = file_q.save_qubit(qubit0.replace(t1=9.0))
+    get_horizon = _archive.get_horizon
+    compaction = Thread(target=file_q.compact, args=(horizon,), kwargs=dict(grace=1.0))
+
+    def raise_during_read(session, table_name):
+        # The horizon is raised right after the read saw the old one
+        result = get_horizon(session, table_name)
+        if table_name == QubitModel.__tablename__ and compaction.ident is None:
+            compaction.start()
+            while get_horizon(session, table_name) is None:
+                time.sleep(0.01)
+        return result
+
+    monkeypatch.setattr(_archive, "get_horizon", raise_during_read)
+    assert file_q.get_snapshot(name1, replaced).qubits == (qubit0,)
+    compaction.join()
+    assert file_q.get_snapshot(name1, replaced).qubits == (qubit0,)
+    session = sessionmaker(bind=file_engine)()
+    assert session.query(QubitArchiveModel).count() == 1
+    session.close()
+
+def test_get_devices():
+    q.create_device(name1, desc)
+    q.create_device(name2, "Second device")
+    q.create_device(name3, desc)
+    before = q.save_calibration(name1, [qubit0, qubit1], [gate0X, gate1X])
+    qubit2 = Qubit(name2, 0, 2.0, 2.0, 2.0)
+    gate2 = Gate(name2, 0, "+X", 2.0, 2.0, 2.0)
+    q.save_calibration(name2, [qubit2], [gate2])
+    q.qubits.delete_qubit(name1, 1)
+    q.devices.delete_device(name3)
+
+    summaries = q.get_devices()
+    assert list(summaries) == [name1, name2]
+    assert summaries[name1] == q.get_device(name1)
+    assert summaries[name2] == q.get_device(name2)
+    assert q.get_devices([name2]) == {name2: q.get_device(name2)}
+    assert q.get_devices([name2, name1], timestamp=before + 1) == {
+            name1: q.get_snapshot(name1, before + 1),
+            name2: q.get_snapshot(name2, before + 1)}
+    assert q.get_devices([]) == {}
+
+    with pytest.raises(RuntimeError):
+        q.get_devices([name1, name3])
+    with pytest.raises(TypeError):
+        q.get_devices([1])
+
+def test_get_devices_head_tables():
+    head_q = DeviceSummaries(engine, head_tables=True)
+    head_q.create_device(name1, desc)
+    head_q.create_device(name2, desc)
+    head_q.save_calibration(name1, [qubit0], [gate0X])
+    assert head_q.get_devices([name1, name2]) == {name1: head_q.get_device(name1),
+            name2: head_q.get_device(name2)}
+
+def test_get_version():
+    q.create_device(name1, desc)
+    versions = [q.get_version(name1)]
+    assert q.get_device(name1, if_changed_since=versions[-1]) is None
+
+    for write in [lambda: q.save_qubit(qubit0),
+            lambda: q.save_gate(gate0X),
+            lambda: q.save_calibration(name1, [qubit1], [gate1X]),
+            lambda: q.gates.delete_gate(name1, 1, "+X"),
+            lambda: q.qubits.delete_qubit(name1, 1),
+            lambda: q.devices.update_device(Device(name1, "New description")),
+            lambda: q.restore_snapshot(name1, versions[1])]:
+        write()
+        versions.append(q.get_version(name1))
+        assert versions[-1] > versions[-2]
+        assert q.get_device(name1, if_changed_since=versions[-2]) == q.get_device(name1)
+        assert q.get_device(name1, if_changed_since=versions[-1]) is None
+
+    q.devices.delete_device(name1)
+    with pytest.raises(RuntimeError):
+        q.get_version(name1)
+    with pytest.raises(RuntimeError):
+        q.get_device(name1, if_changed_since=versions[-1])
+    q.devices.restore_device(name1)
+    assert q.get_version(name1) > versions[-1]
+    with pytest.raises(TypeError):
+        q.get_device(name1, if_changed_since="1")
+
+def test_get_snapshots():
+    q.create_device(name1, desc)
+    timestamps = [q.save_qubit(qubit0)]
+    timestamps.append(q.save_gate(gate0X))
+    timestamps.append(q.save_calibration(name1, [qubit0.replace(t1=5.0), qubit1],
+            [gate1X]))
+    timestamps.append(q.gates.delete_gate(name1, 0, "+X"))
+    timestamps.append(q.qubits.delete_qubit(name1, 1))
+    timestamps.append(q.save_qubit(qubit1))
+    requested = [t + offset for t in timestamps for offset in (0, 1)]
+    requested.append(requested[-1] + 1000)
+
+    snapshots = list(q.get_snapshots(name1, reversed(requested)))
+    assert [timestamp for timestamp, _ in snapshots] == requested
+    for timestamp, summary in snapshots:
+        assert summary == q.get_snapshot(name1, timestamp)
+
+    q.compact(timestamps[3], grace=0)
+    assert list(q.get_snapshots(name1, requested)) == snapshots
+    assert list(q.get_snapshots(name1, [])) == []
+
+    with pytest.raises(RuntimeError):
+        list(q.get_snapshots(name2, requested))
+    with pytest.raises(ValueError):
+        list(q.get_snapshots(name1, [0]))
+    with pytest.raises(TypeError):
+        list(q.get_snapshots(name1, ["1"]))
+
+@pytest.mark.parametrize("latest_query", ["group_by", "window"])
+@pytest.mark.parametrize("head_tables", [False, True])
+def test_latest_query(latest_query, head_tables):
+    strategy_q = DeviceSummaries(engine, head_tables=head_tables,
+            latest_query=latest_query)
+    strategy_q.create_device(name1, desc)
+    timestamps = [strategy_q.save_calibration(name1, [qubit0, qubit1], [gate0X, gate1X])]
+    timestamps.append(strategy_q.save_qubit(qubit1.replace(t2=5.0)))
+    timestamps.append(strategy_q.gates.delete_gate(name1, 0, "+X"))
+    timestamps.append(strategy_q.qubits.delete_qubit(name1, 0))
+    timestamps.append(strategy_q.save_gate(gate1X.replace(phase=5.0)))
+    requested = [t + 1 for t in timestamps]
+
+    for timestamp, summary in list(strategy_q.get_snapshots(name1, requested)):
+        assert strategy_q.get_snapshot(name1, timestamp) == summary
+    assert strategy_q.get_device(name1) == summary
+    assert strategy_q.diff(name1, requested[0], requested[-1]) == \
+            q.diff(name1, requested[0], requested[-1])
+
+def test_latest_query_invalid():
+    with pytest.raises(ValueError):
+        DeviceSummaries(engine, latest_query="max")
+    # sqlite can't run these, which is known as soon as there is an engine
+    for latest_query in ["distinct_on", "lateral"]:
+        with pytest.raises(ValueError):
+            DeviceSummaries(engine, latest_query=latest_query)
+        with pytest.raises(ValueError):
+            DeviceSummaries(engine, read_engines=[engine], latest_query=latest_query)
@@ -0,0 +1,46 @@
+from base_test import *
+import pytest
+from qversions.device_summary import DeviceSummaries
+from qversions.engine import create_engine
+from sqlalchemy.pool import QueuePool
+import time
+
+def test_sqlite_defaults():
+    memory_engine = create_engine("sqlite:///:memory:")
+    assert memory_engine.pool.__class__ is not QueuePool
+    assert memory_engine.pool._recycle == -1
+    assert not memory_engine.pool._pre_ping
+    assert create_engine("sqlite://", pool_recycle=60).pool._recycle == 60
+
+def test_sqlite_memory_kept(monkeypatch):
+    memory_engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(memory_engine)
+    summaries = DeviceSummaries(memory_engine)
+    summaries.create_device(name1, desc)
+    # Long after any recycle time the database is still there
+    monkeypatch.setattr(time, "time", lambda now=time.time(): now + 100000)
+    assert summaries.devices.get_device(name1).description == desc
+
+def test_sessions_are_returned(tmpdir):
+    # A single connection that is never handed out twice, any leaked session
+    # makes the next call time out
+    file_engine = create_engine("sqlite:///" + str(tmpdir.join("pool.db")),
+            poolclass=QueuePool, pool_size=1, max_overflow=0, pool_timeout=1)
+    Base.metadata.create_all(file_engine)
+    summaries = DeviceSummaries(file_engine)
+    summaries.create_device(name1, desc)
+    for _ in range(20):
+        summaries.save_qubit(qubit0)
+        summaries.save_gate(gate0X)
+        summaries.get_device(name1)
+        summaries.get_snapshot(name1, 1)
+        summaries.qubits.get_qubit(name1, 0)
+        summaries.gates.get_gates_by_qubit(name1, 0)
+        summaries.devices.get_all_devices()
+        with pytest.raises(RuntimeError):
+            summaries.create_device(name1, desc)
+        with pytest.raises(RuntimeError):
+            summaries.get_device(name2)
+        with pytest.raises(RuntimeError):
+            summaries.qubits.delete_qubit(name2, 0)
+    assert file_engine.pool.checkedout() == 0
@@ -10,12 +10,18 @@ def test_save():
 
 def test_update():
     initial_timestamp = gates.save_gate(gate0X)
-    gate0X.amplitude = -1.0
-    update_timestamp = gates.save_gate(gate0X)
+    update_timestamp = gates.save_gate(gate0X.replace(amplitude=-1.0))
     assert gates.get_gate(name1, 0, "+X").amplitude == -1.0
     assert gates.get_gate(name1, 0, "+X", update_timestamp).amplitude == 0.0
     assert gates.get_gate(name1, 0, "+X", initial_timestamp) == None
 
+def test_immutable():
+    gate = Gate(name1, 0, "+X", amplitude=0.0, width=0.0, phase=0.0)
+    with pytest.raises(AttributeError):
+        gate.amplitude = -1.0
+    assert gate == gate0X and hash(gate) == hash(gate0X)
+    assert set([gate, gate0X, gate1X]) == set([gate0X, gate1X])
+
 def test_get_gates_by_qubit():
     gate_on_different_device = Gate(name2, 0, "+X", amplitude=5.0, width=5.0, phase=5.0)
     save_gates([gate1X, gate1Y, gate0X, gate_on_different_device])
@@ -39,3 +45,61 @@ def test_delete_gate_nonexistent():
 def save_gates(gate_list):
     for gate in gate_list:
         gates.save_gate(gate)
+
+def test_head_table():
+    head_gates = Gates(engine, head_table=True)
+    head_gates.save_gate(gate1Y)
+    initial_timestamp = head_gates.save_gate(Gate(name1, 1, "+X", 0.0, 0.0, 0.0))
+    update_timestamp = head_gates.save_gate(Gate(name1, 1, "+X", 2.0, 2.0, 2.0))
+    assert head_gates.get_gate(name1, 1, "+X") == Gate(name1, 1, "+X", 2.0, 2.0, 2.0)
+    assert head_gates.get_gate(name1, 1, "+X", update_timestamp) == Gate(name1, 1, "+X", 0.0, 0.0, 0.0)
+    assert head_gates.get_gate(name1, 1, "+X", initial_timestamp) == None
+    head_gates.delete_gate(name1, 1, "+X")
+    assert head_gates.get_gate(name1, 1, "+X") == None
+    assert set(head_gates.get_gates_by_device(name1)) == set([gate1Y])
+
+def test_rebuild_head_table():
+    save_gates([gate1X, gate1Y, gate0X])
+    head_gates = Gates(engine, head_table=True)
+    assert head_gates.get_gates_by_device(name1) == []
+    head_gates.rebuild_head_table()
+    assert set(head_gates.get_gates_by_device(name1)) == set([gate1X, gate1Y, gate0X])
+
+def test_get_history():
+    first = Gate(name1, 0, "+X", 1.0, 1.0, 1.0)
+    second = Gate(name1, 0, "+X", 2.0, 2.0, 2.0)
+    first_timestamp = gates.save_gate(first)
+    gates.save_gate(Gate(name1, 0, "-X", 1.0, 1.0, 1.0))
+    second_timestamp = gates.save_gate(second)
+    delete_timestamp = gates.delete_gate(name1, 0, "+X")
+    history = [(first_timestamp, first), (second_timestamp, second), (delete_timestamp, None)]
+    assert gates.get_history(name1, 0, "+X") == history
+    assert gates.get_history(name1, 0, "+X", limit=2) == history[:2]
+    assert gates.get_history(name1, 0, "+X", start=second_timestamp) == history[1:]
+    assert gates.get_history(name1, 0, "+X", end=second_timestamp) == history[:1]
+    with pytest.raises(ValueError):
+        gates.get_history(name1, 0, "+X", limit=-1)
+
+def test_iter_history():
+    versions = [Gate(name1, 0, "+X", float(i), 1.0, 1.0) for i in range(5)]
+    timestamps = [gates.save_gate(version) for version in versions]
+    history = list(zip(timestamps, versions))
+    assert list(gates.iter_history(name1, 0, "+X", batch_size=2)) == history
+    assert list(gates.iter_history(name1, 0, "+X", start=timestamps[1],
+            end=timestamps[4], batch_size=1)) == history[1:4]
+    with pytest.raises(ValueError):
+        list(gates.iter_history(name1, 0, "+X", batch_size=0))
+
+def test_export_history():
+    pytest.importorskip("numpy")
+    first_timestamp = gates.save_gate(gate1Y)
+    second_timestamp = gates.save_gate(gate0X)
+    delete_timestamp = gates.delete_gate(name1, 0, "+X")
+    columns = gates.export_history(name1, start=second_timestamp)
+    assert list(columns["gate_id"]) == ["+X", "+X"]
+    assert list(columns["timestamp"]) == [second_timestamp, delete_timestamp]
+    assert list(columns["archived"]) == [False, True]
+    array = gates.export_history(name1, structured=True)
+    assert list(array["gate_id"]) == ["+X", "+X", "-Y/2"]
+    assert array[2]["amplitude"] == 1.2
+    assert len(gates.export_history(name2, structured=True)) == 0
@@ -1,6 +1,9 @@
 from base_test import *
+import pickle
 import pytest
 from qversions.qubit import Qubit, Qubits
+from sqlalchemy import create_mock_engine
+from sqlalchemy.orm import Session
 
 qubits = Qubits(engine)
 
@@ -10,12 +13,23 @@ def test_save():
 
 def test_update():
     initial_timestamp = qubits.save_qubit(qubit0)
-    qubit0.t1 = -1.0
-    update_timestamp = qubits.save_qubit(qubit0)
+    update_timestamp = qubits.save_qubit(qubit0.replace(t1=-1.0))
     assert qubits.get_qubit(name1, 0).t1 == -1.0
     assert qubits.get_qubit(name1, 0, update_timestamp).t1 == 0.0
     assert qubits.get_qubit(name1, 0, initial_timestamp) == None
 
+def test_immutable():
+    qubit = Qubit(name1, 0, resonance_frequency=0.0, t1=0.0, t2=0.0)
+    with pytest.raises(AttributeError):
+        qubit.t1 = -1.0
+    with pytest.raises(AttributeError):
+        qubit.other = 1
+    assert not hasattr(qubit, "__dict__")
+    assert qubit == qubit0 and hash(qubit) == hash(qubit0)
+    assert qubit != qubit1 and qubit != None
+    assert qubit.replace(qubit_id=1, resonance_frequency=1.0, t1=1.0, t2=1.0) == qubit1
+    assert pickle.loads(pickle.dumps(qubit)) == qubit
+
 def test_get_qubits_by_device():
     qubit_on_different_device = Qubit("test-device-2", 1, resonance_frequency=5.0, t1=5.0, t2=5.0)
     save_qubits([qubit0, qubit1, qubit_on_different_device])
@@ -32,3 +46,80 @@ def test_delete_qubit_nonexists():
 def save_qubits(qubit_list):
     for qubit in qubit_list:
         qubits.save_qubit(qubit)
+
+def test_head_table():
+    head_qubits = Qubits(engine, head_table=True)
+    head_qubits.save_qubit(qubit1)
+    initial_timestamp = head_qubits.save_qubit(Qubit(name1, 0, 0.0, 0.0, 0.0))
+    update_timestamp = head_qubits.save_qubit(Qubit(name1, 0, 2.0, 2.0, 2.0))
+    assert head_qubits.get_qubit(name1, 0) == Qubit(name1, 0, 2.0, 2.0, 2.0)
+    assert head_qubits.get_qubit(name1, 0, update_timestamp) == Qubit(name1, 0, 0.0, 0.0, 0.0)
+    assert head_qubits.get_qubit(name1, 0, initial_timestamp) == None
+    head_qubits.delete_qubit(name1, 0)
+    assert head_qubits.get_qubit(name1, 0) == None
+    assert set(head_qubits.get_qubits_by_device(name1)) == set([qubit1])
+
+def test_rebuild_head_table():
+    save_qubits([qubit0, qubit1])
+    head_qubits = Qubits(engine, head_table=True)
+    assert head_qubits.get_qubits_by_device(name1) == []
+    head_qubits.rebuild_head_table()
+    assert set(head_qubits.get_qubits_by_device(name1)) == set([qubit0, qubit1])
+
+def test_get_history():
+    first = Qubit(name1, 0, 1.0, 1.0, 1.0)
+    second = Qubit(name1, 0, 2.0, 2.0, 2.0)
+    first_timestamp = qubits.save_qubit(first)
+    qubits.save_qubit(qubit1)
+    second_timestamp = qubits.save_qubit(second)
+    delete_timestamp = qubits.delete_qubit(name1, 0)
+    history = [(first_timestamp, first), (second_timestamp, second), (delete_timestamp, None)]
+    assert qubits.get_history(name1, 0) == history
+    assert qubits.get_history(name1, 0, limit=2) == history[:2]
+    assert qubits.get_history(name1, 0, start=second_timestamp) == history[1:]
+    assert qubits.get_history(name1, 0, end=second_timestamp) == history[:1]
+    assert qubits.get_history(name1, 2) == []
+    with pytest.raises(ValueError):
+        qubits.get_history(name1, 0, limit=-1)
+    with pytest.raises(TypeError):
+        qubits.get_history(name1, 0, limit="2")
+
+def test_iter_history():
+    versions = [Qubit(name1, 0, float(i), 1.0, 1.0) for i in range(5)]
+    timestamps = [qubits.save_qubit(version) for version in versions]
+    history = list(zip(timestamps, versions))
+    assert list(qubits.iter_history(name1, 0, batch_size=2)) == history
+    assert list(qubits.iter_history(name1, 0, start=timestamps[1], end=timestamps[4],
+            batch_size=1)) == history[1:4]
+    with pytest.raises(ValueError):
+        list(qubits.iter_history(name1, 0, batch_size=0))
+
+def test_export_history():
+    pytest.importorskip("numpy")
+    first_timestamp = qubits.save_qubit(Qubit(name1, 1, 1.0, 2.0, 3.0))
+    second_timestamp = qubits.save_qubit(Qubit(name1, 0, 0.0, 0.0, 0.0))
+    qubits.save_qubit(Qubit(name2, 0, 5.0, 5.0, 5.0))
+    columns = qubits.export_history(name1)
+    assert list(columns["qubit_id"]) == [0, 1]
+    assert list(columns["timestamp"]) == [second_timestamp, first_timestamp]
+    assert list(columns["t2"]) == [0.0, 3.0]
+    assert list(columns["archived"]) == [False, False]
+    array = qubits.export_history(name1, end=second_timestamp, structured=True)
+    assert array.dtype.names == ("qubit_id", "timestamp", "resonance_frequency",
+            "t1", "t2", "archived")
+    assert len(array) == 1 and array[0]["t1"] == 2.0
+
+@pytest.mark.parametrize("latest_query, expected", [
+        ("distinct_on", "DISTINCT ON (qubits.device_id, qubits.qubit_id)"),
+        ("lateral", "JOIN LATERAL"),
+        ("window", "row_number() OVER (PARTITION BY qubits.device_id, qubits.qubit_id "
+                "ORDER BY qubits.timestamp DESC)"),
+        (None, "DISTINCT ON")])
+def test_latest_query_postgres(latest_query, expected):
+    postgres = create_mock_engine("postgresql://", lambda *args, **kwargs: None)
+    postgres_qubits = Qubits(postgres, latest_query=latest_query)
+    latest = postgres_qubits._latest(Session(bind=postgres),
+            lambda query_builder: query_builder.filter_by(device_id=name1), 1000, QubitModel)
+    sql = str(latest.select().compile(dialect=postgres.dialect))
+    assert expected in sql
+    assert "timestamp <" in sql
@@ -0,0 +1,41 @@
+from base_test import *
+import pytest
+from qversions.schema import create_tables
+from sqlalchemy import create_mock_engine, inspect
+
+def _postgres_ddl(partitions):
+    statements = []
+
+    def executor(sql, *multiparams, **params):
+        statements.append(str(sql.compile(dialect=postgres.dialect)).strip())
+
+    postgres = create_mock_engine("postgresql://", executor)
+    create_tables(postgres, partitions)
+    return statements
+
+def test_create_tables(tmpdir):
+    file_engine = create_engine("sqlite:///" + str(tmpdir.join("schema.db")))
+    create_tables(file_engine)
+    assert set(inspect(file_engine).get_table_names()) == set(Base.metadata.tables)
+
+def test_create_partitioned_tables():
+    statements = _postgres_ddl(4)
+    qubits = [s for s in statements if s.startswith("CREATE TABLE qubits")]
+    assert len(qubits) == 1
+    assert qubits[0].endswith("PARTITION BY HASH (device_id)")
+    assert "CREATE TABLE IF NOT EXISTS qubits_p3 PARTITION OF qubits "\
+            "FOR VALUES WITH (MODULUS 4, REMAINDER 3)" in statements
+    assert "CREATE TABLE IF NOT EXISTS gate_heads_p0 PARTITION OF gate_heads "\
+            "FOR VALUES WITH (MODULUS 4, REMAINDER 0)" in statements
+    assert len([s for s in statements if "PARTITION OF" in s]) == 24
+    devices = [s for s in statements if s.startswith("CREATE TABLE devices")]
+    assert "PARTITION" not in devices[0]
+
+    # The shared table definitions are left alone
+    assert not Base.metadata.tables["qubits"].dialect_options["postgresql"]["partition_by"]
+
+def test_create_partitioned_tables_invalid():
+    with pytest.raises(ValueError):
+        create_tables(engine, 4)
+    with pytest.raises(ValueError):
+        _postgres_ddl(0)
@@ -0,0 +1,155 @@
+from base_test import *
+import gzip
+import json
+from qversions.device_summary import DeviceSummaries
+from qversions.service import Service
+from sqlalchemy import create_engine
+from wsgiref.util import setup_testing_defaults
+
+def request(app, path, query="", method="GET", environ=None, **headers):
+    environ = dict(environ or {}, PATH_INFO=path, QUERY_STRING=query,
+            REQUEST_METHOD=method)
+    environ.update(("HTTP_" + name.upper(), value) for name, value in headers.items())
+    setup_testing_defaults(environ)
+    response = {}
+
+    def start_response(status, response_headers):
+        response["status"] = int(status.split()[0])
+        response["headers"] = dict(response_headers)
+
+    response["body"] = b"".join(app(environ, start_response))
+    return response
+
+def test_get_device():
+    q = DeviceSummaries(engine)
+    app = Service(q)
+    q.create_device(name1, desc)
+    q.save_calibration(name1, [qubit0, qubit1], [gate1X])
+
+    response = request(app, "/devices/" + name1)
+    assert response["status"] == 200
+    assert response["headers"]["ETag"] == '"{}"'.format(q.get_version(name1))
+    assert json.loads(response["body"]) == dict(device_id=name1, description=desc,
+            qubits=[dict(device_id=name1, qubit_id=0, resonance_frequency=0.0,
+                    t1=0.0, t2=0.0, gates=[]),
+                    dict(device_id=name1, qubit_id=1, resonance_frequency=1.0,
+                    t1=1.0, t2=1.0, gates=[dict(device_id=name1, qubit_id=1,
+                            gate_id="+X", amplitude=1.0, width=1.0, phase=1.0)])])
+
+    etag = response["headers"]["ETag"]
+    assert request(app, "/devices/" + name1)["body"] == response["body"]
+    assert app.stats() == dict(hits=1, misses=1, not_modified=0, size=1)
+    not_modified = request(app, "/devices/" + name1, if_none_match=etag)
+    assert not_modified["status"] == 304
+    assert not_modified["body"] == b""
+    assert app.stats()["not_modified"] == 1
+
+    q.save_qubit(qubit0.replace(t1=5.0))
+    changed = request(app, "/devices/" + name1, if_none_match=etag)
+    assert changed["status"] == 200
+    assert changed["headers"]["ETag"] != etag
+    assert json.loads(changed["body"])["qubits"][0]["t1"] == 5.0
+
+def test_read_replicas():
+    lagging_engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(lagging_engine)
+    lagging = DeviceSummaries(lagging_engine)
+    lagging.create_device(name1, desc)
+    lagging.save_qubit(qubit0)
+    q = DeviceSummaries(engine)
+    q.create_device(name1, desc)
+    q.save_qubit(qubit0)
+    q.save_qubit(qubit0.replace(t1=5.0))
+
+    # Reads alternate between the replicas, the version and the body of a
+    # response always come from the same one
+    app = Service(DeviceSummaries(engine, read_engines=[engine, lagging_engine]))
+    t1s = {'"{}"'.format(q.get_version(name1)): 5.0,
+            '"{}"'.format(lagging.get_version(name1)): 0.0}
+    for _ in range(4):
+        response = request(app, "/devices/" + name1)
+        assert json.loads(response["body"])["qubits"][0]["t1"] == \
+                t1s[response["headers"]["ETag"]]
+
+def test_snapshots_and_history():
+    q = DeviceSummaries(engine)
+    app = Service(q)
+    q.create_device(name1, desc)
+    before = q.save_qubit(qubit0)
+    q.save_gate(gate0X)
+    after = q.save_qubit(qubit0.replace(t1=5.0))
+
+    snapshot = request(app, "/devices/{}/snapshots/{}".format(name1, after))
+    assert json.loads(snapshot["body"])["qubits"][0]["t1"] == 0.0
+
+    history = json.loads(request(app, "/devices/{}/qubits/0/history".format(name1),
+            query="start={}".format(before))["body"])
+    assert [(version["timestamp"], version["value"]["t1"]) for version in history] == \
+            [(before, 0.0), (after, 5.0)]
+    assert len(json.loads(request(app, "/devices/{}/qubits/0/history".format(name1),
+            query="limit=1")["body"])) == 1
+
+    q.gates.delete_gate(name1, 0, "+X")
+    history = json.loads(request(app,
+            "/devices/{}/qubits/0/gates/+X/history".format(name1))["body"])
+    assert [version["value"] is None for version in history] == [False, True]
+
+def test_encoded_ids():
+    q = DeviceSummaries(engine)
+    app = Service(q)
+    q.create_device(name1, desc)
+    q.save_calibration(name1, [qubit1], [gate1Y])
+    path = "/devices/{}/qubits/1/gates/-Y/2/history".format(name1)
+
+    # Servers decode %2F in PATH_INFO, so the raw URI is split instead
+    assert request(app, path)["status"] == 404
+    history = request(app, path, environ=dict(
+            RAW_URI="/devices/{}/qubits/1/gates/-Y%2F2/history?limit=5".format(name1)))
+    assert history["status"] == 200
+    assert json.loads(history["body"])[0]["value"]["gate_id"] == "-Y/2"
+    assert request(app, "/api" + path, environ=dict(SCRIPT_NAME="/api",
+            REQUEST_URI="/api/devices/{}/qubits/1/gates/-Y%2F2/history".format(name1)))\
+            ["body"] == history["body"]
+    assert request(app, "/devices/{}/qubits/1/gates/history".format(name1),
+            query="gate_id=-Y%2F2")["body"] == history["body"]
+    assert request(app, "/devices/{}/qubits/1/gates/history".format(name1))\
+            ["status"] == 400
+
+def test_gzip():
+    q = DeviceSummaries(engine)
+    app = Service(q, gzip_min_size=0)
+    q.create_device(name1, desc)
+    q.save_qubit(qubit0)
+
+    response = request(app, "/devices/" + name1, accept_encoding="deflate, gzip")
+    assert response["headers"]["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response["body"]) == request(app, "/devices/" + name1)["body"]
+    assert request(app, "/devices/" + name1, if_none_match=response["headers"]["ETag"])\
+            ["status"] == 304
+    assert "Content-Encoding" not in request(app, "/devices/" + name1,
+            accept_encoding="gzip;q=0")["headers"]
+    assert "Content-Encoding" not in request(Service(q), "/devices/" + name1,
+            accept_encoding="gzip")["headers"]
+
+def test_errors():
+    q = DeviceSummaries(engine)
+    app = Service(q, cache_size=0)
+    q.create_device(name1, desc)
+
+    assert request(app, "/devices/" + name2)["status"] == 404
+    assert request(app, "/devices")["status"] == 404
+    assert request(app, "/devices/{}/qubits".format(name1))["status"] == 404
+    assert request(app, "/devices/{}/snapshots/now".format(name1))["status"] == 400
+    assert request(app, "/devices/{}/qubits/0/history".format(name1),
+            query="limit=all")["status"] == 400
+    for timestamp in ["0", "-5"]:
+        assert request(app, "/devices/{}/snapshots/{}".format(name1, timestamp))\
+                ["status"] == 400
+    for query in ["limit=-1", "start=-1", "end=-1"]:
+        assert request(app, "/devices/{}/qubits/0/history".format(name1),
+                query=query)["status"] == 400
+    assert request(app, "/devices/" + name1, method="POST")["status"] == 405
+    head = request(app, "/devices/" + name1, method="HEAD")
+    assert head["status"] == 200
+    assert head["body"] == b""
+    assert app.stats()["size"] == 0